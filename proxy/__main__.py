@@ -6,14 +6,20 @@
 #
 import argparse
 import cache
+import connection_pool
 import constants
+import eviction
 import http_proxy
 import logging
 import http_server
 import os
+import pollable
 import poller
+import resolver
+import signal
 import time
 import traceback
+import workers
 
 ## Package name.
 PACKAGE_NAME = 'HTTP_Proxy'
@@ -54,6 +60,119 @@ def parse_args():
         type=int,
         help='Server bind port, default: %(default)s',
     )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help=(
+            'Number of worker processes sharing the bind ports, '
+            'default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        default=constants.DEFAULT_CONNECT_TIMEOUT,
+        type=float,
+        help='Seconds to connect to destination, default: %(default)s',
+    )
+    parser.add_argument(
+        '--first-byte-timeout',
+        default=constants.DEFAULT_FIRST_BYTE_TIMEOUT,
+        type=float,
+        help=(
+            'Seconds until request/response head is received, '
+            'default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--idle-timeout',
+        default=constants.DEFAULT_IDLE_TIMEOUT,
+        type=float,
+        help='Seconds a connection may be idle, default: %(default)s',
+    )
+    parser.add_argument(
+        '--total-timeout',
+        default=constants.DEFAULT_TOTAL_TIMEOUT,
+        type=float,
+        help=(
+            'Seconds a connection may live, 0 for unlimited, '
+            'default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--dns-server',
+        default=None,
+        help=(
+            'Name server to query, host[:port], '
+            'default: first nameserver in %s' % constants.RESOLV_CONF_FILE
+        ),
+    )
+    parser.add_argument(
+        '--max-head-size',
+        default=constants.MAX_HEAD_SIZE,
+        type=int,
+        help=(
+            'Max bytes of request or response head, '
+            'default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--max-headers',
+        default=constants.MAX_NUMBER_OF_HEADERS,
+        type=int,
+        help='Max number of headers in a message, default: %(default)s',
+    )
+    parser.add_argument(
+        '--memory-cache-size',
+        default=constants.MEMORY_CACHE_SIZE,
+        type=int,
+        help=(
+            'Bytes of cached responses kept in memory by each worker, '
+            '0 to disable, default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--memory-cache-object-size',
+        default=constants.MEMORY_CACHE_OBJECT_SIZE,
+        type=int,
+        help=(
+            'Max bytes of a cached response kept in memory, '
+            'default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--cache-size',
+        default=constants.CACHE_MAX_SIZE,
+        type=int,
+        help=(
+            'Max bytes of cache on disk, 0 for unlimited, enforced by each '
+            'worker, default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--cache-entries',
+        default=constants.CACHE_MAX_ENTRIES,
+        type=int,
+        help=(
+            'Max number of cache entries, 0 for unlimited, enforced by each '
+            'worker, default: %(default)s'
+        ),
+    )
+    parser.add_argument(
+        '--eviction-policy',
+        default=constants.CACHE_EVICTION_POLICY,
+        choices=sorted(eviction.POLICIES.keys()),
+        help='Cache eviction policy, default: %(default)s',
+    )
+    parser.add_argument(
+        '--cache-store',
+        default=constants.CACHE_STORE,
+        choices=constants.CACHE_STORES,
+        help=(
+            'Store cache entries in files, or small ones in segment files, '
+            'default: %(default)s'
+        ),
+    )
     parser.add_argument(
         '--base',
         default='.',
@@ -109,31 +228,56 @@ def setup_logging(stream=None, level=logging.INFO):
 
 ## Closes all open sockets
 def close_all(poll):
-    for p in poll._pollables:
+    for p in poll.pollables():
         p.close_socket()
 
 
-## Main implementation.
-def main():
-    application_context = {
-        'statistics': {
-            'throughput': [0, time.time()],
-        },
-        'connections': 0,
-    }
-    args = parse_args()
-    logger = setup_logging(
-        stream=open(args.log_file, 'a'),
-        level=args.log_level_str,
-    )
-    logger.info('Startup %s-%s', PACKAGE_NAME, PACKAGE_VERSION)
-    logger.debug('Args: %s', args)
-
+## Runs a single proxy worker.
+# @param args (dict) program arguments.
+# @param application_context (dict)
+# @param logger (logging.Logger)
+# @param slot (int) worker index.
+#
+def run_worker(args, application_context, logger, slot=0):
+    poll = None
+    cache_handler = None
     try:
         # Create poll.
-        poll = poller.Poller(logger)
+        poll = poller.Poller(
+            logger,
+            {
+                pollable.CONNECT_TIMEOUT: args.connect_timeout,
+                pollable.FIRST_BYTE_TIMEOUT: args.first_byte_timeout,
+                pollable.IDLE_TIMEOUT: args.idle_timeout,
+                pollable.TOTAL_TIMEOUT: args.total_timeout,
+            },
+        )
+        # Create resolver.
+        application_context['resolver'] = resolver.Resolver(
+            poll,
+            args.dns_server,
+            logger,
+        )
+        poll.register(application_context['resolver'])
+        # Create upstream connection pool.
+        application_context['pool'] = connection_pool.ConnectionPool(
+            poll,
+            logger,
+        )
         # Create cache handler.
-        cache_handler = cache.Cache(logger)
+        cache_handler = cache.Cache(
+            poll,
+            logger,
+            memory_size=args.memory_cache_size,
+            memory_object_size=args.memory_cache_object_size,
+            max_size=args.cache_size,
+            max_entries=args.cache_entries,
+            eviction_policy=args.eviction_policy,
+            cache_store=args.cache_store,
+            slot=slot,
+            shared=args.workers > 1,
+            sweep_statistics=application_context['statistics']['sweep'],
+        )
         # Create proxy listener.
         proxy_listener = http_proxy.ProxyListen(
             args.bind_address,
@@ -141,6 +285,7 @@ def main():
             cache_handler,
             application_context,
             logger,
+            reuse_port=args.workers > 1,
         )
         # Create server listener.
         server_listener = http_server.ServerListen(
@@ -149,6 +294,7 @@ def main():
             cache_handler,
             application_context,
             logger,
+            reuse_port=args.workers > 1,
         )
         poll.register(proxy_listener)
         poll.register(server_listener)
@@ -159,10 +305,58 @@ def main():
 
     finally:
         print 'exit'
-        close_all(poll)
+        if poll is not None:
+            close_all(poll)
+        if application_context['pool'] is not None:
+            application_context['pool'].close_all()
+        if cache_handler is not None:
+            cache_handler.save_index()
         logger.info('All sockets closed, shutting down log')
 
 
+## Main implementation.
+def main():
+    application_context = {
+        'statistics': {
+            'throughput': [0, time.time()],
+            'connections': [0],
+            'sweep': {
+                'entries': 0,
+                'bytes': 0,
+                'lag': 0,
+            },
+        },
+        'workers': None,
+        'resolver': None,
+        'pool': None,
+        # url -> ProxyClientSocket leading fetch of url
+        'fetches': {},
+    }
+    args = parse_args()
+    logger = setup_logging(
+        stream=open(args.log_file, 'a'),
+        level=args.log_level_str,
+    )
+    logger.info('Startup %s-%s', PACKAGE_NAME, PACKAGE_VERSION)
+    logger.debug('Args: %s', args)
+
+    if args.workers > 1:
+        shared_statistics = workers.SharedStatistics(args.workers)
+        application_context['workers'] = shared_statistics
+
+        def worker_main(index):
+            shared_statistics.reset(index)
+            application_context['statistics'] = (
+                shared_statistics.statistics(index)
+            )
+            run_worker(args, application_context, logger, index)
+
+        workers.Supervisor(args.workers, worker_main, logger).run()
+    else:
+        signal.signal(signal.SIGTERM, workers.terminate)
+        run_worker(args, application_context, logger)
+
+
 ## Error used for handling disconnecting sockets.
 class Disconnect(RuntimeError):
     def __init__(self):
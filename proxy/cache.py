@@ -4,64 +4,550 @@
 # Implementation of @ref proxy.cache
 #
 
+import cache_index
+import cache_reader
 import constants
 import datetime
+import eviction
+import freshness
 import hashlib
+import http_parser
+import memory_cache
 import os
 import os.path
+import segment_store
+import signal
 import time
 import traceback
+import urllib
 import util
+import zero_copy
 
 
 ## Cache Handler.
 #
 # Created when the program boots.
 # Handles all cache activities.
+# Entries are stored on disk, in files or segments, looked up through an
+# in-memory index, and small ones are kept in a memory tier as well.
 #
 class Cache():
     ## Constructor.
+    # @param poll (Poller) poll object, used for index snapshots.
     # @param logger (logging.Logger)
-    def __init__(self, logger):
-        # Currently opened files
+    # @param memory_size (int) bytes of responses kept in memory.
+    # @param memory_object_size (int) max bytes of response kept in memory.
+    # @param snapshot_interval (float) seconds between index snapshots.
+    # @param max_size (int) max bytes on disk, 0 for unlimited.
+    # @param max_entries (int) max number of entries, 0 for unlimited.
+    # @param eviction_policy (str) name of eviction policy.
+    # @param sweep_interval (float) seconds between sweeps of expired entries,
+    # 0 disables sweeping.
+    # @param cache_store (str) files or segments.
+    # @param slot (int) worker slot, owner of segments.
+    # @param shared (bool) whether other workers fill the same cache.
+    # @param sweep_statistics (dict) sweeper counters, may live in memory
+    # shared by workers.
+    #
+    def __init__(
+        self,
+        poll,
+        logger,
+        memory_size=constants.MEMORY_CACHE_SIZE,
+        memory_object_size=constants.MEMORY_CACHE_OBJECT_SIZE,
+        snapshot_interval=constants.CACHE_SNAPSHOT_INTERVAL,
+        max_size=constants.CACHE_MAX_SIZE,
+        max_entries=constants.CACHE_MAX_ENTRIES,
+        eviction_policy=constants.CACHE_EVICTION_POLICY,
+        sweep_interval=constants.CACHE_SWEEP_INTERVAL,
+        cache_store=constants.CACHE_STORE,
+        slot=0,
+        shared=False,
+        sweep_statistics=None,
+    ):
+        # Files opened for filling
         self._opened_files = {}
+        # Files opened for reading, url -> SharedFile
+        self._shared_files = {}
+        # Files being filled, url -> (expiration date, expected length)
+        self._filling = {}
+        # Content of files being filled that fit in memory, url -> list
+        self._fill_content = {}
+        # Url of response with Vary -> names of request headers
+        self._vary = {}
+        self._memory = memory_cache.MemoryCache(memory_size)
+        self._memory_object_size = memory_object_size
+        self._index = cache_index.CacheIndex(
+            eviction.POLICIES[eviction_policy](),
+        )
+        self._max_size = max_size
+        self._max_entries = max_entries
+        # Armed eviction timer, None if cache is within quota.
+        self._evict_timer = None
+        self._sweep_interval = sweep_interval
+        # Sweeper counters: entries and bytes it removed, and seconds since
+        # the earliest expired entry that is still stored.
+        if sweep_statistics is None:
+            sweep_statistics = {
+                'entries': 0,
+                'bytes': 0,
+                'lag': 0,
+            }
+        self.sweep_statistics = sweep_statistics
+        # Segment store, None if entries are stored in files.
+        self._store = None
+        if cache_store == 'segments':
+            self._store = segment_store.SegmentStore(
+                self.content_path(constants.SEGMENTS_PATH),
+                slot,
+            )
+        self._slot = slot
+        self._shared = shared
+        self._poll = poll
+        self._snapshot_interval = snapshot_interval
+        # Process writing index snapshot, None if there is none.
+        self._snapshot_pid = None
+        # Segment store position the running snapshot is saved with.
+        self._snapshot_mark = None
         self._logger = logger
+        self.load_index()
+        if self._snapshot_interval:
+            self._poll.arm_timer(self._snapshot_interval, self.snapshot)
+        if self._sweep_interval:
+            self._poll.arm_timer(self._sweep_interval, self.sweep)
+        if self._store is not None:
+            self._poll.arm_timer(
+                constants.SEGMENT_COMPACT_INTERVAL,
+                self.compact,
+            )
+        self.schedule_eviction()
+
+    ## Returns path of cache file.
+    # @param name (str) encoded url.
+    # @returns (str) path.
+    #
+    def content_path(self, name):
+        return '%s/%s/%s' % (os.getcwd(), constants.CACHING_PATH, name)
+
+    ## Returns path of metadata file.
+    # Metadata file holds the metadata lines, an empty line, and the response
+    # head (status line and headers, with the exact Content-Length of the
+    # stored content).
+    # @param name (str) encoded url.
+    # @returns (str) path.
+    #
+    def metadata_path(self, name):
+        return '%s/%s/metadata/%s' % (
+            os.getcwd(),
+            constants.CACHING_PATH,
+            name,
+        )
+
+    ## Returns path of index snapshot.
+    # Each worker slot has its own snapshot, entries other workers filled
+    # meanwhile are found by their metadata files at startup. Entries in
+    # segments are located by the index, so it is kept per worker as well.
+    # @returns (str) path.
+    #
+    def index_path(self):
+        if self._store is not None:
+            return self._store.index_path
+        return self.content_path(
+            '%s.%s' % (constants.CACHE_INDEX_FILE, self._slot),
+        )
+
+    ## Loads index from snapshot, and adds entries filled after it.
+    # Entries whose files or records were deleted are dropped.
+    #
+    def load_index(self):
+        for path in (self.content_path(''), self.metadata_path('')):
+            try:
+                os.mkdir(path)
+            except OSError:
+                pass
+
+        self.remove_orphans(self.content_path(''))
+        self.remove_orphans(self.metadata_path(''))
+        if self._store is not None:
+            self._store.open()
+            self.remove_orphans(self.content_path(constants.SEGMENTS_PATH))
+        self._index.load(self.index_path())
+        names = set(
+            name
+            for name in os.listdir(self.metadata_path(''))
+            if not name.endswith('.tmp')
+        )
+        for url, entry in list(self._index.items()):
+            name = self.encode_url(url)
+            if entry.location is not None:
+                if self._store is None or not self._store.adopt(
+                    url,
+                    entry.location,
+                    entry.size,
+                ):
+                    self._index.remove(url)
+            elif name in names:
+                names.discard(name)
+            else:
+                self._index.remove(url)
+        if self._store is not None:
+            self._store.mark = self._index.mark
+            self.recover_records()
+            # Recovered entries are saved before the records they came from
+            # may be compacted.
+            self.save_index()
+            self._store.drop_unused()
+        for url, entry in self._index.items():
+            self.note_vary(url, entry)
+        for name in names:
+            self.load_entry(name)
+        self._logger.debug('Cache index loaded, %s entries', len(self._index))
 
-    ## Checks if cache file exists and not expired.
+    ## Indexes segment records appended after the index snapshot.
+    # Record replaces or deletes entry of the same key that was appended
+    # before it, entry stored in files is kept.
+    #
+    def recover_records(self):
+        for key, expiration, head, size, location in self._store.recover():
+            old = self._index.get(key)
+            if old is not None and (
+                old.location is None or
+                old.location > location
+            ):
+                if head is not None:
+                    self._store.remove(location)
+                continue
+            if old is not None:
+                self._index.remove(key)
+                self._store.remove(old.location)
+            if head is None:
+                continue
+            self._index.add(
+                key,
+                cache_index.IndexEntry(expiration, size, 0, head, location),
+            )
+
+    ## Removes temporary files left by processes that are gone.
+    # @param path (str) directory.
+    #
+    def remove_orphans(self, path):
+        for name in os.listdir(path):
+            if not name.endswith('.tmp'):
+                continue
+            try:
+                if util.process_alive(int(name.split('.')[-2])):
+                    continue
+            except (IndexError, ValueError):
+                pass
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+    ## Returns path of temporary file, written by this process.
+    # Temporary file is named after the process, so one left by a dead
+    # process is removed at startup.
+    # @param path (str) path of file written through it.
+    # @returns (str) path.
+    #
+    def temp_path(self, path):
+        return '%s.%s.tmp' % (path, os.getpid())
+
+    ## Reads metadata file into index.
+    # Entry is left out if its cache file does not match the metadata.
+    # @param name (str) encoded url.
+    # @returns (IndexEntry) entry, None if there is no complete entry.
+    #
+    def load_entry(self, name):
+        try:
+            with open(self.metadata_path(name), 'rb') as metadata_file:
+                parsed_metadata = self.parse_metadata(metadata_file)
+            entry = cache_index.IndexEntry(
+                int(parsed_metadata['expiration_date']),
+                int(parsed_metadata.get('size', 0)),
+                int(parsed_metadata['hits']),
+                parsed_metadata['head'],
+            )
+            size = os.stat(self.content_path(name)).st_size
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        if not entry.head or size != entry.size:
+            return None
+        self._index.add(parsed_metadata['url'], entry)
+        self.note_vary(parsed_metadata['url'], entry)
+        return entry
+
+    ## Keeps names of headers that variant entry varies on.
+    # @param key (str) cache key.
+    # @param entry (IndexEntry).
+    #
+    def note_vary(self, key, entry):
+        if '#' in key:
+            names = freshness.vary_names(entry.headers)
+            if names:
+                self._vary[key.split('#', 1)[0]] = names
+
+    ## Returns cache key of request.
+    # Key is the url, followed by values of request headers the stored
+    # response varies on.
     # @param request_context (dict).
-    # @returns (bool) whether file exist or not.
+    # @returns (str) key.
     #
-    def check_if_exist(self, request_context):
-        if request_context['uri'] in self._opened_files:
-            return False
-        if (
-            os.path.isfile(
-                '%s/cache/%s' % (
-                    os.getcwd(),
-                    self.encode_url(
-                        request_context['uri']
-                    ),
-                )
+    def cache_key(self, request_context):
+        uri = request_context['uri']
+        names = self._vary.get(uri)
+        if not names:
+            return uri
+        headers = request_context['headers']
+        return '%s#%s' % (
+            uri,
+            '&'.join(
+                '%s=%s' % (name, urllib.quote(headers.get(name, ''), ''))
+                for name in names
+            ),
+        )
+
+    ## Writes index snapshot if index changed.
+    # Snapshot is saved with position of segment store, which is the mark
+    # for compaction once written. Snapshot being written by a forked
+    # process is waited for first, so this one is the last.
+    #
+    def save_index(self):
+        self.reap_snapshot(True)
+        if self._index.dirty:
+            if self._store is not None:
+                self._index.mark = self._store.position
+            try:
+                self._index.save(self.index_path())
+            except (IOError, OSError) as e:
+                self._logger.error('Error writing cache index %s', e)
+                return
+            if self._store is not None:
+                self._store.mark = self._index.mark
+
+    ## Called by timer to write index snapshot, re-arms the timer.
+    # Snapshot is written by a forked process, which gets a copy of the
+    # index, so the loop is not blocked while a large index is written.
+    # A single snapshot is written at a time.
+    #
+    def snapshot(self):
+        self.reap_snapshot()
+        if self._snapshot_pid is None and self._index.dirty:
+            if hasattr(os, 'fork'):
+                self.fork_snapshot()
+            else:
+                self.save_index()
+        if self._snapshot_interval:
+            self._poll.arm_timer(self._snapshot_interval, self.snapshot)
+
+    ## Forks a process that writes index snapshot.
+    # Index is clean from now on, changes made meanwhile go to the next one.
+    #
+    def fork_snapshot(self):
+        if self._store is not None:
+            self._index.mark = self._store.position
+        try:
+            pid = os.fork()
+        except OSError as e:
+            self._logger.error('Cannot fork index snapshot %s', e)
+            return
+        if pid == 0:
+            status = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self._index.save(self.index_path())
+                status = 0
+            finally:
+                os._exit(status)
+        self._snapshot_pid = pid
+        self._snapshot_mark = self._index.mark
+        self._index.dirty = False
+
+    ## Collects process that wrote index snapshot.
+    # Segment store mark moves once the snapshot was written, index is
+    # dirty again if it was not.
+    # @param block (bool) whether to wait for the process to finish.
+    #
+    def reap_snapshot(self, block=False):
+        if self._snapshot_pid is None:
+            return
+        try:
+            pid, status = os.waitpid(
+                self._snapshot_pid,
+                0 if block else os.WNOHANG,
             )
-        ):
-            metadata_file = open(
-                '%s/%s/metadata/%s' % (
-                    os.getcwd(),
-                    constants.CACHING_PATH,
-                    self.encode_url(request_context['uri']),
-                ),
-                'rb+',
+        except OSError as e:
+            pid, status = self._snapshot_pid, e.errno
+        if pid == 0:
+            return
+        self._snapshot_pid = None
+        if status == 0:
+            if self._store is not None:
+                self._store.mark = self._snapshot_mark
+        else:
+            self._logger.error('Error writing cache index, status %s', status)
+            self._index.dirty = True
+
+    ## Opens reader of cache file or segment record.
+    # File is shared with other readers of the entry, which read it
+    # positionally, so any number of connections can stream it at once.
+    # @param uri (str).
+    # @param entry (IndexEntry).
+    # @returns (CacheReader) reader.
+    #
+    def open_reader(self, uri, entry):
+        if entry.location is not None:
+            return self._store.open_reader(
+                uri,
+                entry.head,
+                entry.location,
+                entry.size,
+            )
+        shared = self._shared_files.get(uri)
+        if shared is None:
+            shared = cache_reader.SharedFile(
+                self.content_path(self.encode_url(uri)),
             )
-            parsed_metadata = self.parse_metadata(metadata_file)
-            exp_date = parsed_metadata['expiration_date']
-            parsed_metadata['hits'] = int(parsed_metadata['hits']) + 1
-            self.update_metadata(metadata_file, parsed_metadata)
-            metadata_file.close()
-            if int(exp_date) >= time.time():
-                return True
+            self._shared_files[uri] = shared
+        return cache_reader.CacheReader(uri, shared, entry.head)
+
+    ## Closes reader of request, if there is one.
+    # Called when response was sent, or connection was closed before.
+    # @param request_context (dict).
+    #
+    def close_reader(self, request_context):
+        reader = request_context.get('cache_reader')
+        if reader is None:
+            return
+        request_context['cache_reader'] = None
+        reader.close()
+        if (
+            reader.shared.closed and
+            self._shared_files.get(reader.uri) is reader.shared
+        ):
+            del self._shared_files[reader.uri]
+
+    ## Stops sharing file of url with new readers.
+    # Used when entry is replaced or deleted, current readers keep reading
+    # the file they opened.
+    # @param url (str).
+    #
+    def unshare(self, url):
+        self._shared_files.pop(url, None)
+
+    ## Checks whether cache is over quota.
+    # @returns (bool)
+    #
+    def over_quota(self):
+        return bool(
+            (self._max_size and self._index.size > self._max_size) or
+            (self._max_entries and len(self._index) > self._max_entries)
+        )
+
+    ## Arms eviction timer if cache is over quota.
+    #
+    def schedule_eviction(self):
+        if self._evict_timer is None and self.over_quota():
+            self._evict_timer = self._poll.arm_timer(0, self.evict)
+
+    ## Called by timer to evict entries while cache is over quota.
+    # A batch of entries is evicted, timer is re-armed if that was not
+    # enough, so the loop keeps serving meanwhile.
+    #
+    def evict(self):
+        self._evict_timer = None
+        for i in range(constants.CACHE_EVICTION_BATCH):
+            if not self.over_quota():
+                return
+            url = self._index.victim()
+            if url is None:
+                return
+            self._logger.debug('Evicting cache of %s', url)
+            self.delete_cache(url)
+        self.schedule_eviction()
+
+    ## Called by timer to remove expired entries.
+    # Entries are removed earliest expiration first, a batch at a time, timer
+    # is re-armed right away if expired entries are left. Entry with a
+    # validator (ETag or Last-Modified) is swept a while after it expired, so
+    # it can be revalidated meanwhile.
+    #
+    def sweep(self):
+        now = time.time()
+        for i in range(constants.CACHE_SWEEP_BATCH):
+            url = self._index.pop_sweepable(now)
+            if url is None:
+                break
+            self.sweep_statistics['entries'] += 1
+            self.sweep_statistics['bytes'] += self._index.get(url).disk_size
+            self.delete_cache(url)
+
+        date = self._index.next_sweep()
+        if date is not None and date < now:
+            self.sweep_statistics['lag'] = int(now - date)
+            self._poll.arm_timer(0, self.sweep)
+        else:
+            self.sweep_statistics['lag'] = 0
+            self._poll.arm_timer(self._sweep_interval, self.sweep)
+
+    ## Called by timer to compact segments.
+    # Records copied to the active segment are relocated in the index, timer
+    # is re-armed right away while there is more to copy.
+    #
+    def compact(self):
+        moved = self._store.compact(constants.SEGMENT_COMPACT_BYTES)
+        for key, old, new in moved:
+            entry = self._index.get(key)
+            if entry is None or entry.location != old:
+                if new is not None:
+                    self._store.remove(new)
+            elif new is None:
+                self._logger.debug('Record of %s is lost', key)
+                self.delete_cache(key)
             else:
-                self.delete_cache(request_context['uri'])
-        return False
+                entry.location = new
+                self._index.dirty = True
+        self._poll.arm_timer(
+            0 if moved else constants.SEGMENT_COMPACT_INTERVAL,
+            self.compact,
+        )
+
+    ## Keeps response of opened cache file in memory, if it is small enough.
+    # Disk store still has every entry, memory one is only dropped when
+    # evicted.
+    # @param request_context (dict).
+    #
+    def promote(self, request_context):
+        reader = request_context['cache_reader']
+        size = reader.size
+        if size > self._memory_object_size:
+            return
+        entry = memory_cache.MemoryEntry(reader.head, reader.read_all(size))
+        if len(entry.content) != size:
+            return
+        self.close_reader(request_context)
+        self._memory.put(request_context['cache_key'], entry)
+        request_context['cached_response'] = [entry.head, entry.content]
+
+    ## Writes metadata file of an entry.
+    # File is written aside and renamed over the previous one.
+    # @param key (str) cache key.
+    # @param entry (IndexEntry).
+    #
+    def write_metadata(self, key, entry):
+        path = self.metadata_path(self.encode_url(key))
+        with open(self.temp_path(path), 'wb') as metadata_file:
+            self.update_metadata(
+                metadata_file,
+                {
+                    'expiration_date': entry.expiration,
+                    'url': key,
+                    'hits': entry.hits,
+                    'size': entry.size,
+                    'head': entry.head,
+                },
+            )
+        os.rename(self.temp_path(path), path)
 
     ## Updates (rewrites) the metadata file
     # @param fd (file).
@@ -71,223 +557,512 @@ class Cache():
         fd.truncate(0)
         fd.seek(0, 0)
         for key in data.keys():
-            fd.write('%s:%s\r\n' % (key, data[key]))
+            if key != 'head':
+                fd.write('%s:%s\r\n' % (key, data[key]))
+        fd.write('\r\n%s' % data.get('head', ''))
 
     ## Checks if response should be cached or not.
-    # Based on headers from the HTTP response.
-    # @param headers (dict) response headers.
-    #
-    def check_headers(self, headers):
-        if 'Cache-Control' in headers:
-            cache_header = headers['Cache-Control']
-            parsed_header = self.parse_cache_header(cache_header)
-            if 'max-age' in parsed_header:
-                if int(parsed_header['max-age']) > 0:
-                    return int(parsed_header['max-age'])
-        return False
-
-    ## Checks whether file should be cached or not.
+    # Based on status and headers from the HTTP response, and on the request.
+    # @param headers (Headers) response headers.
+    # @param status (str) status code.
+    # @param method (str) request method.
+    # @param request_headers (Headers) request headers, None if not known.
+    # @returns (int) seconds response is fresh, False if it is not cached.
+    #
+    def check_headers(
+        self,
+        headers,
+        status='200',
+        method='GET',
+        request_headers=None,
+    ):
+        seconds = freshness.lifetime(
+            status,
+            headers,
+            time.time(),
+            method,
+            request_headers,
+        )
+        if seconds is None:
+            return False
+        return seconds
+
+    ## Checks whether response is cached and not expired.
+    # Only GET is served from cache. Request of other unsafe methods
+    # invalidates the entry of its url.
+    # When workers share the cache, entry that is not indexed is looked up
+    # on disk, as another worker may have filled it.
+    # Expired entry that is still of use is put in the request context as
+    # stale entry, and is sent if it may be while revalidated. Otherwise it
+    # is deleted.
     # @param request_context (dict).
-    # @returns (bool) whether file should be cached or not.
+    # @returns (bool) whether response is sent from cache.
     #
     def check_if_cache(self, request_context):
-        if request_context['method'] == 'CONNECT':
+        key = request_context['cache_key'] = self.cache_key(request_context)
+        method = request_context['method']
+        if method != 'GET':
+            if method not in constants.SAFE_METHODS:
+                for url in set((key, request_context['uri'])):
+                    self.delete_cache(url)
             return False
-        try:
-            try:
-                os.mkdir('%s/cache' % os.getcwd())
-            except OSError as e:
-                pass
+        if key in self._filling:
+            return False
+        entry = self._index.get(key)
+        if entry is None:
+            if not self._shared:
+                return False
+            entry = self.load_entry(self.encode_url(key))
+            if entry is None:
+                return False
+        now = time.time()
+        if entry.expiration < now:
+            if entry.sweep_date < now:
+                self.delete_cache(key)
+                return False
+            request_context['stale_entry'] = entry
+            if entry.stale_until('stale-while-revalidate') < now:
+                return False
+        return self.serve_entry(request_context, entry)
 
-            try:
-                os.mkdir('%s/cache/metadata' % os.getcwd())
-            except OSError as e:
-                pass
+    ## Serves request from cache entry.
+    # Conditional request that entry satisfies gets 304 response, otherwise
+    # response kept in memory is put in the request context, or a reader of
+    # cache file is.
+    # @param request_context (dict).
+    # @param entry (IndexEntry).
+    # @returns (bool) whether response is sent from cache.
+    #
+    def serve_entry(self, request_context, entry):
+        key = request_context['cache_key']
+        if self.not_modified(request_context, entry):
+            self._index.hit(key, entry)
+            request_context['cached_response'] = [
+                self.not_modified_head(entry),
+            ]
+            return True
 
-            if self.check_if_exist(request_context):
-                self._opened_files[request_context['uri']] = open(
-                    '%s/%s/%s' % (
-                        os.getcwd(),
-                        constants.CACHING_PATH,
-                        self.encode_url(
-                            request_context['uri'],
-                        )
-                    ),
-                    'rb',
-                )
-                return True
-            return False
+        memory_entry = self._memory.get(key)
+        if memory_entry is not None:
+            self._index.hit(key, entry)
+            request_context['cached_response'] = [
+                memory_entry.head,
+                memory_entry.content,
+            ]
+            return True
 
+        try:
+            request_context['cache_reader'] = self.open_reader(key, entry)
+        except OSError as e:
+            # Entry was deleted by another worker.
+            self._logger.debug('Cache file of %s is gone: %s', key, e)
+            self._index.remove(key)
+            return False
+        if request_context['cache_reader'].size != entry.size:
+            # Entry is being replaced by another worker.
+            self._logger.debug('Cache file of %s was replaced', key)
+            self.close_reader(request_context)
+            self.unshare(key)
+            self._index.remove(key)
+            return False
+        self._index.hit(key, entry)
+        try:
+            self.promote(request_context)
         except Exception as e:
             traceback.print_exc()
             self._logger.error('Error with cache file %s', e)
+        return True
+
+    ## Checks whether conditional request is satisfied by entry.
+    # If-None-Match takes precedence over If-Modified-Since.
+    # @param request_context (dict).
+    # @param entry (IndexEntry).
+    # @returns (bool) whether 304 response is sent.
+    #
+    def not_modified(self, request_context, entry):
+        headers = request_context['headers']
+        if 'If-None-Match' in headers:
+            return util.etag_matches(
+                headers['If-None-Match'],
+                entry.headers.get('ETag'),
+            )
+        if 'If-Modified-Since' not in headers:
             return False
+        since = util.parse_http_date(headers['If-Modified-Since'])
+        modified = util.parse_http_date(
+            entry.headers.get('Last-Modified', ''),
+        )
+        return (
+            since is not None and
+            modified is not None and
+            modified <= since
+        )
 
-    ## Parsing Cache-Control header.
-    # @param cache_header (str) cache header.
-    # @returns (dict) parsed cache header.
+    ## Builds 304 response head of entry.
+    # @param entry (IndexEntry).
+    # @returns (str) head.
     #
-    def parse_cache_header(self, cache_header):
-        to_return = {}
-        for entry in cache_header.split(','):
-            splt = entry.split('=')
-            if len(splt) > 1:
-                to_return[splt[0]] = splt[1]
-            else:
-                to_return[entry] = None
-        return to_return
+    def not_modified_head(self, entry):
+        head = '%s 304 Not Modified\r\n' % constants.HTTP_SIGNATURE
+        for name in constants.NOT_MODIFIED_HEADERS:
+            value = entry.headers.get(name)
+            if value is not None:
+                head += '%s: %s\r\n' % (name, value)
+        return head + constants.CRLF
+
+    ## Refreshes stale entry with 304 response of its revalidation.
+    # Headers of the 304 response replace the stored ones, and the entry
+    # gets a new expiration date.
+    # @param request_context (dict).
+    # @param headers (Headers) headers of 304 response.
+    # @returns (IndexEntry) refreshed entry, None if entry is gone.
+    #
+    def refresh(self, request_context, headers):
+        key = request_context['cache_key']
+        stale = request_context['stale_entry']
+        if self._index.get(key) is not stale:
+            return None
+        stored = http_parser.Headers(stale.headers.items())
+        skip = util.hop_by_hop_headers(headers)
+        skip.update(('content-length', 'transfer-encoding'))
+        for name in set(name for name, value in headers.items()):
+            if name.lower() not in skip:
+                stored.remove(name)
+                for value in headers.get_all(name):
+                    stored.add(name, value)
+        status_line = stale.head.split('\r\n', 1)[0]
+        head = status_line + '\r\n'
+        for name, value in stored.items():
+            head += '%s: %s\r\n' % (name, value)
+        head += constants.CRLF
+        seconds = self.check_headers(stored, status_line.split(' ')[1])
+        entry = cache_index.IndexEntry(
+            int(time.time()) + (seconds or 0),
+            stale.size,
+            stale.hits,
+            head,
+            stale.location,
+        )
+        try:
+            if entry.location is None:
+                self.write_metadata(key, entry)
+        except IOError as e:
+            self._logger.error('Error refreshing cache of %s %s', key, e)
+            self.delete_cache(key)
+            return None
+        self._index.add(key, entry)
+        memory_entry = self._memory.remove(key)
+        if memory_entry is not None:
+            self._memory.put(
+                key,
+                memory_cache.MemoryEntry(head, memory_entry.content),
+            )
+        return entry
 
     ## Loads response from cache.
-    # Reades from relevent cache file and return requested number of bytes.
+    # Reads from reader of request and returns requested number of bytes,
+    # reader is closed at end of file.
+    # Response kept in memory is returned as is.
     # @param request_context (dict).
     # @param to_send_len (int) length of socket-object to_send.
     # @returns part of the cached response (str).
     #
     def load_response(self, request_context, to_send_len):
+        if request_context.get('cached_response') is not None:
+            if request_context['cached_response']:
+                return request_context['cached_response'].pop(0)
+            return ''
+        reader = request_context.get('cache_reader')
+        if reader is None or to_send_len >= constants.TO_SEND_MAXSIZE:
+            return ''
         try:
-            read = ''
-            if (
-                request_context['uri'] in self._opened_files and
-                to_send_len < constants.TO_SEND_MAXSIZE
-            ):
-                read = self._opened_files[request_context['uri']].read(
-                    constants.TO_SEND_MAXSIZE - to_send_len
-                )
-                if not read:
-                    self._opened_files[request_context['uri']].close()
-                    del self._opened_files[request_context['uri']]
+            read = reader.read(constants.TO_SEND_MAXSIZE - to_send_len)
+            if not read:
+                self.close_reader(request_context)
             return read
 
         except Exception as e:
             self._logger.error('Error with cache file %s', e)
             traceback.print_exc()
 
+    ## Checks whether response is sent from cache file with sendfile.
+    # Content then goes from file to socket inside the kernel.
+    # @param request_context (dict).
+    # @returns (bool)
+    #
+    def sends_file(self, request_context):
+        return (
+            zero_copy.sendfile is not None and
+            request_context.get('cache_reader') is not None
+        )
+
+    ## Takes head of response sent from cache file.
+    # @param request_context (dict).
+    # @returns (str) head, empty if already taken.
+    #
+    def load_head(self, request_context):
+        return request_context['cache_reader'].take_head()
+
+    ## Sends next part of content from cache file to socket.
+    # Reader is closed at end of file.
+    # @param request_context (dict).
+    # @param fd (int) socket descriptor.
+    # @returns (int) bytes sent, 0 at end.
+    #
+    def send_content(self, request_context, fd):
+        sent = request_context['cache_reader'].send(
+            fd,
+            constants.SENDFILE_BLOCK_SIZE,
+        )
+        if not sent:
+            self.close_reader(request_context)
+        return sent
+
     ## Creates files for new cache storage.
+    # Content is written to a temporary file until the entry is complete.
     # @param request_context (dict).
     # @param exp - time to expire in seconds (int).
+    # @param vary (tuple) names of request headers response varies on.
+    # @param length (int) expected content length, None if unknown.
+    # @returns (bool) whether caller fills the entry, False if entry is
+    # already being filled or files cannot be created.
     #
-    def create_files(self, request_context, exp):
+    def create_files(self, request_context, exp, vary=(), length=None):
+        if vary:
+            self._vary[request_context['uri']] = vary
+        else:
+            self._vary.pop(request_context['uri'], None)
+        key = request_context['cache_key'] = self.cache_key(request_context)
+        if key in self._filling:
+            return False
         try:
-            self._opened_files[request_context['uri']] = open(
-                '%s/%s/%s' % (
-                    os.getcwd(),
-                    constants.CACHING_PATH,
-                    self.encode_url(
-                        request_context['uri'],
-                    ),
-                ),
-                'wb',
-            )
-            metadata_file = open(
-                '%s/%s/metadata/%s' % (
-                    os.getcwd(),
-                    constants.CACHING_PATH,
-                    self.encode_url(
-                        request_context['uri'],
-                    ),
-                ),
-                'wb',
-            )
-            metadata_file.write(
-                'expiration_date:%s\r\n'
-                'url:%s\r\n'
-                'hits:0\r\n' % (
-                    int(time.time()) + exp,
-                    request_context['uri'],
-                )
-            )
-            metadata_file.close()
+            path = self.content_path(self.encode_url(key))
+            self._opened_files[key] = open(self.temp_path(path), 'wb')
+            self._filling[key] = (int(time.time()) + exp, length)
+            self._fill_content[key] = []
+            return True
 
         except Exception as e:
             self._logger.error('Error creating files %s', e)
             traceback.print_exc()
+            return False
 
-    ## Writes data to opend cache file.
+    ## Writes content to opend cache file.
+    # Entry is dropped if content cannot be written.
     # @param request_context (dict).
-    # @param to_add (str) text to written to file.
+    # @param to_add (str) content to written to file.
     #
     def add_cache(self, request_context, to_add):
-        if request_context['uri'] in self._opened_files:
-            self._opened_files[request_context['uri']].write(to_add)
+        key = request_context['cache_key']
+        if key in self._filling:
+            try:
+                self._opened_files[key].write(to_add)
+            except IOError as e:
+                self._logger.error('Error writing cache of %s %s', key, e)
+                self.abort_cache(request_context)
+                return
+            content = self._fill_content.get(key)
+            if content is not None:
+                if self._opened_files[key].tell() > self._memory_object_size:
+                    del self._fill_content[key]
+                else:
+                    content.append(to_add)
 
-    ## Get all cached responses.
-    # @returns (dict) dict with all urls cached, their expiration date & hits.
+    ## Completes cache entry, once all content was written.
+    # Content is checked against the expected length and the size of the
+    # written file, then renamed over the cache file, or appended to a segment
+    # if it is small enough. Readers of previous entry keep reading the old
+    # one. Entry is published in the index last.
+    # @param request_context (dict).
+    # @param head (str) status line and headers, without Content-Length and
+    # without the empty line.
     #
-    def get_cached(self):
+    def finish_cache(self, request_context, head):
+        key = request_context['cache_key']
+        if key not in self._filling:
+            return
         try:
-            os.mkdir('%s/cache' % os.getcwd())
-        except OSError:
-            pass
-
-        to_return = {}
-        for fn in os.listdir('%s/cache' % os.getcwd()):
+            content_file = self._opened_files[key]
+            content_file.flush()
+            length = content_file.tell()
+            expiration, expected = self._filling[key]
             if (
-                os.path.isfile('%s/cache/%s' % (os.getcwd(), fn)) and
-                not fn.startswith('.')
+                (expected is not None and length != expected) or
+                os.fstat(content_file.fileno()).st_size != length
             ):
-                metadata_file = open(
-                    '%s/%s/metadata/%s' % (
-                        os.getcwd(),
-                        constants.CACHING_PATH,
-                        fn,
-                    ),
-                    'rb',
+                raise RuntimeError(
+                    'Cache file of %s is %s bytes, expected %s' % (
+                        key,
+                        length,
+                        expected,
+                    )
                 )
-                parsed_metadata = self.parse_metadata(metadata_file)
-                exp_date = parsed_metadata['expiration_date']
-                uri = parsed_metadata['url']
-                hits = parsed_metadata['hits']
-                metadata_file.close()
-                to_return[uri] = [
-                    datetime.datetime.fromtimestamp(
-                        float(exp_date),
-                    ).strftime('%c'),
-                    hits,
-                ]
+            content_file.close()
+            del self._opened_files[key]
+            del self._filling[key]
+            head = '%sContent-Length: %s\r\n\r\n' % (head, length)
+            content = self._fill_content.pop(key, None)
+            if content is not None:
+                content = ''.join(content)
+            old = self._index.get(key)
+            if (
+                self._store is not None and
+                length <= constants.SEGMENT_OBJECT_SIZE
+            ):
+                data = content
+                if data is None:
+                    with open(content_file.name, 'rb') as f:
+                        data = f.read()
+                entry = cache_index.IndexEntry(
+                    expiration,
+                    length,
+                    0,
+                    head,
+                    self._store.append(key, head, data, expiration),
+                )
+                os.remove(content_file.name)
+                if old is not None and old.location is None:
+                    self.remove_files(self.encode_url(key))
+            else:
+                os.rename(
+                    content_file.name,
+                    self.content_path(self.encode_url(key)),
+                )
+                entry = cache_index.IndexEntry(expiration, length, 0, head)
+                self.write_metadata(key, entry)
+            if old is not None and old.location is not None:
+                self._store.remove(old.location)
+            self.unshare(key)
+            self._index.add(key, entry)
+            self.schedule_eviction()
+            if content is not None:
+                self._memory.put(key, memory_cache.MemoryEntry(head, content))
+
+        except Exception as e:
+            self._logger.error('Error completing cache file %s', e)
+            traceback.print_exc()
+            if key in self._filling:
+                self.abort_cache(request_context)
+            else:
+                # Files may no longer match each other.
+                self.delete_cache(key)
+                try:
+                    os.remove(content_file.name)
+                except OSError:
+                    pass
+
+    ## Opens cache fill file, to read content written so far.
+    # Descriptor is owned by the caller, it stays valid once the file was
+    # renamed or removed.
+    # @param request_context (dict).
+    # @returns (int) descriptor, None if entry is not being filled.
+    #
+    def open_filling(self, request_context):
+        content_file = self._opened_files.get(request_context['cache_key'])
+        if content_file is None:
+            return None
+        content_file.flush()
+        try:
+            return os.open(content_file.name, os.O_RDONLY)
+        except OSError as e:
+            self._logger.error('Error opening cache file %s', e)
+            return None
+
+    ## Writes buffered content of cache fill file.
+    # @param request_context (dict).
+    #
+    def flush_filling(self, request_context):
+        content_file = self._opened_files.get(request_context['cache_key'])
+        if content_file is not None:
+            content_file.flush()
+
+    ## Drops cache entry that could not be completed.
+    # Its temporary file is removed.
+    # @param request_context (dict).
+    #
+    def abort_cache(self, request_context):
+        key = request_context['cache_key']
+        self._fill_content.pop(key, None)
+        if key not in self._filling:
+            return
+        del self._filling[key]
+        content_file = self._opened_files.pop(key, None)
+        if content_file is not None:
+            content_file.close()
+            try:
+                os.remove(content_file.name)
+            except OSError:
+                pass
+
+    ## Get all cached responses.
+    # Expired entries that were not swept yet are left out.
+    # @returns (dict) dict with all urls cached, their expiration date & hits.
+    #
+    def get_cached(self):
+        to_return = {}
+        now = time.time()
+        for uri, entry in self._index.items():
+            if entry.expiration < now:
+                continue
+            to_return[uri] = [
+                datetime.datetime.fromtimestamp(
+                    float(entry.expiration),
+                ).strftime('%c'),
+                entry.hits,
+            ]
         return to_return
 
-    ## Deletes cache file.
+    ## Deletes cache file or segment record.
     # @param url (str) a url whose response will be deleted.
     #
     def delete_cache(self, url):
-        url = self.encode_url(url)
-        os.remove('%s/cache/%s' % (os.getcwd(), url))
-        os.remove('%s/cache/metadata/%s' % (os.getcwd(), url))
+        entry = self._index.remove(url)
+        self._memory.remove(url)
+        self.unshare(url)
+        if entry is not None and entry.location is not None:
+            try:
+                self._store.delete(url, entry.location)
+            except (IOError, OSError) as e:
+                self._logger.error('Error deleting cache of %s %s', url, e)
+        else:
+            self.remove_files(self.encode_url(url))
 
     ## Delets all cached files.
     #
     def delete_all_cache(self):
-        for key in os.listdir('%s/cache' % os.getcwd()):
-            if (
-                os.path.isfile('%s/cache/%s' % (os.getcwd(), key)) and
-                not key.startswith('.')
-            ):
-                metadata_file = open(
-                    '%s/%s/metadata/%s' % (
-                        os.getcwd(),
-                        constants.CACHING_PATH,
-                        key,
-                    ),
-                    'rb',
-                )
-                parsed_metadata = self.parse_metadata(metadata_file)
-                uri = parsed_metadata['url']
-                metadata_file.close()
-                fn = self.encode_url(uri)
-                os.remove('%s/cache/%s' % (os.getcwd(), fn))
-                os.remove('%s/cache/metadata/%s' % (os.getcwd(), fn))
+        self._index.clear()
+        self._memory.clear()
+        self._shared_files.clear()
+        self._vary.clear()
+        if self._store is not None:
+            self._store.clear()
+        for name in os.listdir(self.metadata_path('')):
+            self.remove_files(name)
+
+    ## Removes cache and metadata files of an entry.
+    # Files may be already removed by another worker.
+    # @param name (str) encoded url.
+    #
+    def remove_files(self, name):
+        for path in (self.content_path(name), self.metadata_path(name)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
     ## Parse metadata file content.
     # @param fd (file) metadata file to be parsed.
+    # @returns (dict) metadata, response head is under 'head' key.
     #
     def parse_metadata(self, fd):
         to_return = {}
-        read = fd.read(constants.BLOCK_SIZE)
+        read = fd.read()
         line, read = util.read_line(read)
         while line:
             splt = line.split(':', 1)
             to_return[splt[0]] = splt[1]
             line, read = util.read_line(read)
+        to_return['head'] = read
         return to_return
 
     ## Encode url to sha1 encoding.
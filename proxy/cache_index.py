@@ -0,0 +1,253 @@
+## @package proxy.cache_index
+# Module for CacheIndex object.
+## @file cache_index.py
+# Implementation of @ref proxy.cache_index
+#
+
+import constants
+import freshness
+import heapq
+import http_parser
+import os
+import pickle
+
+
+## Index entry of a cached response.
+#
+class IndexEntry(object):
+    ## Constructor.
+    # @param expiration (int) expiration date.
+    # @param size (int) content length.
+    # @param hits (int) number of hits.
+    # @param head (str) status line and headers, with the empty line.
+    # @param location (tuple) location of record in segment store, None if
+    # entry is stored in files.
+    #
+    def __init__(self, expiration, size, hits, head, location=None):
+        self.expiration = expiration
+        self.size = size
+        self.hits = hits
+        self.head = head
+        self.location = location
+        # Headers parsed from head, on first use.
+        self._headers = None
+
+    ## Bytes taken by entry on disk, content and head.
+    @property
+    def disk_size(self):
+        return self.size + len(self.head)
+
+    ## Response headers.
+    @property
+    def headers(self):
+        if self._headers is None:
+            parser = http_parser.HeadParser()
+            try:
+                parser.feed(self.head)
+            except http_parser.ParseError:
+                pass
+            self._headers = parser.headers
+        return self._headers
+
+    ## Whether entry can be revalidated with the destination server.
+    @property
+    def has_validators(self):
+        return 'ETag' in self.headers or 'Last-Modified' in self.headers
+
+    ## Returns until when expired entry may still be used.
+    # @param directive (str) stale-while-revalidate or stale-if-error.
+    # @returns (int) date.
+    #
+    def stale_until(self, directive):
+        return self.expiration + freshness.stale_time(self.headers, directive)
+
+    ## Date after which entry is of no use.
+    # Expired entry that can be revalidated or served stale is kept a while
+    # longer.
+    @property
+    def sweep_date(self):
+        date = max(
+            self.stale_until('stale-while-revalidate'),
+            self.stale_until('stale-if-error'),
+        )
+        if self.has_validators:
+            date = max(date, self.expiration + constants.CACHE_STALE_TIME)
+        return date
+
+
+## In-memory index of the cache.
+#
+# Created by Cache.
+# Maps url to IndexEntry, so cache lookups and hit counting do not touch
+# the disk. Index is persisted as a whole into a snapshot file, which is
+# replaced atomically, and loaded from it at startup.
+# Total size of entries is kept, and entries are passed to an eviction
+# policy that picks victims when cache is over quota.
+# Entries are also kept in a heap by sweep date, so entries that are of no
+# use are found without a scan. Replaced and removed entries leave stale heap
+# items, which are skipped.
+#
+class CacheIndex(object):
+    ## Constructor.
+    # @param policy (EvictionPolicy) eviction policy.
+    #
+    def __init__(self, policy):
+        # url -> IndexEntry
+        self._entries = {}
+        # (sweep date, url) heap
+        self._expiry = []
+        self._policy = policy
+        # Whether index changed since last snapshot.
+        self.dirty = False
+        # Bytes taken by all entries on disk.
+        self.size = 0
+        # Position of segment store saved with snapshot, None if there is
+        # none.
+        self.mark = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, url):
+        return url in self._entries
+
+    ## Returns entry of url.
+    # @param url (str)
+    # @returns (IndexEntry) entry, None if url is not indexed.
+    #
+    def get(self, url):
+        return self._entries.get(url)
+
+    ## Adds or replaces entry of url.
+    # @param url (str)
+    # @param entry (IndexEntry)
+    #
+    def add(self, url, entry):
+        old = self._entries.get(url)
+        if old is not None:
+            self.size -= old.disk_size
+        self._entries[url] = entry
+        self.size += entry.disk_size
+        self._policy.add(url, entry)
+        heapq.heappush(self._expiry, (entry.sweep_date, url))
+        if len(self._expiry) > 2 * len(self._entries) + 64:
+            self._expiry = [
+                (entry.sweep_date, url)
+                for url, entry in self._entries.items()
+            ]
+            heapq.heapify(self._expiry)
+        self.dirty = True
+
+    ## Counts a hit of entry.
+    # @param url (str)
+    # @param entry (IndexEntry)
+    #
+    def hit(self, url, entry):
+        entry.hits += 1
+        self._policy.hit(url, entry)
+        self.dirty = True
+
+    ## Removes entry of url.
+    # @param url (str)
+    # @returns (IndexEntry) removed entry, None if url was not indexed.
+    #
+    def remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry.disk_size
+            self._policy.remove(url)
+            self.dirty = True
+        return entry
+
+    ## Removes all entries.
+    #
+    def clear(self):
+        self._entries.clear()
+        self._expiry = []
+        self._policy.clear()
+        self.size = 0
+        self.dirty = True
+
+    ## Returns url of entry to evict, by eviction policy.
+    # Entry stays in index until removed.
+    # @returns (str) url, None if index is empty.
+    #
+    def victim(self):
+        return self._policy.victim()
+
+    ## Returns earliest sweep date.
+    # @returns (int) sweep date, None if index is empty.
+    #
+    def next_sweep(self):
+        while self._expiry:
+            date, url = self._expiry[0]
+            entry = self._entries.get(url)
+            if entry is not None and entry.sweep_date == date:
+                return date
+            heapq.heappop(self._expiry)
+        return None
+
+    ## Returns url of an entry whose sweep date passed.
+    # Entry stays in index until removed.
+    # @param now (float) current time.
+    # @returns (str) url, None if there is no such entry.
+    #
+    def pop_sweepable(self, now):
+        date = self.next_sweep()
+        if date is None or date >= now:
+            return None
+        return heapq.heappop(self._expiry)[1]
+
+    ## Returns all entries.
+    # @returns (list) (url, IndexEntry) tuples.
+    #
+    def items(self):
+        return self._entries.items()
+
+    ## Loads index from snapshot file.
+    # @param path (str) snapshot file.
+    # @returns (bool) whether snapshot was loaded.
+    #
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+        if isinstance(snapshot, tuple):
+            snapshot, self.mark = snapshot
+        for url, fields in snapshot.items():
+            self.add(url, IndexEntry(*fields))
+        self.dirty = False
+        return True
+
+    ## Writes index to snapshot file.
+    # File is written aside and renamed over the previous snapshot, so a
+    # reader never sees a partial file.
+    # @param path (str) snapshot file.
+    #
+    def save(self, path):
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(
+                (
+                    dict(
+                        (
+                            url,
+                            (
+                                entry.expiration,
+                                entry.size,
+                                entry.hits,
+                                entry.head,
+                                entry.location,
+                            ),
+                        )
+                        for url, entry in self._entries.items()
+                    ),
+                    self.mark,
+                ),
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        os.rename(tmp, path)
+        self.dirty = False
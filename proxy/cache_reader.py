@@ -0,0 +1,122 @@
+## @package proxy.cache_reader
+# Module for SharedFile, CacheReader objects.
+## @file cache_reader.py
+# Implementation of @ref proxy.cache_reader
+#
+
+import os
+import util
+import zero_copy
+
+
+## Cache file opened once for all its readers.
+#
+# Created by Cache on the first hit of an entry read from disk, and closed
+# once its last reader is done.
+#
+class SharedFile(object):
+    ## Constructor.
+    # @param path (str) cache file.
+    # @param flags (int) open flags.
+    #
+    def __init__(self, path, flags=os.O_RDONLY):
+        self.fd = os.open(path, flags, 0o644)
+        # Files are never changed once filled.
+        self.size = os.fstat(self.fd).st_size
+        # Number of readers.
+        self.refs = 0
+
+    ## Whether file was closed.
+    @property
+    def closed(self):
+        return self.fd == -1
+
+    ## Adds a reader.
+    #
+    def acquire(self):
+        self.refs += 1
+
+    ## Removes a reader, file is closed after the last one.
+    #
+    def release(self):
+        self.refs -= 1
+        if not self.refs:
+            os.close(self.fd)
+            self.fd = -1
+
+
+## Read cursor of a single connection over a cached entry.
+#
+# Created by Cache, kept in the request context. Reads are positional, so
+# any number of readers can stream the same shared file at once. Content may
+# be a part of the file, starting at base.
+# Where sendfile is available, content is sent from file to socket without
+# being read into user space, only the head is read.
+#
+class CacheReader(object):
+    ## Constructor.
+    # @param uri (str) url of entry.
+    # @param shared (SharedFile) cache file.
+    # @param head (str) response head, sent before the content.
+    # @param base (int) file offset of content.
+    # @param size (int) content length, None for rest of file.
+    #
+    def __init__(self, uri, shared, head, base=0, size=None):
+        self.uri = uri
+        self.shared = shared
+        self.head = head
+        self.base = base
+        self.size = shared.size - base if size is None else size
+        self.offset = 0
+        shared.acquire()
+
+    ## Reads next part of response.
+    # @param size (int) max bytes of content to read.
+    # @returns (str) head if not read yet and content, empty at end.
+    #
+    def read(self, size):
+        size = min(size, self.size - self.offset)
+        data = ''
+        if size > 0:
+            data = util.pread(self.shared.fd, size, self.base + self.offset)
+        self.offset += len(data)
+        if self.head:
+            data, self.head = self.head + data, ''
+        return data
+
+    ## Takes head that was not read yet.
+    # @returns (str) head, empty if already taken.
+    #
+    def take_head(self):
+        head, self.head = self.head, ''
+        return head
+
+    ## Sends next part of content to socket.
+    # @param fd (int) socket descriptor.
+    # @param size (int) max bytes to send.
+    # @returns (int) bytes sent, 0 at end.
+    #
+    def send(self, fd, size):
+        size = min(size, self.size - self.offset)
+        if size <= 0:
+            return 0
+        sent = zero_copy.sendfile(
+            fd,
+            self.shared.fd,
+            self.base + self.offset,
+            size,
+        )
+        self.offset += sent
+        return sent
+
+    ## Reads all content from start.
+    # @param size (int) content length.
+    # @returns (str) content.
+    #
+    def read_all(self, size):
+        return util.pread(self.shared.fd, size, self.base)
+
+    ## Releases the shared file.
+    #
+    def close(self):
+        self.shared.release()
@@ -0,0 +1,115 @@
+## @package proxy.chunked
+# Module for chunked transfer coding.
+## @file chunked.py
+# Implementation of @ref proxy.chunked
+#
+
+import constants
+import re
+
+## States of chunked decoder
+(
+    SIZE_STATE,
+    DATA_STATE,
+    DATA_END_STATE,
+    TRAILER_STATE,
+    DONE_STATE,
+) = range(5)
+
+## Last chunk, ends a chunked body without trailers.
+LAST_CHUNK = '0%s%s' % (constants.CRLF, constants.CRLF)
+## Chunk size token, int() alone would take sign, spaces and 0x prefix.
+CHUNK_SIZE = re.compile(r'[0-9A-Fa-f]+\Z')
+
+
+## Encodes data as a single chunk.
+# Parts are returned separately, so data itself is not copied.
+# @param data (str) chunk data.
+# @returns (list) parts of chunk, empty if there is no data.
+#
+def encode_chunk(data):
+    if not data:
+        return []
+    return ['%x%s' % (len(data), constants.CRLF), data, constants.CRLF]
+
+
+## Checks whether message body uses chunked transfer coding.
+# @param headers (Headers) message headers.
+# @returns (bool)
+#
+def is_chunked(headers):
+    codings = headers.get('Transfer-Encoding', '').split(',')
+    return codings[-1].strip().lower() == 'chunked'
+
+
+## Incremental decoder of chunked body.
+#
+# Data is fed as it is received, in pieces of any size. Only a partial
+# size or trailer line is kept between calls, chunk data is returned right
+# away, so memory does not depend on body or chunk size.
+# Chunk extensions and trailers are ignored.
+#
+class ChunkedDecoder(object):
+    ## Constructor.
+    # @param max_line (int) max length of chunk size or trailer line.
+    #
+    def __init__(self, max_line=constants.MAX_HEADER_LENGTH):
+        self._state = SIZE_STATE
+        self._left = 0
+        self._line = ''
+        self._max_line = max_line
+
+    ## Whether whole body was decoded.
+    @property
+    def done(self):
+        return self._state == DONE_STATE
+
+    ## Decodes next piece of body.
+    # Stops at end of body, data after it belongs to next message.
+    # @param data (str) received data.
+    # @returns (tuple) decoded data (str), number of bytes of data consumed.
+    #
+    def decode(self, data):
+        decoded = []
+        pos = 0
+        while pos < len(data) and self._state != DONE_STATE:
+            if self._state == DATA_STATE:
+                n = min(self._left, len(data) - pos)
+                decoded.append(data[pos:pos + n])
+                pos += n
+                self._left -= n
+                if not self._left:
+                    self._state = DATA_END_STATE
+                continue
+
+            end = data.find('\n', pos)
+            if end == -1:
+                self._line += data[pos:]
+                pos = len(data)
+                if len(self._line) > self._max_line:
+                    raise ValueError('Chunk line too long')
+                break
+            line = (self._line + data[pos:end]).rstrip('\r')
+            self._line = ''
+            pos = end + 1
+            if len(line) > self._max_line:
+                raise ValueError('Chunk line too long')
+
+            if self._state == SIZE_STATE:
+                size = line.split(';', 1)[0].rstrip(' \t')
+                if not CHUNK_SIZE.match(size):
+                    raise ValueError('Invalid chunk size')
+                size = int(size, 16)
+                if size:
+                    self._left = size
+                    self._state = DATA_STATE
+                else:
+                    self._state = TRAILER_STATE
+            elif self._state == DATA_END_STATE:
+                if line:
+                    raise ValueError('Missing chunk terminator')
+                self._state = SIZE_STATE
+            elif not line:
+                self._state = DONE_STATE
+
+        return ''.join(decoded), pos
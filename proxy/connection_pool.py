@@ -0,0 +1,147 @@
+## @package proxy.connection_pool
+# Module for ConnectionPool object.
+## @file connection_pool.py
+# Implementation of @ref proxy.connection_pool
+#
+
+import collections
+import constants
+import errno
+import functools
+import socket
+
+
+## Pool of idle upstream connections.
+#
+# Created by __main__, one per worker.
+# ProxyClientSocket returns its socket here once a response was fully
+# received and the server agreed to keep the connection, and checks a socket
+# out before connecting to the same origin again.
+# Idle sockets are not polled, they are closed when idle for too long, when
+# a cap is reached, or when found dead on checkout.
+#
+class ConnectionPool(object):
+    ## Constructor.
+    # @param poll (Poller) poll object, used for idle expiry.
+    # @param logger (logging.Logger)
+    # @param max_per_origin (int) max idle connections to a single origin.
+    # @param max_total (int) max idle connections.
+    # @param idle_timeout (float) seconds an idle connection is kept.
+    #
+    def __init__(
+        self,
+        poll,
+        logger,
+        max_per_origin=constants.POOL_MAX_PER_ORIGIN,
+        max_total=constants.POOL_MAX_CONNECTIONS,
+        idle_timeout=constants.POOL_IDLE_TIMEOUT,
+    ):
+        self._poll = poll
+        self._logger = logger
+        self._max_per_origin = max_per_origin
+        self._max_total = max_total
+        self._idle_timeout = idle_timeout
+        # (host, port) -> list of sockets, most recently released last.
+        self._idle = {}
+        # socket -> ((host, port), expiry timer), least recently released
+        # first.
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    ## Checks whether an idle socket is still usable.
+    # A socket that became readable while idle was either closed by the
+    # server or has unexpected data, neither can be reused.
+    # @param s (socket)
+    # @returns (bool)
+    #
+    def is_alive(self, s):
+        try:
+            s.recv(1, socket.MSG_PEEK)
+        except socket.error as e:
+            return e.errno in (errno.EWOULDBLOCK, errno.EAGAIN)
+        return False
+
+    ## Takes an idle connection to origin out of the pool.
+    # @param key (tuple) host, port.
+    # @returns (socket) connected socket, None if there is none.
+    #
+    def checkout(self, key):
+        sockets = self._idle.get(key)
+        while sockets:
+            s = sockets.pop()
+            self.forget(s)
+            if self.is_alive(s):
+                self._logger.debug(
+                    'Reusing connection %s to %s:%s',
+                    s.fileno(),
+                    key[0],
+                    key[1],
+                )
+                return s
+            self._logger.debug('Pooled connection %s is dead', s.fileno())
+            s.close()
+        self._idle.pop(key, None)
+        return None
+
+    ## Returns a connection to the pool.
+    # @param key (tuple) host, port.
+    # @param s (socket) connected socket with no outstanding response.
+    #
+    def release(self, key, s):
+        if self._max_per_origin <= 0 or self._max_total <= 0:
+            s.close()
+            return
+
+        sockets = self._idle.setdefault(key, [])
+        if len(sockets) >= self._max_per_origin:
+            self.discard(key, sockets[0])
+        if len(self._entries) >= self._max_total:
+            oldest = next(iter(self._entries))
+            self.discard(self._entries[oldest][0], oldest)
+
+        sockets.append(s)
+        # discard() drops the list of an origin once it is empty.
+        self._idle[key] = sockets
+        self._entries[s] = (
+            key,
+            self._poll.arm_timer(
+                self._idle_timeout,
+                functools.partial(self.discard, key, s),
+            ),
+        )
+        self._logger.debug(
+            'Connection %s to %s:%s is idle',
+            s.fileno(),
+            key[0],
+            key[1],
+        )
+
+    ## Removes socket from pool bookkeeping and cancels its expiry.
+    # @param s (socket)
+    #
+    def forget(self, s):
+        key, timer = self._entries.pop(s)
+        self._poll.cancel_timer(timer)
+
+    ## Removes an idle connection from the pool and closes it.
+    # @param key (tuple) host, port.
+    # @param s (socket)
+    #
+    def discard(self, key, s):
+        if s not in self._entries:
+            return
+        self.forget(s)
+        sockets = self._idle[key]
+        sockets.remove(s)
+        if not sockets:
+            del self._idle[key]
+        self._logger.debug('Closing idle connection %s', s.fileno())
+        s.close()
+
+    ## Closes all idle connections.
+    #
+    def close_all(self):
+        for s, (key, timer) in list(self._entries.items()):
+            self.discard(key, s)
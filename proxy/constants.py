@@ -18,8 +18,8 @@ DEFAULT_PROXY_PORT = 8080
 DEFAULT_SERVER_PORT = 9090
 ## HTTP signature.
 HTTP_SIGNATURE = 'HTTP/1.1'
-## Max header length.
-MAX_HEADER_LENGTH = 4096
+## Max length of start line or header line.
+MAX_HEADER_LENGTH = 8192
 ## Max number of headers.
 MAX_NUMBER_OF_HEADERS = 100
 ## Mime mapping for HTTP protocol.
@@ -30,8 +30,150 @@ MIME_MAPPING = {
 }
 ## To-send buffer max length.
 TO_SEND_MAXSIZE = 16384
-## Max request length.
-MAX_REQ_SIZE = 1000
+## Max bytes moved by a single splice call.
+SPLICE_BLOCK_SIZE = 65536
+## Max bytes sent by a single sendfile call.
+SENDFILE_BLOCK_SIZE = 65536
+## Max number of chunks written by a single sendmsg call.
+SEND_BUFFER_IOV = 64
+## Max length of request or response head.
+MAX_HEAD_SIZE = 65536
+## Default seconds allowed for connecting to destination server.
+DEFAULT_CONNECT_TIMEOUT = 10
+## Default seconds allowed until request or response head is received.
+DEFAULT_FIRST_BYTE_TIMEOUT = 30
+## Default seconds a connection may stay without any activity.
+DEFAULT_IDLE_TIMEOUT = 120
+## Default seconds a connection may live, 0 for unlimited.
+DEFAULT_TOTAL_TIMEOUT = 0
+## Name server used when none is configured.
+DEFAULT_DNS_SERVER = '127.0.0.1'
+## DNS server port.
+DNS_PORT = 53
+## File holding system name servers.
+RESOLV_CONF_FILE = '/etc/resolv.conf'
+## Dots a name needs to be tried as is before search domains are appended.
+DNS_NDOTS = 1
+## File holding static host names.
+HOSTS_FILE = '/etc/hosts'
+## Seconds to wait for DNS response before resending query.
+DNS_TIMEOUT = 2
+## Number of times a DNS query is sent before giving up.
+DNS_TRIES = 3
+## Seconds to cache failed lookups when server did not say.
+DNS_NEGATIVE_TTL = 30
+## Max seconds to cache a DNS answer.
+DNS_MAX_TTL = 3600
+## Max number of cached DNS answers.
+DNS_CACHE_SIZE = 4096
+## Max DNS packet size.
+DNS_MAX_PACKET_SIZE = 4096
+## Max name compression pointers or aliases followed.
+DNS_MAX_POINTERS = 32
+## Max idle upstream connections kept per origin.
+POOL_MAX_PER_ORIGIN = 8
+## Max idle upstream connections kept.
+POOL_MAX_CONNECTIONS = 256
+## Seconds an idle upstream connection is kept.
+POOL_IDLE_TIMEOUT = 30
+## Headers that apply to a single connection and are not forwarded.
+HOP_BY_HOP_HEADERS = (
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'upgrade',
+)
+## Number of slots in timer wheel.
+TIMER_WHEEL_SLOTS = 512
+## Seconds per timer wheel tick.
+TIMER_WHEEL_RESOLUTION = 0.1
+## Seconds to wait before restarting a worker that died right after start.
+WORKER_RESTART_DELAY = 1
+## Default bytes of responses kept in memory, 0 disables memory cache.
+MEMORY_CACHE_SIZE = 16 * 1024 * 1024
+## Default max bytes of a single response kept in memory.
+MEMORY_CACHE_OBJECT_SIZE = 128 * 1024
+## Part of memory cache for responses that were hit more than once.
+MEMORY_CACHE_PROTECTED_RATIO = 0.8
+## Default seconds between cache index snapshots.
+CACHE_SNAPSHOT_INTERVAL = 10
+## Default max bytes of cache on disk, 0 for unlimited.
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+## Default max number of cache entries, 0 for unlimited.
+CACHE_MAX_ENTRIES = 100000
+## Default cache eviction policy.
+CACHE_EVICTION_POLICY = 'lru'
+## Max entries evicted in a single loop turn.
+CACHE_EVICTION_BATCH = 128
+## Seconds between sweeps of expired cache entries.
+CACHE_SWEEP_INTERVAL = 1
+## Max expired entries removed in a single loop turn.
+CACHE_SWEEP_BATCH = 128
+## Seconds an expired entry that can be revalidated is kept.
+CACHE_STALE_TIME = 24 * 60 * 60
+## Stored headers sent with a 304 response.
+NOT_MODIFIED_HEADERS = (
+    'Cache-Control',
+    'Content-Location',
+    'Date',
+    'ETag',
+    'Expires',
+    'Last-Modified',
+    'Vary',
+)
+## Request methods that do not change the resource, others invalidate its
+# cache entry.
+SAFE_METHODS = (
+    'CONNECT',
+    'GET',
+    'HEAD',
+    'OPTIONS',
+    'TRACE',
+)
+## Request headers of a conditional request.
+CONDITIONAL_HEADERS = (
+    'if-none-match',
+    'if-modified-since',
+)
+## Status codes of responses that are cached.
+CACHEABLE_STATUSES = (
+    '200',
+    '203',
+    '300',
+    '301',
+    '308',
+    '404',
+    '405',
+    '410',
+    '414',
+    '501',
+)
+## Fraction of time since Last-Modified a response without explicit
+# expiration is fresh.
+CACHE_HEURISTIC_FRACTION = 0.1
+## Max seconds of heuristic freshness.
+CACHE_HEURISTIC_MAX = 24 * 60 * 60
+## Cache index snapshot file, in cache directory.
+CACHE_INDEX_FILE = 'index'
+## Default cache store, files per entry or segments.
+CACHE_STORE = 'files'
+## Cache stores.
+CACHE_STORES = ('files', 'segments')
+## Directory of segment files, in cache directory.
+SEGMENTS_PATH = 'segments'
+## Bytes of a segment file after which a new one is started.
+SEGMENT_SIZE = 64 * 1024 * 1024
+## Max content bytes of entry stored in a segment, larger ones are files.
+SEGMENT_OBJECT_SIZE = 256 * 1024
+## Part of segment in use below which the segment is compacted.
+SEGMENT_COMPACT_RATIO = 0.5
+## Seconds between checks for segments to compact.
+SEGMENT_COMPACT_INTERVAL = 1
+## Max bytes copied by compaction in a single loop turn.
+SEGMENT_COMPACT_BYTES = 1024 * 1024
 ## Path for cache to be stored.
 CACHING_PATH = 'cache'
 ## Beggining of HTML table.
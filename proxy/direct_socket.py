@@ -7,10 +7,13 @@
 import constants
 import errno
 import fcntl
+import functools
 import os
 import pollable
 import select
+import send_buffer
 import socket
+import zero_copy
 
 
 ## DirectSocketUp for sending and receiving HTTPS requests and responses.
@@ -20,6 +23,12 @@ import socket
 # the DirectSocketDown object.
 #
 class DirectSocketUp(pollable.Pollable):
+    ## Deadlines armed by the poller.
+    timeouts = (
+        pollable.IDLE_TIMEOUT,
+        pollable.TOTAL_TIMEOUT,
+    )
+
     ## Constructor.
     # @param socket (socket)
     # @param address to connect to (str)
@@ -41,19 +50,20 @@ class DirectSocketUp(pollable.Pollable):
     ):
         self._http_socket = http_socket
         self._socket = socket
-        self._to_send = 'HTTP/1.1 200 Connection established\r\n\r\n'
+        self._to_send = send_buffer.SendBuffer()
         self._closing = False
+        # Pipe carrying data read from this socket to the peer socket.
+        self._pipe = zero_copy.create_pipe()
+        self._piped = 0
         self._application_context = application_context
         self._logger = logger
         self._peer = DirectSocketDown(
-            address,
-            port,
             self,
             application_context,
             logger,
         )
         poll.register(self)
-        poll.register(self._peer)
+        self._peer.resolve(poll, address, port)
 
     @property
     def socket(self):
@@ -83,6 +93,21 @@ class DirectSocketUp(pollable.Pollable):
         raise RuntimeError
         return None
 
+    ## Function to be called when a deadline expires.
+    # @param kind (int) deadline kind.
+    # @returns (DirectSocketUp) object to be removed from poll.
+    #
+    def on_timeout(self, kind):
+        self._logger.error(
+            'DirectSocketUp %s deadline %s expired',
+            self._socket.fileno(),
+            kind,
+        )
+        self.close_socket()
+        if self._peer:
+            self._peer._closing = True
+        return self
+
     ## Function to be called when poller have a POLLIN event.
     # DirectSocketUp is in the process of receving request from the source
     # server.
@@ -109,9 +134,9 @@ class DirectSocketUp(pollable.Pollable):
     #
     def on_write(self):
         try:
-            self._to_send = self.send_all()
+            self.send_all()
 
-            if not self._to_send and self._closing:
+            if not self.pending() and self._closing:
                 self.close_socket()
                 if self._peer:
                     self._peer._closing = True
@@ -136,15 +161,18 @@ class DirectSocketUp(pollable.Pollable):
     #
     def get_events(self):
         events = select.POLLERR
-        if len(self._peer._to_send) < constants.TO_SEND_MAXSIZE:
+        if self._peer.pending() < constants.TO_SEND_MAXSIZE:
             events |= select.POLLIN
-        if (
-            self._to_send and
-            len(self._peer._to_send) < constants.TO_SEND_MAXSIZE
-        ):
+        if self.pending():
             events |= select.POLLOUT
         return events
 
+    ## Returns number of bytes waiting to be sent to this socket.
+    # @returns (int) bytes in to_send buffer and in peer pipe.
+    #
+    def pending(self):
+        return len(self._to_send) + self._peer._piped
+
     # Receives string from socket and adds it to received buffer.
     # @param max_length (int) max header length.
     # @param blocksize (int) length of bytes to receive.
@@ -155,13 +183,23 @@ class DirectSocketUp(pollable.Pollable):
         block_size=constants.BLOCK_SIZE,
     ):
         try:
-            t = self._socket.recv(block_size)
-            if not t:
-                raise RuntimeError('Disconnect')
-            self._peer._to_send += t
-
-        except socket.error as e:
-            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+            if self._pipe:
+                t = zero_copy.splice(
+                    self._socket.fileno(),
+                    self._pipe[1],
+                    constants.SPLICE_BLOCK_SIZE,
+                )
+                if not t:
+                    raise RuntimeError('Disconnect')
+                self._piped += t
+            else:
+                t = self._socket.recv(block_size)
+                if not t:
+                    raise RuntimeError('Disconnect')
+                self._peer._to_send += t
+
+        except (socket.error, OSError) as e:
+            if not zero_copy.would_block(e):
                 self._logger.error(
                     'DirectSocketUp %s socket error: %s',
                     self._socket.fileno(),
@@ -169,21 +207,29 @@ class DirectSocketUp(pollable.Pollable):
                 )
                 raise
 
-    ## Sends everything possible from to_send buffer.
-    # @returns (str) string from buffer that couldn't be sent.
+    ## Sends everything possible from to_send buffer, then from peer pipe.
     #
     def send_all(self):
         try:
-            buf = self._to_send
-            while buf:
-                bytes_sent = self._socket.send(buf)
+            bytes_sent = self._to_send.send(self._socket)
+            self._application_context[
+                'statistics'
+            ]['throughput'][0] += bytes_sent
+            while not self._to_send and self._peer._piped:
+                bytes_sent = zero_copy.splice(
+                    self._peer._pipe[0],
+                    self._socket.fileno(),
+                    self._peer._piped,
+                )
+                if not bytes_sent:
+                    break
+                self._peer._piped -= bytes_sent
                 self._application_context[
                     'statistics'
                 ]['throughput'][0] += bytes_sent
-                buf = buf[bytes_sent:]
 
-        except socket.error as e:
-            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+        except (socket.error, OSError) as e:
+            if not zero_copy.would_block(e):
                 self._logger.error(
                     'DirectSocketUp %s socket error: %s',
                     self._socket.fileno(),
@@ -191,9 +237,8 @@ class DirectSocketUp(pollable.Pollable):
                 )
                 raise
 
-        return buf
-
     ## Closing socket.
+    # Peer pipe is drained only by this socket, so it is closed as well.
     #
     def close_socket(self):
         self._logger.debug(
@@ -201,6 +246,10 @@ class DirectSocketUp(pollable.Pollable):
             self._socket.fileno()
         )
         self._socket.close()
+        if self._peer and self._peer._pipe:
+            zero_copy.close_pipe(self._peer._pipe)
+            self._peer._pipe = None
+            self._peer._piped = 0
 
 
 ## DirectSocketDown for sending and receiving HTTP requests and responses.
@@ -209,18 +258,26 @@ class DirectSocketUp(pollable.Pollable):
 # Sends requests to the destination server and receives his response.
 #
 class DirectSocketDown(pollable.Pollable):
+    ## Deadlines armed by the poller.
+    timeouts = (
+        pollable.CONNECT_TIMEOUT,
+        pollable.IDLE_TIMEOUT,
+        pollable.TOTAL_TIMEOUT,
+    )
+
     ## Constructor.
-    # @param address to connect to (str)
-    # @param port (int)
     # @param peer (ProxySocket) ProxySocket object.
     # @param application_context (dict)
     # @param logger (logging.Logger)
     #
-    def __init__(self, address, port, peer, application_context, logger):
-        self._to_send = ''
+    def __init__(self, peer, application_context, logger):
+        self._to_send = send_buffer.SendBuffer()
         self._peer = peer
         self._bytes_sent = 0
         self._closing = False
+        # Pipe carrying data read from this socket to the peer socket.
+        self._pipe = zero_copy.create_pipe()
+        self._piped = 0
         self._application_context = application_context
         self._logger = logger
         self._socket = socket.socket(
@@ -232,6 +289,52 @@ class DirectSocketDown(pollable.Pollable):
             fcntl.F_SETFL, fcntl.fcntl(self._socket.fileno(), fcntl.F_GETFL) |
             os.O_NONBLOCK,
         )
+        self._logger.debug(
+            'DirectSocketDown %s created',
+            self._socket.fileno(),
+        )
+
+    ## Resolves destination address, connection is made once it is resolved.
+    # @param poll object (poll).
+    # @param host (str) destination host name.
+    # @param port (int) destination port.
+    #
+    def resolve(self, poll, host, port):
+        self._application_context['resolver'].resolve(
+            host,
+            functools.partial(self.connect, poll, host, port),
+        )
+
+    ## Connects to the destination server and registers to poll.
+    # Called by the resolver.
+    # @param poll object (poll).
+    # @param host (str) destination host name.
+    # @param port (int) destination port.
+    # @param address (str) resolved address, None if resolving failed.
+    #
+    def connect(self, poll, host, port, address):
+        if self._closing:
+            # Peer is already gone.
+            self.close_socket()
+            return
+
+        if address is None:
+            self._logger.error(
+                'DirectSocketDown %s cannot resolve %s',
+                self._socket.fileno(),
+                host,
+            )
+            self._peer._to_send = send_buffer.SendBuffer(
+                'HTTP/1.1 502 Bad Gateway\r\n\r\n',
+            )
+            self._peer._closing = True
+            poll.touch(self._peer)
+            self.close_socket()
+            return
+
+        self._peer._to_send = send_buffer.SendBuffer(
+            'HTTP/1.1 200 Connection established\r\n\r\n',
+        )
         try:
             self._socket.connect((address, port))
         except socket.error as e:
@@ -241,13 +344,11 @@ class DirectSocketDown(pollable.Pollable):
                     self._socket.fileno(),
                     e,
                 )
-                self._peer._to_send = 'HTTP/1.1 403 Forbidden\r\n\r\n'
-
-        self._peer._to_send = 'HTTP/1.1 200 Connection established\r\n\r\n'
-        self._logger.debug(
-            'DirectSocketDown %s created',
-            self._socket.fileno(),
-        )
+                self._peer._to_send = send_buffer.SendBuffer(
+                    'HTTP/1.1 403 Forbidden\r\n\r\n',
+                )
+        poll.register(self)
+        poll.touch(self._peer)
 
     @property
     def socket(self):
@@ -277,6 +378,21 @@ class DirectSocketDown(pollable.Pollable):
         raise RuntimeError
         return None
 
+    ## Function to be called when a deadline expires.
+    # @param kind (int) deadline kind.
+    # @returns (DirectSocketDown) object to be removed from poll.
+    #
+    def on_timeout(self, kind):
+        self._logger.error(
+            'DirectSocketDown %s deadline %s expired',
+            self._socket.fileno(),
+            kind,
+        )
+        self.close_socket()
+        if self._peer:
+            self._peer._closing = True
+        return self
+
     ## Function to be called when poller have a POLLIN event.
     # DirectSocketDown is in the process of receving response from the
     # destination server.
@@ -304,9 +420,9 @@ class DirectSocketDown(pollable.Pollable):
     #
     def on_write(self):
         try:
-            self._to_send = self.send_all()
+            self.send_all()
 
-            if not self._to_send and self._closing:
+            if not self.pending() and self._closing:
                 self.close_socket()
                 if self._peer:
                     self._peer._closing = True
@@ -331,15 +447,18 @@ class DirectSocketDown(pollable.Pollable):
     #
     def get_events(self):
         events = select.POLLERR
-        if len(self._peer._to_send) < constants.TO_SEND_MAXSIZE:
+        if self._peer.pending() < constants.TO_SEND_MAXSIZE:
             events |= select.POLLIN
-        if (
-            self._to_send and
-            len(self._peer._to_send) < constants.TO_SEND_MAXSIZE
-        ):
+        if self.pending():
             events |= select.POLLOUT
         return events
 
+    ## Returns number of bytes waiting to be sent to this socket.
+    # @returns (int) bytes in to_send buffer and in peer pipe.
+    #
+    def pending(self):
+        return len(self._to_send) + self._peer._piped
+
     # Receives string from socket and adds it to received buffer.
     # @param max_length (int) max header length.
     # @param blocksize (int) length of bytes to receive.
@@ -350,13 +469,23 @@ class DirectSocketDown(pollable.Pollable):
         block_size=constants.BLOCK_SIZE,
     ):
         try:
-            t = self._socket.recv(block_size)
-            if not t:
-                raise RuntimeError('Disconnect')
-            self._peer._to_send += t
-
-        except socket.error as e:
-            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+            if self._pipe:
+                t = zero_copy.splice(
+                    self._socket.fileno(),
+                    self._pipe[1],
+                    constants.SPLICE_BLOCK_SIZE,
+                )
+                if not t:
+                    raise RuntimeError('Disconnect')
+                self._piped += t
+            else:
+                t = self._socket.recv(block_size)
+                if not t:
+                    raise RuntimeError('Disconnect')
+                self._peer._to_send += t
+
+        except (socket.error, OSError) as e:
+            if not zero_copy.would_block(e):
                 self._logger.error(
                     'DirectSocketDown %s socket error: %s',
                     self._socket.fileno(),
@@ -364,21 +493,29 @@ class DirectSocketDown(pollable.Pollable):
                 )
                 raise RuntimeError('Disconnect')
 
-    ## Sends everything possible from to_send buffer.
-    # @returns (str) string from buffer that couldn't be sent.
+    ## Sends everything possible from to_send buffer, then from peer pipe.
     #
     def send_all(self):
         try:
-            buf = self._to_send
-            while buf:
-                bytes_sent = self._socket.send(buf)
+            bytes_sent = self._to_send.send(self._socket)
+            self._application_context[
+                'statistics'
+            ]['throughput'][0] += bytes_sent
+            while not self._to_send and self._peer._piped:
+                bytes_sent = zero_copy.splice(
+                    self._peer._pipe[0],
+                    self._socket.fileno(),
+                    self._peer._piped,
+                )
+                if not bytes_sent:
+                    break
+                self._peer._piped -= bytes_sent
                 self._application_context[
                     'statistics'
                 ]['throughput'][0] += bytes_sent
-                buf = buf[bytes_sent:]
 
-        except socket.error as e:
-            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+        except (socket.error, OSError) as e:
+            if not zero_copy.would_block(e):
                 self._logger.error(
                     'DirectSocketDown %s socket error: %s',
                     self._socket.fileno(),
@@ -386,9 +523,8 @@ class DirectSocketDown(pollable.Pollable):
                 )
                 raise
 
-        return buf
-
     ## Closing socket.
+    # Peer pipe is drained only by this socket, so it is closed as well.
     #
     def close_socket(self):
         self._logger.debug(
@@ -396,3 +532,7 @@ class DirectSocketDown(pollable.Pollable):
             self._socket.fileno()
         )
         self._socket.close()
+        if self._peer and self._peer._pipe:
+            zero_copy.close_pipe(self._peer._pipe)
+            self._peer._pipe = None
+            self._peer._piped = 0
@@ -0,0 +1,132 @@
+## @package proxy.eviction
+# Module for cache eviction policies.
+## @file eviction.py
+# Implementation of @ref proxy.eviction
+#
+
+import heapq
+
+
+## Base of eviction policies.
+#
+# Created by CacheIndex, which tells it about every entry that is added, hit
+# or removed.
+# Entries are kept in a heap by (priority, tick), the victim is the entry
+# with the lowest key. Updated entries are pushed again, stale heap items are
+# skipped when popped and dropped when the heap grows too much.
+#
+class EvictionPolicy(object):
+    ## Constructor.
+    #
+    def __init__(self):
+        self._heap = []
+        # url -> current key
+        self._keys = {}
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    ## Returns priority of entry, lowest is evicted first.
+    # @param entry (IndexEntry)
+    # @returns priority.
+    #
+    def priority(self, entry):
+        raise NotImplementedError()
+
+    ## Called when victim is evicted.
+    # @param key (tuple) key of victim.
+    #
+    def evicted(self, key):
+        pass
+
+    ## Adds or updates entry.
+    # @param url (str)
+    # @param entry (IndexEntry)
+    #
+    def add(self, url, entry):
+        self._tick += 1
+        key = (self.priority(entry), self._tick)
+        self._keys[url] = key
+        heapq.heappush(self._heap, (key, url))
+        if len(self._heap) > 2 * len(self._keys) + 64:
+            self._heap = [(key, url) for url, key in self._keys.items()]
+            heapq.heapify(self._heap)
+
+    ## Called when entry is hit.
+    # @param url (str)
+    # @param entry (IndexEntry)
+    #
+    def hit(self, url, entry):
+        self.add(url, entry)
+
+    ## Removes entry.
+    # @param url (str)
+    #
+    def remove(self, url):
+        self._keys.pop(url, None)
+
+    ## Removes all entries.
+    #
+    def clear(self):
+        self._heap = []
+        self._keys.clear()
+
+    ## Removes and returns entry to evict.
+    # @returns (str) url, None if there are no entries.
+    #
+    def victim(self):
+        while self._heap:
+            key, url = heapq.heappop(self._heap)
+            if self._keys.get(url) == key:
+                del self._keys[url]
+                self.evicted(key)
+                return url
+        return None
+
+
+## Least recently used entry is evicted first.
+#
+class LruPolicy(EvictionPolicy):
+    def priority(self, entry):
+        return 0
+
+
+## Least frequently used entry is evicted first, least recently used of
+# entries with same hits.
+#
+class LfuPolicy(EvictionPolicy):
+    def priority(self, entry):
+        return entry.hits
+
+
+## Greedy-Dual-Size-Frequency.
+#
+# Priority is frequency per byte, on top of an age that is raised to the
+# priority of each victim, so large entries go before small ones of the same
+# frequency and entries that were popular long ago age out.
+#
+class GdsfPolicy(EvictionPolicy):
+    ## Constructor.
+    #
+    def __init__(self):
+        super(GdsfPolicy, self).__init__()
+        self._age = 0.0
+
+    def priority(self, entry):
+        return self._age + (entry.hits + 1.0) / max(entry.disk_size, 1)
+
+    def evicted(self, key):
+        self._age = key[0]
+
+    def clear(self):
+        super(GdsfPolicy, self).clear()
+        self._age = 0.0
+
+
+## Policies by name.
+POLICIES = {
+    'lru': LruPolicy,
+    'lfu': LfuPolicy,
+    'gdsf': GdsfPolicy,
+}
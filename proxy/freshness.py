@@ -0,0 +1,137 @@
+## @package proxy.freshness
+# Module for freshness of cached responses.
+## @file freshness.py
+# Implementation of @ref proxy.freshness
+#
+
+import constants
+import util
+
+
+## Parses Cache-Control header.
+# Directive names are lower case, quoted values are unquoted.
+# @param value (str) header value.
+# @returns (dict) directive -> value, None for directive without value.
+#
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(','):
+        name, sep, arg = directive.partition('=')
+        name = name.strip().lower()
+        if not name:
+            continue
+        if sep:
+            directives[name] = arg.strip().strip('"')
+        else:
+            directives[name] = None
+    return directives
+
+
+## Returns names of request headers that select a variant of response.
+# @param headers (Headers) response headers.
+# @returns (tuple) sorted lower case names, None if response varies on
+# anything (Vary: *).
+#
+def vary_names(headers):
+    names = set()
+    for value in headers.get_all('Vary'):
+        for name in value.split(','):
+            name = name.strip().lower()
+            if name == '*':
+                return None
+            if name:
+                names.add(name)
+    return tuple(sorted(names))
+
+
+## Parses delta seconds directive.
+# @param value (str) directive value.
+# @returns (int) seconds, None if value is invalid.
+#
+def _delta_seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+## Returns for how long an expired response may still be used.
+# No stale use is allowed with must-revalidate or proxy-revalidate.
+# @param headers (Headers) response headers.
+# @param directive (str) stale-while-revalidate or stale-if-error.
+# @returns (int) seconds after expiration.
+#
+def stale_time(headers, directive):
+    directives = parse_cache_control(headers.get('Cache-Control', ''))
+    if 'must-revalidate' in directives or 'proxy-revalidate' in directives:
+        return 0
+    return _delta_seconds(directives.get(directive)) or 0
+
+
+## Calculates for how long a response stays fresh in a shared cache.
+#
+# Only responses to GET are stored. Response to a request with
+# Authorization is stored only if it allows so explicitly, with public,
+# s-maxage or must-revalidate.
+# Freshness lifetime is taken from s-maxage, max-age, Expires relative to
+# Date, or, when none is given, is a fraction of the time since Last-Modified.
+# Age of response when received is subtracted.
+# Response with no-cache is stored with no freshness, so it is revalidated
+# on every use.
+# @param status (str) status code.
+# @param headers (Headers) response headers.
+# @param now (float) current time.
+# @param method (str) request method.
+# @param request_headers (Headers) request headers, None if not known.
+# @returns (int) seconds response is fresh, None if response must not be
+# stored.
+#
+def lifetime(status, headers, now, method='GET', request_headers=None):
+    if method != 'GET' or status not in constants.CACHEABLE_STATUSES:
+        return None
+    directives = parse_cache_control(headers.get('Cache-Control', ''))
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if (
+        request_headers is not None and
+        'Authorization' in request_headers and
+        not (
+            'public' in directives or
+            's-maxage' in directives or
+            'must-revalidate' in directives
+        )
+    ):
+        return None
+    if vary_names(headers) is None:
+        return None
+
+    date = util.parse_http_date(headers.get('Date', ''))
+    if date is None:
+        date = now
+    if 'no-cache' in directives:
+        seconds = 0
+    elif _delta_seconds(directives.get('s-maxage')) is not None:
+        seconds = _delta_seconds(directives['s-maxage'])
+    elif _delta_seconds(directives.get('max-age')) is not None:
+        seconds = _delta_seconds(directives['max-age'])
+    elif 'Expires' in headers:
+        # Invalid date means already expired.
+        expires = util.parse_http_date(headers['Expires'])
+        seconds = 0 if expires is None else max(int(expires - date), 0)
+    else:
+        modified = util.parse_http_date(headers.get('Last-Modified', ''))
+        if modified is None or modified >= date:
+            return None
+        seconds = min(
+            int((date - modified) * constants.CACHE_HEURISTIC_FRACTION),
+            constants.CACHE_HEURISTIC_MAX,
+        )
+
+    age = max(_delta_seconds(headers.get('Age')) or 0, int(now - date), 0)
+    seconds = max(seconds - age, 0)
+    if not seconds and not (
+        'ETag' in headers or 'Last-Modified' in headers
+    ):
+        # Entry could only be fetched again.
+        return None
+    return seconds
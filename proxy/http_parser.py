@@ -0,0 +1,210 @@
+## @package proxy.http_parser
+# Module for HTTP message head parsing.
+## @file http_parser.py
+# Implementation of @ref proxy.http_parser
+#
+
+import constants
+
+
+## Error in received message head.
+#
+# Carries the status code to answer the sender with.
+#
+class ParseError(RuntimeError):
+    ## Constructor.
+    # @param code (int) HTTP status code.
+    # @param reason (str) HTTP reason phrase.
+    #
+    def __init__(self, code, reason):
+        super(ParseError, self).__init__(reason)
+        self.code = code
+        self.reason = reason
+
+
+## HTTP header fields.
+#
+# Keeps fields in received order, duplicate fields included. Lookups ignore
+# name case, values of a repeated field are joined with commas.
+#
+class Headers(object):
+    ## Constructor.
+    # @param items (iterable) (name, value) tuples.
+    #
+    def __init__(self, items=()):
+        self._items = []
+        for name, value in items:
+            self.add(name, value)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, name):
+        name = name.lower()
+        for k, v in self._items:
+            if k.lower() == name:
+                return True
+        return False
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.remove(name)
+        self.add(name, value)
+
+    def __repr__(self):
+        return 'Headers(%r)' % (self._items,)
+
+    ## Adds a field, existing fields of same name are kept.
+    # @param name (str) field name.
+    # @param value (str) field value.
+    #
+    def add(self, name, value):
+        self._items.append((name, value))
+
+    ## Removes all fields of name.
+    # @param name (str) field name.
+    #
+    def remove(self, name):
+        name = name.lower()
+        self._items = [
+            (k, v) for k, v in self._items if k.lower() != name
+        ]
+
+    ## Returns field value.
+    # @param name (str) field name.
+    # @param default value returned if field is missing.
+    # @returns (str) value, values of repeated field joined with commas.
+    #
+    def get(self, name, default=None):
+        values = self.get_all(name)
+        if not values:
+            return default
+        return ', '.join(values)
+
+    ## Returns values of all fields of name.
+    # @param name (str) field name.
+    # @returns (list) values in received order.
+    #
+    def get_all(self, name):
+        name = name.lower()
+        return [v for k, v in self._items if k.lower() == name]
+
+    ## Returns all fields.
+    # @returns (list) (name, value) tuples in received order.
+    #
+    def items(self):
+        return list(self._items)
+
+
+## Incremental parser of HTTP message head.
+#
+# Data is fed as it is received. Scan position is kept between calls, so
+# every byte of the head is looked at once, no matter how it was split.
+# Start line and header fields are parsed in the same pass, folded field
+# lines are joined. Data after the head is left for the message body.
+#
+class HeadParser(object):
+    ## Constructor.
+    # @param max_size (int) max length of whole head.
+    # @param max_line (int) max length of start line or field line.
+    # @param max_headers (int) max number of header fields.
+    #
+    def __init__(
+        self,
+        max_size=constants.MAX_HEAD_SIZE,
+        max_line=constants.MAX_HEADER_LENGTH,
+        max_headers=constants.MAX_NUMBER_OF_HEADERS,
+    ):
+        self._max_size = max_size
+        self._max_line = max_line
+        self._max_headers = max_headers
+        self._buf = bytearray()
+        # Start of the current line.
+        self._pos = 0
+        # Where search for end of current line goes on.
+        self._scan = 0
+        # Last field, kept until it is known not to be folded.
+        self._field = None
+        self.start_line = None
+        self.headers = Headers()
+        self.done = False
+        ## Data received after the head.
+        self.rest = ''
+
+    ## Parses next piece of head.
+    # @param data (str) received data.
+    # @returns (bool) whether head is complete.
+    # @throws ParseError when head is invalid or exceeds limits.
+    #
+    def feed(self, data):
+        if self.done:
+            self.rest += data
+            return True
+
+        self._buf += data
+        while not self.done:
+            end = self._buf.find('\n', self._scan)
+            if end == -1:
+                self._scan = len(self._buf)
+                if self._scan - self._pos > self._max_line:
+                    self._line_too_long()
+                break
+            if end - self._pos > self._max_line:
+                self._line_too_long()
+            line = bytes(self._buf[self._pos:end]).rstrip('\r')
+            self._pos = self._scan = end + 1
+            self._parse_line(line)
+
+        if (self._pos if self.done else len(self._buf)) > self._max_size:
+            raise ParseError(431, 'Request Header Fields Too Large')
+        if self.done:
+            self.rest = bytes(self._buf[self._pos:])
+            self._buf = None
+        return self.done
+
+    ## Raises error for a line longer than limit.
+    #
+    def _line_too_long(self):
+        if self.start_line is None:
+            raise ParseError(414, 'URI Too Long')
+        raise ParseError(431, 'Request Header Fields Too Large')
+
+    ## Parses a single line of head.
+    # @param line (str) line without line break.
+    #
+    def _parse_line(self, line):
+        if self.start_line is None:
+            # Empty lines before start line are ignored.
+            if line:
+                self.start_line = line
+        elif not line:
+            self._add_field()
+            self.done = True
+        elif line[0] in ' \t':
+            if self._field is None:
+                raise ParseError(400, 'Bad Request')
+            self._field = (
+                self._field[0],
+                '%s %s' % (self._field[1], line.strip()),
+            )
+        else:
+            self._add_field()
+            n = line.find(':')
+            if n <= 0:
+                raise ParseError(400, 'Bad Request')
+            self._field = (line[:n].rstrip(), line[n + 1:].strip())
+
+    ## Adds pending field to headers.
+    #
+    def _add_field(self):
+        if self._field is None:
+            return
+        if len(self.headers) >= self._max_headers:
+            raise ParseError(431, 'Request Header Fields Too Large')
+        self.headers.add(*self._field)
+        self._field = None
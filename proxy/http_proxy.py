@@ -5,24 +5,29 @@
 #
 
 import proxy_client
+import chunked
 import constants
 import errno
 import fcntl
+import http_parser
 import os
 import pollable
 import direct_socket
 import select
+import send_buffer
 import socket
 import time
 import util
+import zero_copy
 
 ## States for parsing HTTP request
 (
     REQUEST_STATE,
     HEADERS_STATE,
     CONTENT_STATE,
+    RESPONSE_STATE,
     CLOSING_STATE,
-) = range(4)
+) = range(5)
 
 
 ## ProxySocket for sending and receiving HTTP requests and responses.
@@ -30,12 +35,25 @@ import util
 # Created from ProxyListen class.
 # Receives requests from the browser client server and parse his request. Then
 # moves the requests to the ProxyClientSocket object.
+# Connection is persistent, once a response was sent the state machine starts
+# over with the next request. Pipelined requests wait in the received buffer
+# until the previous response was sent, so responses keep request order.
+# Cacheable request that misses while the same url is already fetched, or
+# its cache entry filled, follows that fetch instead of fetching it again.
 #
 class ProxySocket(pollable.Pollable):
+    ## Deadlines armed by the poller.
+    timeouts = (
+        pollable.FIRST_BYTE_TIMEOUT,
+        pollable.IDLE_TIMEOUT,
+        pollable.TOTAL_TIMEOUT,
+    )
+
     ## Constructor.
     # @param socket (socket)
+    # @param poll object (poll).
     # @param state (int)
-    # @param headers (dict)
+    # @param headers (Headers)
     # @param cache_handler (Cache)
     # @param application_context (dict)
     # @param logger (logging.Logger)
@@ -43,6 +61,7 @@ class ProxySocket(pollable.Pollable):
     def __init__(
         self,
         socket,
+        poll,
         state,
         headers,
         cache_handler,
@@ -50,19 +69,43 @@ class ProxySocket(pollable.Pollable):
         logger,
     ):
         self._socket = socket
+        self._poll = poll
         self._received = ''
-        self._to_send = ''
+        self._to_send = send_buffer.SendBuffer()
         self._state = state
         self._peer = ''
         self._cache = cache_handler
         self._caching = False
         self._closing = False
+        # Whether connection stays open after current response.
+        self._keep_alive = True
+        # Set once the whole response was queued in to_send.
+        self._response_complete = False
+        # Request content bytes that were not received yet.
+        self._content_left = 0
+        # Decoder of chunked request content.
+        self._decoder = None
+        # Parser of request head being received.
+        self._parser = None
+        # Destination (address, port, path) of request.
+        self._origin = None
+        # ProxyClientSocket this request follows, if any.
+        self._leader = None
         self._logger = logger
         self._request_context = {
             'method': '',
             'uri': '',
+            # Key of response in cache, set by cache lookup.
+            'cache_key': '',
             'headers': headers,
             'content': '',
+            # Pieces of response served from memory cache.
+            'cached_response': None,
+            # Reader of response served from cache file.
+            'cache_reader': None,
+            # Expired cache entry the request revalidates, or serves while
+            # it is revalidated.
+            'stale_entry': None,
             'application_context': application_context,
         }
 
@@ -90,200 +133,406 @@ class ProxySocket(pollable.Pollable):
     def request_context(self, request_context):
         self.request_context = request_context
 
-    ## Checks if received buffer length exceeded max request/response length.
-    # If true, closing socket and sending error message.
-    # @returns (bool) whether buffer exceeded max length.
-    #
-    def check_if_maxsize(self):
-        if len(self._received) > constants.MAX_REQ_SIZE:
-            self._to_send = util.return_status(500, 'Internal Error', '')
-            self._state = CLOSING_STATE
-            self._logger.error(
-                'ProxySocket %s received-buffer reached max-size',
-                self._socket.fileno(),
-            )
-            return True
-        return False
-
-    ## Receives the status line from the source server (client).
+    ## Receives the request head from the source server (client).
+    # Whole head is parsed here, request line is handled.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def request_state(self, args, poll):
-        self.add_buf()
-        line = self.check_if_line()
-        if line:
-            try:
-                method, uri, signature = util.check_request(line)
-            except RuntimeError:
-                self._to_send = util.return_status(
+        if self._parser is None:
+            self._parser = http_parser.HeadParser(
+                max_size=args.max_head_size,
+                max_headers=args.max_headers,
+            )
+        if not self._received:
+            self.add_buf()
+        data, self._received = self._received, ''
+        try:
+            if not self._parser.feed(data):
+                return False
+        except http_parser.ParseError as e:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(e.code, e.reason, ''),
+            )
+            self._logger.error(
+                'ProxySocket %s invalid request head: %s',
+                self._socket.fileno(),
+                e,
+            )
+            self._state = CLOSING_STATE
+            self._closing = True
+            return True
+        self._received = self._parser.rest
+        self._request_context['headers'] = self._parser.headers
+        line = self._parser.start_line
+        self._parser = None
+        try:
+            method, uri, signature = util.check_request(line)
+        except RuntimeError:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(
                     500,
                     'Unsupported http request',
                     '',
                 )
-                self._logger.error(
-                    'ProxySocket %s Unsupported http request, closing socket',
-                    self._socket.fileno(),
-                )
-                self._state = CLOSING_STATE
-                self._closing = True
-                return True
-
-            self._logger.info(
-                'ProxySocket %s: %s request, %s, %s',
+            )
+            self._logger.error(
+                'ProxySocket %s Unsupported http request, closing socket',
                 self._socket.fileno(),
-                method,
-                uri,
-                signature,
             )
-            if method == 'CONNECT':
-                address, port = uri.split(':', 1)
-                upstream = direct_socket.DirectSocketUp(
-                    self._socket,
-                    address,
-                    int(port),
-                    poll,
-                    self,
-                    self._request_context['application_context'],
-                    self._logger,
-                )
-                self._logger.debug(
-                    'DirectSocketUp %s object created',
-                    upstream._socket.fileno(),
-                )
-                poll._pollables.remove(self)
-                self._state = CLOSING_STATE
-                self._closing = True
-                return True
-
-            if '//' not in uri:
-                self._to_send = util.return_status(400, 'Bad request', '')
-                self._state = CLOSING_STATE
-                self._logger.error(
-                    'ProxySocket %s Bad request %s',
-                    self._socket.fileno(),
-                    uri,
-                )
-                return True
-            self._request_context['method'] = method
-            self._request_context['uri'] = uri
-            address, uri = uri.split('//', 1)[1].split('/', 1)
-            address = '%s:' % (address)
-            address, port = address.split(':', 1)
-            port = port.replace(':', '')
-            if not port:
-                port = 80
-            else:
-                port = int(port)
-            self._caching = self._cache.check_if_cache(self._request_context)
-            if self._caching:
-                self._logger.info(
-                    'ProxySocket %s: Found in cache %s',
-                    self._socket.fileno(),
-                    uri,
-                )
-                self._state = CLOSING_STATE
-                response = self._cache.load_response(
-                    self._request_context,
-                    len(self._to_send),
-                )
-                if not response:
-                    self._closing = True
-                self._to_send += response
-                return True
+            self._state = CLOSING_STATE
+            self._closing = True
+            return True
 
-            self._peer = proxy_client.ProxyClientSocket(
+        self._logger.info(
+            'ProxySocket %s: %s request, %s, %s',
+            self._socket.fileno(),
+            method,
+            uri,
+            signature,
+        )
+        if method == 'CONNECT':
+            address, port = uri.split(':', 1)
+            upstream = direct_socket.DirectSocketUp(
+                self._socket,
                 address,
-                port,
+                int(port),
+                poll,
                 self,
                 self._request_context['application_context'],
                 self._logger,
             )
-            poll.register(self._peer)
             self._logger.debug(
-                'ProxyClientSocket object %s created' %
-                self._peer._socket.fileno()
+                'DirectSocketUp %s object created',
+                upstream._socket.fileno(),
             )
-            self._peer._to_send = '%s /%s %s\r\n' % (
-                method,
+            poll.unregister(self)
+            self._state = CLOSING_STATE
+            self._closing = True
+            return True
+
+        if '//' not in uri:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(400, 'Bad request', ''),
+            )
+            self._state = CLOSING_STATE
+            self._closing = True
+            self._logger.error(
+                'ProxySocket %s Bad request %s',
+                self._socket.fileno(),
                 uri,
-                constants.HTTP_SIGNATURE,
             )
             return True
-        self.check_if_maxsize()
-        return False
+        self._request_context['method'] = method
+        self._request_context['uri'] = uri
+        address, uri = uri.split('//', 1)[1].split('/', 1)
+        address = '%s:' % (address)
+        address, port = address.split(':', 1)
+        port = port.replace(':', '')
+        if not port:
+            port = 80
+        else:
+            port = int(port)
+        self._origin = (address, port, uri)
+        self._caching = self._cache.check_if_cache(self._request_context)
+        if self._caching:
+            self._logger.info(
+                'ProxySocket %s: Found in cache %s',
+                self._socket.fileno(),
+                uri,
+            )
+            # Response is sent while rest of request is consumed.
+        return True
 
-    ## Receives request headers from the source server.
+    ## Handles request headers, they were parsed with the request line.
+    # Request body must be framed unambiguously, Transfer-Encoding other
+    # than chunked, or with Content-Length, is rejected, so a request is not
+    # read differently by the origin (request smuggling).
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def headers_state(self, args, poll):
-        line = ' '
-        if constants.CRLF not in self._received:
-            self.add_buf()
-        while line:
-            line = self.check_if_line()
+        headers = self._request_context['headers']
+        try:
+            if 'Transfer-Encoding' in headers:
+                if (
+                    headers.get('Transfer-Encoding').strip().lower() !=
+                    'chunked' or
+                    'Content-Length' in headers
+                ):
+                    raise ValueError('Ambiguous request framing')
+                self._decoder = chunked.ChunkedDecoder()
+            else:
+                length = headers.get('Content-Length', '0').strip()
+                if not length.isdigit():
+                    raise ValueError('Invalid Content-Length')
+                self._content_left = int(length)
+        except ValueError:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(400, 'Bad request', ''),
+            )
+            self._state = CLOSING_STATE
+            self._closing = True
+            return True
+        self._keep_alive = util.is_keep_alive(
+            constants.HTTP_SIGNATURE,
+            headers,
+        )
+        if self._caching:
+            if self._request_context['stale_entry'] is not None:
+                self.revalidate(poll)
+            return True
 
-            if line:
-                self._request_context['headers'] = util.update_headers(
-                    line,
-                    self._request_context['headers'],
-                )
+        uri = self._request_context['uri']
+        fetches = self._request_context['application_context']['fetches']
+        if not self.collapsible():
+            self.fetch(poll)
+        elif uri in fetches:
+            self._leader = fetches[uri]
+            self._leader.add_follower(self)
+            self._logger.info(
+                'ProxySocket %s: Following fetch of %s',
+                self._socket.fileno(),
+                uri,
+            )
+        else:
+            self.fetch(poll)
+            self._peer.lead(uri)
+        return True
 
-        if self._received == constants.CRLF or line == '':
-            for key in self._request_context['headers']:
-                self._peer._to_send += '%s: %s%s' % (
-                    key,
-                    self._request_context['headers'][key],
-                    constants.CRLF,
-                )
-            self._peer._to_send += constants.CRLF
-            return True
-        self.check_if_maxsize()
-        return False
+    ## Checks whether request can follow another fetch of its url.
+    # Only plain GET requests of whole content are collapsed.
+    # @returns (bool)
+    #
+    def collapsible(self):
+        return (
+            self._request_context['method'] == 'GET' and
+            self._decoder is None and
+            self._content_left == 0 and
+            'Range' not in self._request_context['headers']
+        )
+
+    ## Sends request head to destination server.
+    # @param poll object (poll).
+    # @param pooled (bool) whether an idle pooled connection may be used.
+    #
+    def fetch(self, poll, pooled=True):
+        address, port, path = self._origin
+        headers = self._request_context['headers']
+        self._peer = proxy_client.ProxyClientSocket(
+            address,
+            port,
+            self,
+            poll,
+            self._request_context['application_context'],
+            self._logger,
+            pooled,
+        )
+        self._peer._to_send = send_buffer.SendBuffer(
+            '%s /%s %s\r\n' % (
+                self._request_context['method'],
+                path,
+                constants.HTTP_SIGNATURE,
+            )
+        )
+        hop_by_hop = util.hop_by_hop_headers(headers)
+        if self._decoder is not None:
+            # Chunked content is passed as is.
+            hop_by_hop.add('content-length')
+        stale = self._request_context['stale_entry']
+        if stale is not None:
+            # Validators of stale entry replace those of the client, whose
+            # conditions are checked against the entry.
+            hop_by_hop.update(constants.CONDITIONAL_HEADERS)
+            for key, name in (
+                ('If-None-Match', 'ETag'),
+                ('If-Modified-Since', 'Last-Modified'),
+            ):
+                value = stale.headers.get(name)
+                if value is not None:
+                    self._peer._to_send += '%s: %s%s' % (
+                        key,
+                        value,
+                        constants.CRLF,
+                    )
+        for key, value in headers.items():
+            if key.lower() in hop_by_hop:
+                continue
+            self._peer._to_send += '%s: %s%s' % (
+                key,
+                value,
+                constants.CRLF,
+            )
+        # Upstream connection is pooled, independent of the client one.
+        self._peer._to_send += 'Connection: keep-alive%s' % (
+            constants.CRLF,
+        )
+        self._peer._to_send += constants.CRLF
+
+    ## Revalidates stale entry that is sent from cache meanwhile.
+    # Fetch goes on its own, detached from this request. It leads the url,
+    # so a single one runs at a time.
+    # @param poll object (poll).
+    #
+    def revalidate(self, poll):
+        uri = self._request_context['uri']
+        fetches = self._request_context['application_context']['fetches']
+        if self.collapsible() and uri not in fetches:
+            self._logger.info(
+                'ProxySocket %s: Revalidating %s',
+                self._socket.fileno(),
+                uri,
+            )
+            self.fetch(poll)
+            self._peer.lead(uri)
+            self._peer.detach()
+        self._request_context['stale_entry'] = None
+
+    ## Called by leader whose response is not cached.
+    # Request is served from cache if leader refreshed the entry, otherwise
+    # it is fetched on its own, it has no content so it is complete.
+    #
+    def unfollow(self):
+        self._leader = None
+        if self._cache.check_if_cache(self._request_context):
+            self._caching = True
+            self._poll.touch(self)
+            return
+        self.fetch(self._poll)
+        self._peer._request_complete = True
+        self._poll.touch(self._peer)
+
+    ## Sends response from cache instead of from destination server.
+    # Called by peer once it revalidated the stale cache entry. If entry
+    # cannot be served after all, request is fetched again without
+    # conditions.
+    # @param entry (IndexEntry) refreshed entry, None if it is gone.
+    #
+    def serve_from_cache(self, entry):
+        self._request_context['stale_entry'] = None
+        if entry is not None:
+            self._caching = self._cache.serve_entry(
+                self._request_context,
+                entry,
+            )
+        if not self._caching:
+            self.fetch(self._poll)
+            self._peer._request_complete = self.content_done()
+            self._poll.touch(self._peer)
+        self._poll.touch(self)
 
     ## Receives requests content part from the source server.
+    # Content is passed to peer as it arrives. It is received straight into
+    # peer to-send buffer, no more than the buffer has room for, so a slow
+    # destination server slows down the source. Chunked content is passed as
+    # is and decoded only to find where it ends. Anything after the content
+    # belongs to the next request. Content of a request answered from cache
+    # is dropped.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def content_state(self, args, poll):
-        finished = False
-        self._request_context['headers']['Content-Length'] = int(
-            self._request_context['headers'].get('Content-Length', 0)
-        )
-
-        t = ''
-        try:
-            t = self._socket.recv(constants.BLOCK_SIZE)
-        except socket.error as e:
-            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
-                self._logger.error(
-                    'ProxySocket %s socket error: %s',
-                    self._socket.fileno(),
-                    e,
-                )
-                self._state = CLOSING_STATE
-                finished = True
+        while not self.content_done():
+            if self._received:
+                # Left from head, it is never more than a single block.
+                data, self._received = self._received, ''
+            else:
+                room = constants.TO_SEND_MAXSIZE
+                if self._peer:
+                    room -= len(self._peer._to_send)
+                if room <= 0:
+                    return False
+                if self._decoder is None:
+                    room = min(room, self._content_left)
+                try:
+                    data = self._socket.recv(room)
+                except socket.error as e:
+                    if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        self._logger.error(
+                            'ProxySocket %s socket error: %s',
+                            self._socket.fileno(),
+                            e,
+                        )
+                        raise
+                    return False
+                if not data:
+                    self._state = CLOSING_STATE
+                    self._closing = True
+                    return True
+
+            if self._decoder is not None:
+                try:
+                    consumed = self._decoder.decode(data)[1]
+                except ValueError as e:
+                    self._logger.error(
+                        'ProxySocket %s invalid chunked content: %s',
+                        self._socket.fileno(),
+                        e,
+                    )
+                    self._to_send = send_buffer.SendBuffer(
+                        util.return_status(400, 'Bad request', ''),
+                    )
+                    self._state = CLOSING_STATE
+                    self._closing = True
+                    return True
+            else:
+                consumed = min(len(data), self._content_left)
+                self._content_left -= consumed
+            if consumed < len(data):
+                self._received = data[consumed:]
+                data = data[:consumed]
+            if self._peer:
+                self._peer._to_send += data
 
-        if not t:
-            finished = True
+        if self._peer:
+            self._peer._request_complete = True
+        return True
 
-        self._received += t
-        self._peer._to_send += self._received
-        self._request_context['headers']['Content-Length'] -= (
-            len(self._received)
-        )
-        self._received = ''
+    ## Checks whether whole request content was received.
+    # @returns (bool)
+    #
+    def content_done(self):
+        if self._decoder is not None:
+            return self._decoder.done
+        return self._content_left == 0
 
-        if self._request_context['headers']['Content-Length'] == 0:
-            finished = True
-        if finished:
-            return True
+    ## Waits until the response was sent.
+    # @param args (dict) program arguments.
+    # @param poll object (poll).
+    # @returns (boll) if ready to move to next state.
+    #
+    def response_state(self, args, poll):
+        return self._response_complete and not self._to_send
 
-        return False
+    ## Prepares for the next request on the connection.
+    # Next request head has its own first byte deadline. Pipelined request
+    # that was already received is processed right away.
+    #
+    def start_request(self):
+        self._state = REQUEST_STATE
+        self._poll.set_timeout(self, pollable.FIRST_BYTE_TIMEOUT)
+        self._peer = ''
+        self._caching = False
+        self._keep_alive = True
+        self._response_complete = False
+        self._content_left = 0
+        self._decoder = None
+        self._parser = None
+        self._origin = None
+        self._leader = None
+        self._request_context['method'] = ''
+        self._request_context['uri'] = ''
+        self._request_context['cache_key'] = ''
+        self._request_context['headers'] = http_parser.Headers()
+        self._request_context['content'] = ''
+        self._request_context['cached_response'] = None
+        self._request_context['stale_entry'] = None
+        self._cache.close_reader(self._request_context)
+        if self._received:
+            self._poll.wakeup(self)
 
     ## Final state. Finished receiving. Ready to close socket.
     # @returns (boll) if ready to move to next state.
@@ -305,7 +554,11 @@ class ProxySocket(pollable.Pollable):
         },
         CONTENT_STATE: {
             "function": content_state,
-            "next": CLOSING_STATE
+            "next": RESPONSE_STATE
+        },
+        RESPONSE_STATE: {
+            "function": response_state,
+            "next": REQUEST_STATE
         },
         CLOSING_STATE: {
             "function": closing_state,
@@ -323,32 +576,62 @@ class ProxySocket(pollable.Pollable):
         while (self._state <= CONTENT_STATE and
                 ProxySocket.states[self._state]['function'](self, args, poll)):
             self._state = ProxySocket.states[self._state]['next']
+        if self._state > HEADERS_STATE:
+            poll.clear_timeout(self, pollable.FIRST_BYTE_TIMEOUT)
         return None
 
     ## Function to be called when poller have a POLLOUT event.
     # ProxySocket is in the process of sending response to the source server.
     # This function sends everything from the to_send buffer.
+    # Once response was sent, connection either waits for next request or
+    # is closed.
     # @returns (ProxySocket) object to be removed from poll.
     #
     def on_write(self):
-        self._to_send = self.send_all()
+        try:
+            self.send_all()
+        except socket.error:
+            # Peer or leader must know this connection is gone.
+            return self.on_error()
+        if self._leader:
+            # Leader may wait for room in to-send buffer.
+            self._poll.touch(self._leader)
+            if self._leader.replaying(self):
+                self._leader.replay(self)
         if (
             self._caching and
             not self._closing and
             len(self._to_send) < constants.TO_SEND_MAXSIZE
         ):
-            response = self._cache.load_response(
-                self._request_context,
-                len(self._to_send),
-            )
-            if not response:
+            if self._cache.sends_file(self._request_context):
+                try:
+                    self.send_cached()
+                except OSError:
+                    return self.on_error()
+            else:
+                response = self._cache.load_response(
+                    self._request_context,
+                    len(self._to_send),
+                )
+                if response:
+                    self._to_send += response
+                else:
+                    self._caching = False
+                    self._response_complete = True
+
+        if (
+            self._state == RESPONSE_STATE and
+            self.response_state(None, self._poll)
+        ):
+            if self._keep_alive and not self._closing:
+                self.start_request()
+            else:
                 self._closing = True
-            self._to_send += response
 
         if not self._to_send and self._closing:
             self.close_socket()
             if self._peer:
-                self._peer._state = proxy_client.CLOSING_STATE
+                self._peer.peer_closed()
             return self
         return None
 
@@ -359,7 +642,7 @@ class ProxySocket(pollable.Pollable):
     def on_error(self):
         self.close_socket()
         if self._peer:
-            self._peer._state = proxy_client.CLOSING_STATE
+            self._peer.peer_closed()
         return self
 
     ## Function to be called when poller have a POLLHUP event.
@@ -369,9 +652,30 @@ class ProxySocket(pollable.Pollable):
     def on_hup(self):
         self.close_socket()
         if self._peer:
-            self._peer._state = proxy_client.CLOSING_STATE
+            self._peer.peer_closed()
         return self
 
+    ## Function to be called when a deadline expires.
+    # Request that was not received in time is answered with an error, other
+    # deadlines close the socket.
+    # @param kind (int) deadline kind.
+    # @returns (ProxySocket) object to be removed from poll.
+    #
+    def on_timeout(self, kind):
+        self._logger.error(
+            'ProxySocket %s deadline %s expired',
+            self._socket.fileno(),
+            kind,
+        )
+        if kind == pollable.FIRST_BYTE_TIMEOUT and not self._to_send:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(408, 'Request Timeout', ''),
+            )
+            self._state = CLOSING_STATE
+            self._closing = True
+            return None
+        return self.on_error()
+
     ## Returns sockets file discriptor.
     # @returns (str) sockets file discriptor.
     #
@@ -389,11 +693,15 @@ class ProxySocket(pollable.Pollable):
         ):
             events |= select.POLLIN
             if self._peer:
-                if len(self._peer._to_send) > constants.TO_SEND_MAXSIZE:
+                if len(self._peer._to_send) >= constants.TO_SEND_MAXSIZE:
                     events = select.POLLERR
 
         if (
-            self._to_send or self._closing
+            self._to_send or
+            self._closing or
+            self._caching or
+            (self._leader and self._leader.replaying(self)) or
+            (self._state == RESPONSE_STATE and self._response_complete)
         ):
             events |= select.POLLOUT
         return events
@@ -424,17 +732,13 @@ class ProxySocket(pollable.Pollable):
                 raise
 
     ## Sends everything possible from to_send buffer.
-    # @returns (str) string from buffer that couldn't be sent.
     #
     def send_all(self):
         try:
-            buf = self._to_send
-            while buf:
-                bytes_sent = self._socket.send(buf)
-                self._request_context[
-                    'application_context'
-                ]['statistics']['throughput'][0] += bytes_sent
-                buf = buf[bytes_sent:]
+            bytes_sent = self._to_send.send(self._socket)
+            self._request_context[
+                'application_context'
+            ]['statistics']['throughput'][0] += bytes_sent
 
         except socket.error as e:
             if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
@@ -445,19 +749,34 @@ class ProxySocket(pollable.Pollable):
                 )
                 raise
 
-        return buf
-
-    ## Checks if theres a line in the received buffer, and returns it.
-    # @returns (str) line that was found in received buffer.
+    ## Sends response from cache file.
+    # Head goes through to-send buffer, content is sent from file straight to
+    # socket once the buffer is empty.
     #
-    def check_if_line(self):
-        buf = self._received
-        n = buf.find(constants.CRLF_BIN)
-        if n == -1:
-            return None
-        line = buf[:n].decode('utf-8')
-        self._received = buf[n + len(constants.CRLF_BIN):]
-        return line
+    def send_cached(self):
+        self._to_send += self._cache.load_head(self._request_context)
+        if self._to_send:
+            return
+        try:
+            sent = self._cache.send_content(
+                self._request_context,
+                self._socket.fileno(),
+            )
+        except OSError as e:
+            if zero_copy.would_block(e):
+                return
+            self._logger.error(
+                'ProxySocket %s sendfile error: %s',
+                self._socket.fileno(),
+                e,
+            )
+            raise
+        self._request_context[
+            'application_context'
+        ]['statistics']['throughput'][0] += sent
+        if not sent:
+            self._caching = False
+            self._response_complete = True
 
     ## Closing socket.
     #
@@ -466,7 +785,14 @@ class ProxySocket(pollable.Pollable):
             'ProxySocket socket %s is closing' %
             self._socket.fileno()
         )
-        self._request_context['application_context']['connections'] -= 1
+        self._cache.close_reader(self._request_context)
+        if self._leader:
+            self._leader.remove_follower(self)
+            self._leader = None
+        statistics = self._request_context['application_context'][
+            'statistics'
+        ]
+        statistics['connections'][0] -= 1
         self._socket.close()
 
 
@@ -482,6 +808,7 @@ class ProxyListen(pollable.Pollable):
     # @param cache_handler (Cache)
     # @param application_context (dict)
     # @param logger (logging.Logger)
+    # @param reuse_port (bool) share bind port with other workers.
     #
     def __init__(
         self,
@@ -490,6 +817,7 @@ class ProxyListen(pollable.Pollable):
         cache_handler,
         application_context,
         logger,
+        reuse_port=False,
     ):
         self._logger = logger
         self._application_context = application_context
@@ -503,6 +831,12 @@ class ProxyListen(pollable.Pollable):
             fcntl.F_SETFL, fcntl.fcntl(self._socket.fileno(), fcntl.F_GETFL) |
             os.O_NONBLOCK,
         )
+        if reuse_port:
+            self._socket.setsockopt(
+                socket.SOL_SOCKET,
+                util.SO_REUSEPORT,
+                1,
+            )
         connected = False
         while not connected:
             try:
@@ -531,13 +865,12 @@ class ProxyListen(pollable.Pollable):
             fcntl.F_SETFL,
             fcntl.fcntl(s1.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK,
         )
-        self._application_context['connections'] += 1
+        self._application_context['statistics']['connections'][0] += 1
         http_obj = ProxySocket(
             s1,
+            poll,
             REQUEST_STATE,
-            {
-                'Content-Length': '0',
-            },
+            http_parser.Headers(),
             self._cache,
             self._application_context,
             self._logger,
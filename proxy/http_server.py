@@ -7,13 +7,16 @@
 import constants
 import errno
 import fcntl
+import http_parser
 import os
 import pollable
 import select
+import send_buffer
 import socket
 import time
 import urlparse
 import util
+import zero_copy
 
 ## States for parsing HTTP request and sending response.
 (
@@ -31,11 +34,21 @@ import util
 # responding to it.
 #
 # Created from ServerListen object.
+# Where sendfile is available, file content is sent from file to socket
+# inside the kernel. Socket is corked meanwhile, so the head goes out in the
+# same packets as the content.
 #
 class HttpServer(pollable.Pollable):
+    ## Deadlines armed by the poller.
+    timeouts = (
+        pollable.FIRST_BYTE_TIMEOUT,
+        pollable.IDLE_TIMEOUT,
+        pollable.TOTAL_TIMEOUT,
+    )
+
     ## Constructor.
     # @param socket (socket)
-    # @param headers (dict)
+    # @param headers (Headers)
     # @param cache_handler (Cache)
     # @param application_context (dict)
     # @param logger (logging.Logger)
@@ -51,8 +64,12 @@ class HttpServer(pollable.Pollable):
         self._socket = socket
         self._state = 0
         self._received = ''
-        self._to_send = ''
+        self._to_send = send_buffer.SendBuffer()
         self._manage = ''
+        # Parser of request head being received.
+        self._parser = None
+        # Request content bytes that were not received yet.
+        self._content_left = 0
         self._cache_handler = cache_handler
         self._logger = logger
         self._request_context = {
@@ -63,6 +80,9 @@ class HttpServer(pollable.Pollable):
             'content': '',
             'file_name': '',
             'file_obj': '',
+            # Size of file and bytes of it that were sent.
+            'file_size': 0,
+            'file_offset': 0,
             'application_context': application_context,
         }
 
@@ -90,124 +110,117 @@ class HttpServer(pollable.Pollable):
     def request_context(self, request_context):
         self.request_context = request_context
 
-    ## Checks if received buffer length exceeded max request/response length.
-    # If true, closing socket and sending error message.
-    # @returns (bool) whether buffer exceeded max length.
-    #
-    def check_if_maxsize(self):
-        if len(self._received) > constants.MAX_REQ_SIZE:
-            self._to_send = util.return_status(500, 'Internal Error', '')
-            self._state = CLOSING_STATE
-            self._logger.error(
-                'HttpServer %s received-buffer reached max-size',
-                self._socket.fileno(),
-            )
-            return True
-        return False
-
-    ## Receives the status line from the source server (client).
+    ## Receives the request head from the source server (client).
+    # Whole head is parsed here, request line is handled.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def request_state(self, args, poll):
-        self.add_buf()
-        line = self.check_if_line()
-        if line:
-            method, uri, signature = util.check_request(line)
-            file_name = os.path.normpath(
-                '%s%s' % (
-                    args.base,
-                    os.path.normpath(uri),
-                )
+        if self._parser is None:
+            self._parser = http_parser.HeadParser(
+                max_size=args.max_head_size,
+                max_headers=args.max_headers,
+            )
+        if not self._received:
+            self.add_buf()
+        data, self._received = self._received, ''
+        try:
+            if not self._parser.feed(data):
+                return False
+        except http_parser.ParseError as e:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(e.code, e.reason, ''),
             )
-            self._request_context['method'] = method
-            urlparsed = urlparse.urlparse(uri)
-            self._request_context['uri'] = urlparsed.path
-            self._request_context['parameters'] = urlparse.parse_qs(
-                urlparsed.query
+            self._state = CLOSING_STATE
+            self._logger.error(
+                'HttpServer %s invalid request head: %s',
+                self._socket.fileno(),
+                e,
             )
-            self._request_context['file_name'] = file_name
-            if self._request_context['uri'] == '/manage':
-                if len(self._request_context['parameters']) > 0:
-                    if self._request_context['parameters']['url'][0] == 'all':
-                        self._cache_handler.delete_all_cache()
-                    else:
-                        self._cache_handler.delete_cache(
-                            self._request_context['parameters']['url'][0]
-                        )
-                self._manage = ManageInerface(
-                    self._cache_handler,
-                    self._request_context['application_context'],
-                    self._logger,
-                )
-            elif self._request_context['uri'] != '/style.css':
-                self._logger.info(
-                    'HttpServer %s: %s request, %s, %s',
-                    self._socket.fileno(),
-                    method,
-                    uri,
-                    signature,
-                )
             return True
-        self.check_if_maxsize()
-        return False
+        self._received = self._parser.rest
+        self._request_context['headers'] = self._parser.headers
+        line = self._parser.start_line
+        self._parser = None
+        method, uri, signature = util.check_request(line)
+        file_name = os.path.normpath(
+            '%s%s' % (
+                args.base,
+                os.path.normpath(uri),
+            )
+        )
+        self._request_context['method'] = method
+        urlparsed = urlparse.urlparse(uri)
+        self._request_context['uri'] = urlparsed.path
+        self._request_context['parameters'] = urlparse.parse_qs(
+            urlparsed.query
+        )
+        self._request_context['file_name'] = file_name
+        if self._request_context['uri'] == '/manage':
+            if len(self._request_context['parameters']) > 0:
+                if self._request_context['parameters']['url'][0] == 'all':
+                    self._cache_handler.delete_all_cache()
+                else:
+                    self._cache_handler.delete_cache(
+                        self._request_context['parameters']['url'][0]
+                    )
+            self._manage = ManageInerface(
+                self._cache_handler,
+                self._request_context['application_context'],
+                self._logger,
+            )
+        elif self._request_context['uri'] != '/style.css':
+            self._logger.info(
+                'HttpServer %s: %s request, %s, %s',
+                self._socket.fileno(),
+                method,
+                uri,
+                signature,
+            )
+        return True
 
-    ## Receives request headers from the source server.
+    ## Handles request headers, they were parsed with the request line.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def headers_state(self, args, poll):
-        line = ' '
-        while line:
-            line = self.check_if_line()
-            if line:
-                self._request_context['headers'] = util.update_headers(
-                    line,
-                    self._request_context['headers'],
-                )
-        if self._received == constants.CRLF or line == '':
+        try:
+            self._content_left = int(
+                self._request_context['headers'].get('Content-Length', 0)
+            )
+        except ValueError:
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(400, 'Bad request', ''),
+            )
+            self._state = CLOSING_STATE
             return True
-        self.check_if_maxsize()
-        return False
+        return True
 
     ## Receives requests content part from the source server.
+    # Content is not used, it is only consumed.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def content_state(self, args, poll):
-        if int(self._request_context['headers']['Content-Length']) != 0:
-            leng = int(self._request_context['headers']['Content-Length'])
-            self._request_context['headers']['Content-Length'] = leng
-            try:
-                t = self._socket.recv(constants.BLOCK_SIZE)
-                if not t:
-                    raise RuntimeError('Disconnect')
-                self._received += t
-                if self._request_context['headers']['Content-Length'] == 0:
-                    return True
-
-            except socket.error as e:
-                if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
-                    self._logger.error(
-                        'HttpServer %s socket error: %s',
-                        self._socket.fileno(),
-                        e,
-                    )
-                    raise
-
-            return False
-        return True
+        if self._content_left and not self._received:
+            self.add_buf()
+        content = self._received[:self._content_left]
+        self._received = self._received[len(content):]
+        self._content_left -= len(content)
+        return self._content_left == 0
 
     ## Builds responses status line.
     # @returns (boll) if ready to move to next state.
     #
     def response_status_state(self):
-        self._to_send = (
-            '%s 200 OK\r\n' % (constants.HTTP_SIGNATURE)
-        ).encode('utf-8')
+        self._to_send = send_buffer.SendBuffer(
+            (
+                '%s 200 OK\r\n' % (constants.HTTP_SIGNATURE)
+            ).encode('utf-8')
+        )
         return True
 
     ## Builds response headers part.
@@ -220,13 +233,18 @@ class HttpServer(pollable.Pollable):
             else:
                 file_obj = open(self._request_context['file_name'], 'rb')
                 self._request_context['file_obj'] = file_obj
+                self._request_context['file_size'] = os.fstat(
+                    file_obj.fileno(),
+                ).st_size
+                if zero_copy.sendfile is not None:
+                    util.set_cork(self._socket, True)
                 self._to_send += (
                     (
                         'Content-Length: %s\r\n'
                         'Content-Type: %s\r\n'
                         '\r\n'
                     ) % (
-                        os.fstat(file_obj.fileno()).st_size,
+                        self._request_context['file_size'],
                         constants.MIME_MAPPING.get(
                             os.path.splitext(
                                 self._request_context['file_name']
@@ -245,9 +263,13 @@ class HttpServer(pollable.Pollable):
             )
             self._state = CLOSING_STATE
             if e.errno == errno.ENOENT:
-                self._to_send = util.return_status(404, 'File Not Found', e)
+                self._to_send = send_buffer.SendBuffer(
+                    util.return_status(404, 'File Not Found', e),
+                )
             else:
-                self._to_send = util.return_status(500, 'Internal Error', e)
+                self._to_send = send_buffer.SendBuffer(
+                    util.return_status(500, 'Internal Error', e),
+                )
 
         except Exception as e:
             self._logger.error(
@@ -256,7 +278,9 @@ class HttpServer(pollable.Pollable):
                 e,
             )
             self._state = CLOSING_STATE
-            self._to_send = util.return_status(500, 'Internal Error', e)
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(500, 'Internal Error', e),
+            )
 
     ## Builds response content part.
     # @returns (boll) if ready to move to next state.
@@ -266,6 +290,8 @@ class HttpServer(pollable.Pollable):
             if self._manage:
                 self._to_send += self._manage._body
                 return True
+            elif zero_copy.sendfile is not None:
+                return self.send_file()
             else:
                 file_obj = self._request_context['file_obj']
                 while len(self._to_send) < constants.TO_SEND_MAXSIZE:
@@ -284,9 +310,13 @@ class HttpServer(pollable.Pollable):
             )
             self._state = CLOSING_STATE
             if e.errno == errno.ENOENT:
-                self._to_send = util.return_status(404, 'File Not Found', e)
+                self._to_send = send_buffer.SendBuffer(
+                    util.return_status(404, 'File Not Found', e),
+                )
             else:
-                self._to_send = util.return_status(500, 'Internal Error', e)
+                self._to_send = send_buffer.SendBuffer(
+                    util.return_status(500, 'Internal Error', e),
+                )
 
         except Exception as e:
             self._logger.error(
@@ -295,7 +325,52 @@ class HttpServer(pollable.Pollable):
                 e,
             )
             self._state = CLOSING_STATE
-            self._to_send = util.return_status(500, 'Internal Error', e)
+            self._to_send = send_buffer.SendBuffer(
+                util.return_status(500, 'Internal Error', e),
+            )
+
+    ## Sends file content straight from file to socket.
+    # Head is sent first.
+    # @returns (boll) whether whole file was sent.
+    #
+    def send_file(self):
+        self.send_all()
+        if self._to_send:
+            return False
+        file_obj = self._request_context['file_obj']
+        while (
+            self._request_context['file_offset'] <
+            self._request_context['file_size']
+        ):
+            try:
+                sent = zero_copy.sendfile(
+                    self._socket.fileno(),
+                    file_obj.fileno(),
+                    self._request_context['file_offset'],
+                    min(
+                        constants.SENDFILE_BLOCK_SIZE,
+                        self._request_context['file_size'] -
+                        self._request_context['file_offset'],
+                    ),
+                )
+            except OSError as e:
+                if zero_copy.would_block(e):
+                    return False
+                self._logger.error(
+                    'HttpServer %s sendfile error: %s',
+                    self._socket.fileno(),
+                    e,
+                )
+                file_obj.close()
+                self._state = CLOSING_STATE
+                return False
+            if not sent:
+                # File was truncated.
+                break
+            self._request_context['file_offset'] += sent
+        file_obj.close()
+        util.set_cork(self._socket, False)
+        return True
 
     ## Final state. Finished receiving. Ready to close socket.
     # @returns (boll) if ready to move to next state.
@@ -339,6 +414,7 @@ class HttpServer(pollable.Pollable):
 
     ## Function to be called when poller have a POLLIN event.
     # HttpServer is in the process of receving request from the source server.
+    # Content is not used, so first byte deadline covers the whole request.
     # @param poll object (poll).
     # @param args (dict) program arguments.
     # @returns (ProxySocket) object to be removed from poll.
@@ -347,6 +423,8 @@ class HttpServer(pollable.Pollable):
         while (self._state <= CONTENT_STATE and
                 HttpServer.states[self._state]['function'](self, args, poll)):
             self._state = HttpServer.states[self._state]['next']
+        if self._state > CONTENT_STATE:
+            poll.clear_timeout(self, pollable.FIRST_BYTE_TIMEOUT)
         return None
 
     ## Function to be called when poller have a POLLOUT event.
@@ -357,20 +435,17 @@ class HttpServer(pollable.Pollable):
         while (self._state < CLOSING_STATE and
                 HttpServer.states[self._state]['function'](self)):
             self._state = HttpServer.states[self._state]['next']
-        self._to_send = self.send_all()
+        self.send_all()
         if not self._to_send and self._state == CLOSING_STATE:
             self.close_socket()
             return self
         return None
 
     ## Sends everything possible from to_send buffer.
-    # @returns (str) string from buffer that couldn't be sent.
     #
     def send_all(self):
         try:
-            buf = self._to_send
-            while buf:
-                buf = buf[self._socket.send(buf):]
+            self._to_send.send(self._socket)
 
         except socket.error as e:
             if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
@@ -381,8 +456,6 @@ class HttpServer(pollable.Pollable):
                 )
                 raise
 
-        return buf
-
     # Receives string from socket and adds it to received buffer.
     # @param max_length (int) max header length.
     # @param blocksize (int) length of bytes to receive.
@@ -407,21 +480,6 @@ class HttpServer(pollable.Pollable):
                 )
                 raise
 
-    ## Checks if theres a line in the received buffer, and returns it.
-    # @returns (str) line that was found in received buffer.
-    #
-    def check_if_line(self):
-        # checks if theres a full line in what the socket received, if there
-        # is returns it, if not adds buf to the 'received'
-        buf = self._received
-        n = buf.find(constants.CRLF_BIN)
-        if n == -1:
-            self.add_buf()
-            return None
-        line = buf[:n].decode('utf-8')
-        self._received = buf[n + len(constants.CRLF_BIN):]
-        return line
-
     ## Function to be called when poller have a POLLERR event.
     # Socket has encountered an error, closing socket.
     # @returns (ProxySocket) object to be removed from poll.
@@ -430,6 +488,19 @@ class HttpServer(pollable.Pollable):
         raise RuntimeError
         return None
 
+    ## Function to be called when a deadline expires.
+    # @param kind (int) deadline kind.
+    # @returns (HttpServer) object to be removed from poll.
+    #
+    def on_timeout(self, kind):
+        self._logger.error(
+            'HttpServer %s deadline %s expired',
+            self._socket.fileno(),
+            kind,
+        )
+        self.close_socket()
+        return self
+
     ## Returns sockets file discriptor.
     # @returns (str) sockets file discriptor.
     #
@@ -476,6 +547,7 @@ class ServerListen(pollable.Pollable):
     # @param cache_handler (Cache)
     # @param application_context (dict)
     # @param logger (logging.Logger)
+    # @param reuse_port (bool) share bind port with other workers.
     #
     def __init__(
         self,
@@ -484,6 +556,7 @@ class ServerListen(pollable.Pollable):
         cache_handler,
         application_context,
         logger,
+        reuse_port=False,
     ):
         self._cache_handler = cache_handler
         self._application_context = application_context
@@ -497,6 +570,12 @@ class ServerListen(pollable.Pollable):
             fcntl.F_SETFL, fcntl.fcntl(self._socket.fileno(), fcntl.F_GETFL) |
             os.O_NONBLOCK,
         )
+        if reuse_port:
+            self._socket.setsockopt(
+                socket.SOL_SOCKET,
+                util.SO_REUSEPORT,
+                1,
+            )
         connected = False
         while not connected:
             try:
@@ -526,9 +605,7 @@ class ServerListen(pollable.Pollable):
         )
         server_obj = HttpServer(
             s1,
-            {
-                'Content-Length': '0',
-            },
+            http_parser.Headers(),
             self._cache_handler,
             self._application_context,
             self._logger,
@@ -609,33 +686,67 @@ class ManageInerface():
     # @returns (boll) if ready to move to next state.
     #
     def cache_state(self):
-        self._body += '<h3>Cache Stored</h3>'
+        if self._application_context['workers']:
+            # Each worker keeps its own index, table is of this worker.
+            self._body += '<h3>Cache Stored (worker %s)</h3>' % os.getpid()
+        else:
+            self._body += '<h3>Cache Stored</h3>'
         cache_files = self._cache_handler.get_cached()
         # cache.get_cached()  # {name:[date, hits]}
         self._body += util.build_cache_table(cache_files)
+        sweeps = [
+            statistics['sweep']
+            for statistics in self.all_statistics()
+        ]
+        self._body += (
+            '<td> expired entries swept: %s, '
+            'bytes reclaimed: %s, '
+            'sweeper lag: %s seconds </td>'
+        ) % (
+            sum(sweep['entries'] for sweep in sweeps),
+            sum(sweep['bytes'] for sweep in sweeps),
+            max(sweep['lag'] for sweep in sweeps),
+        )
 
         return True
 
+    ## Returns statistics of all workers.
+    # @returns (list) application_context['statistics'] of each worker.
+    #
+    def all_statistics(self):
+        if self._application_context['workers']:
+            return self._application_context['workers'].all_statistics()
+        return [self._application_context['statistics']]
+
     ## Builds the throughput part of the management page.
     # @returns (boll) if ready to move to next state.
     #
     def throughput_state(self):
         self._body += '<h3>Throughput Statistics</h3>'
-        time_started = self._application_context['statistics']['throughput'][1]
+        # Aggregate the counters of all workers.
+        all_statistics = self.all_statistics()
+        throughputs = [
+            statistics['throughput']
+            for statistics in all_statistics
+        ]
+        if self._application_context['workers']:
+            self._body += '<td> %s workers\r\n' % len(throughputs)
+        self._body += '<td> open connections: %s\r\n' % sum(
+            statistics['connections'][0]
+            for statistics in all_statistics
+        )
+        time_started = min(throughput[1] for throughput in throughputs)
         self._body += '<td> throughput rate for the last %s seconds:\r\n' % (
             int(round(time.time() - time_started))
         )
-        if time_started + 10 > time.time():
-            bytesent = self._application_context['statistics']['throughput'][0]
-            self._body += '<td> %s bytes/second </td>' % (
-                bytesent / (time.time() - time_started)
-            )
-        else:
-            self._application_context[
-                'statistics'
-            ]['throughput'][1] = time.time()
-            self._application_context['statistics']['throughput'][0] = 0
-            self._body += '<td> %s bytes/second </td>' % (0.0)
+        rate = 0.0
+        for throughput in throughputs:
+            if throughput[1] + 10 > time.time():
+                rate += throughput[0] / (time.time() - throughput[1])
+            else:
+                throughput[1] = time.time()
+                throughput[0] = 0
+        self._body += '<td> %s bytes/second </td>' % (rate)
 
         return True
 
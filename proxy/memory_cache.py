@@ -0,0 +1,128 @@
+## @package proxy.memory_cache
+# Module for MemoryCache object.
+## @file memory_cache.py
+# Implementation of @ref proxy.memory_cache
+#
+
+import collections
+import constants
+
+
+## Cached response kept in memory.
+#
+class MemoryEntry(object):
+    ## Constructor.
+    # @param head (str) status line and headers, with the empty line.
+    # @param content (str) response content.
+    #
+    def __init__(self, head, content):
+        self.head = head
+        self.content = content
+
+    ## Bytes taken by entry.
+    @property
+    def size(self):
+        return len(self.head) + len(self.content)
+
+
+## Memory tier of the cache.
+#
+# Created by Cache.
+# Holds whole responses within a byte budget, using segmented LRU: new
+# entries start in the probation segment and move to the protected segment
+# when hit again. Protected entries pushed out of their segment go back to
+# probation, and entries are evicted from probation first, so a scan of
+# objects that are requested once does not flush the hot ones.
+# Every entry is also in the disk store, eviction only drops the memory copy.
+#
+class MemoryCache(object):
+    ## Constructor.
+    # @param max_size (int) byte budget, 0 disables memory tier.
+    # @param protected_ratio (float) part of budget for protected segment.
+    #
+    def __init__(
+        self,
+        max_size=constants.MEMORY_CACHE_SIZE,
+        protected_ratio=constants.MEMORY_CACHE_PROTECTED_RATIO,
+    ):
+        self._max_size = max_size
+        self._max_protected = int(max_size * protected_ratio)
+        # uri -> MemoryEntry, least recently used first.
+        self._probation = collections.OrderedDict()
+        self._protected = collections.OrderedDict()
+        self._size = 0
+        self._protected_size = 0
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def __contains__(self, uri):
+        return uri in self._probation or uri in self._protected
+
+    ## Bytes taken by all entries.
+    @property
+    def size(self):
+        return self._size
+
+    ## Returns entry and marks it as recently used.
+    # @param uri (str)
+    # @returns (MemoryEntry) entry, None if not in memory.
+    #
+    def get(self, uri):
+        entry = self._protected.pop(uri, None)
+        if entry is not None:
+            self._protected[uri] = entry
+            return entry
+
+        entry = self._probation.pop(uri, None)
+        if entry is None:
+            return None
+        self._protected[uri] = entry
+        self._protected_size += entry.size
+        while self._protected_size > self._max_protected:
+            old_uri, old = self._protected.popitem(last=False)
+            self._protected_size -= old.size
+            self._probation[old_uri] = old
+        return entry
+
+    ## Adds entry, replacing existing entry of uri.
+    # @param uri (str)
+    # @param entry (MemoryEntry)
+    # @returns (bool) whether entry was added.
+    #
+    def put(self, uri, entry):
+        self.remove(uri)
+        if entry.size > self._max_size:
+            return False
+        self._probation[uri] = entry
+        self._size += entry.size
+        while self._size > self._max_size:
+            if self._probation:
+                old_uri, old = self._probation.popitem(last=False)
+            else:
+                old_uri, old = self._protected.popitem(last=False)
+                self._protected_size -= old.size
+            self._size -= old.size
+        return uri in self
+
+    ## Removes entry.
+    # @param uri (str)
+    # @returns (MemoryEntry) removed entry, None if not in memory.
+    #
+    def remove(self, uri):
+        entry = self._probation.pop(uri, None)
+        if entry is None:
+            entry = self._protected.pop(uri, None)
+            if entry is None:
+                return None
+            self._protected_size -= entry.size
+        self._size -= entry.size
+        return entry
+
+    ## Removes all entries.
+    #
+    def clear(self):
+        self._probation.clear()
+        self._protected.clear()
+        self._size = 0
+        self._protected_size = 0
@@ -4,9 +4,20 @@
 # Implementation of @ref proxy.pollable
 #
 
+## Deadlines a pollable may have
+(
+    CONNECT_TIMEOUT,
+    FIRST_BYTE_TIMEOUT,
+    IDLE_TIMEOUT,
+    TOTAL_TIMEOUT,
+) = range(4)
+
 
 ## Pollable interface.
 class Pollable(object):
+    ## Deadlines armed by the poller when pollable is registered.
+    timeouts = ()
+
     def on_read(self, poller, args):
         pass
 
@@ -16,6 +27,9 @@ class Pollable(object):
     def on_error(self):
         pass
 
+    def on_timeout(self, kind):
+        pass
+
     def get_fd(self):
         pass
 
@@ -4,27 +4,254 @@
 # Implementation of @ref proxy.poller
 #
 
+import errno
+import functools
+import pollable
 import select
+import timers
 import traceback
 
 
 ## Poller object for creating poll and registering pollables to it.
 #
 # Created from __main__.
+# Keeps one long-lived epoll (or poll, where epoll is not available) object
+# and a registry of pollables keyed by fd.
+# Interest masks are re-evaluated only for pollables that were dispatched
+# (and their peers), so a loop turn costs O(ready fds) and not O(open fds).
+# Poll timeout is taken from the next deadline of the timer wheel.
 #
 class Poller():
     ## Constructor.
     # @param logger (logging.Logger)
+    # @param timeouts (dict) deadline kind -> seconds, 0 disables deadline.
     #
-    def __init__(self, logger):
-        self._pollables = []
+    def __init__(self, logger, timeouts=None):
+        # fd -> pollable
+        self._pollables = {}
+        # pollable -> fd it was registered with
+        self._fds = {}
+        # fd -> registered events
+        self._events = {}
+        # pollables whose events should be re-evaluated
+        self._dirty = set()
+        # pollables removed during current dispatch pass
+        self._removed = set()
+        # pollables that should read buffered data without a POLLIN event
+        self._wakeups = set()
+        self._dispatching = False
         self._logger = logger
+        self._timers = timers.TimerWheel()
+        self._timeouts = timeouts or {}
+        # pollable -> {deadline kind: timer}
+        self._deadlines = {}
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+        else:
+            self._poll = select.poll()
 
     ## Register pollable to poll.
     # @param pollable (Pollable)
     #
     def register(self, pollable):
-        self._pollables.append(pollable)
+        fd = pollable.get_fd()
+        events = pollable.get_events()
+        old = self._pollables.get(fd)
+        try:
+            # fd may be reused by a new object before the old one was removed.
+            if old is not None:
+                self._poll.modify(fd, events)
+            else:
+                self._poll.register(fd, events)
+        except (IOError, OSError):
+            self._poll.register(fd, events)
+        if old is not None and old is not pollable:
+            # Old object lost its fd, its own removal becomes a no-op.
+            self._fds.pop(old, None)
+            for timer in self._deadlines.pop(old, {}).values():
+                self._timers.cancel(timer)
+        self._removed.discard(pollable)
+        self._pollables[fd] = pollable
+        self._fds[pollable] = fd
+        self._events[fd] = events
+        for kind in pollable.timeouts:
+            if kind not in self._deadlines.get(pollable, {}):
+                self.set_timeout(pollable, kind)
+
+    ## Remove pollable from poll.
+    # During a dispatch pass removal is deferred to the end of the pass, so
+    # pending events of the same pass are not delivered to removed objects.
+    # @param pollable (Pollable)
+    #
+    def unregister(self, pollable):
+        if self._dispatching:
+            self._removed.add(pollable)
+        else:
+            self._remove(pollable)
+
+    ## Remove pollable from registry and from poll.
+    # @param pollable (Pollable)
+    #
+    def _remove(self, pollable):
+        self._dirty.discard(pollable)
+        self._wakeups.discard(pollable)
+        for timer in self._deadlines.pop(pollable, {}).values():
+            self._timers.cancel(timer)
+        fd = self._fds.pop(pollable, None)
+        if fd is None or self._pollables.get(fd) is not pollable:
+            return
+        del self._pollables[fd]
+        del self._events[fd]
+        try:
+            self._poll.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # Socket was already closed, kernel dropped it.
+            pass
+
+    ## Returns all registered pollables.
+    # @returns (list) pollables.
+    #
+    def pollables(self):
+        return self._pollables.values()
+
+    ## Arm a timer.
+    # @param delay (float) seconds until expiration.
+    # @param callback (callable) called when timer expires, may return a
+    # pollable to be removed from poll.
+    # @returns (Timer) timer handle.
+    #
+    def arm_timer(self, delay, callback):
+        return self._timers.arm(delay, callback)
+
+    ## Cancel a timer.
+    # @param timer (Timer) timer handle.
+    #
+    def cancel_timer(self, timer):
+        self._timers.cancel(timer)
+
+    ## Arm (or re-arm) pollable deadline.
+    # @param pollable (Pollable)
+    # @param kind (int) deadline kind.
+    # @param delay (float) seconds, default is the configured timeout.
+    #
+    def set_timeout(self, pollable, kind, delay=None):
+        if delay is None:
+            delay = self._timeouts.get(kind)
+        self.clear_timeout(pollable, kind)
+        if delay:
+            self._deadlines.setdefault(pollable, {})[kind] = self._timers.arm(
+                delay,
+                functools.partial(self._on_deadline, pollable, kind),
+            )
+
+    ## Cancel pollable deadline.
+    # @param pollable (Pollable)
+    # @param kind (int) deadline kind.
+    #
+    def clear_timeout(self, pollable, kind):
+        timer = self._deadlines.get(pollable, {}).pop(kind, None)
+        if timer is not None:
+            self._timers.cancel(timer)
+
+    ## Called when pollable deadline expires.
+    # @param pollable (Pollable)
+    # @param kind (int) deadline kind.
+    # @returns (Pollable) object to be removed from poll.
+    #
+    def _on_deadline(self, pollable, kind):
+        self._deadlines.get(pollable, {}).pop(kind, None)
+        self._logger.debug('Deadline %s expired for %s', kind, pollable)
+        self.touch(pollable)
+        self.touch(getattr(pollable, '_peer', None))
+        return pollable.on_timeout(kind)
+
+    ## Update deadlines of pollable after an event.
+    # Connect deadline is over once the socket is usable, idle deadline is
+    # restarted on every event.
+    # @param entry (Pollable)
+    #
+    def _on_activity(self, entry):
+        deadlines = self._deadlines.get(entry)
+        if deadlines:
+            if pollable.CONNECT_TIMEOUT in deadlines:
+                self.clear_timeout(entry, pollable.CONNECT_TIMEOUT)
+            if pollable.IDLE_TIMEOUT in deadlines:
+                self.set_timeout(entry, pollable.IDLE_TIMEOUT)
+
+    ## Calls a pollable handler.
+    # @param entry (Pollable) object handler belongs to.
+    # @param function (callable) handler.
+    # @returns (Pollable) object to be removed from poll.
+    #
+    def _call(self, entry, function, *args):
+        try:
+            return function(*args)
+        except Exception as e:
+            traceback.print_exc()
+            self._logger.error(
+                'Poller caghut error %s',
+                e,
+            )
+            return entry
+
+    ## Wait for events.
+    # @param timeout (float) seconds, None to wait forever.
+    # @returns (list) of (fd, event) tuples.
+    #
+    def _wait(self, timeout):
+        try:
+            if hasattr(select, 'epoll') and isinstance(
+                self._poll,
+                select.epoll,
+            ):
+                return self._poll.poll(-1 if timeout is None else timeout)
+            return self._poll.poll(
+                None if timeout is None else int(timeout * 1000)
+            )
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+    ## Mark pollable for events re-evaluation.
+    # Used when pollable state was changed outside of its own dispatch.
+    # @param pollable (Pollable)
+    #
+    def touch(self, pollable):
+        if pollable:
+            self._dirty.add(pollable)
+
+    ## Schedule a read of pollable in the next loop turn.
+    # Used when pollable already holds unprocessed input in user space, so
+    # POLLIN would not be reported for it.
+    # @param pollable (Pollable)
+    #
+    def wakeup(self, pollable):
+        self._wakeups.add(pollable)
+
+    ## Re-evaluate events of dirty pollables, update poll when changed.
+    # Pollable whose fd cannot be updated (it was closed) gets an error and
+    # is removed, the others are updated all the same.
+    #
+    def update_events(self):
+        dirty, self._dirty = self._dirty, set()
+        for entry in dirty:
+            fd = self._fds.get(entry)
+            if fd is None:
+                continue
+            try:
+                events = entry.get_events()
+                if events != self._events[fd]:
+                    self._poll.modify(fd, events)
+                    self._events[fd] = events
+            except (IOError, OSError) as e:
+                self._logger.error(
+                    'Cannot update events of %s: %s, removing',
+                    entry,
+                    e,
+                )
+                self._call(entry, entry.on_error)
+                self._remove(entry)
 
     ## Run the poll.
     # @param args (dict)
@@ -32,39 +259,63 @@ class Poller():
     def run(self, args):
         while True:
             to_remove = []
+            self.update_events()
+            events = self._wait(
+                0 if self._wakeups else self._timers.next_timeout()
+            )
+            self._dispatching = True
             try:
-                poll = select.poll()
-                objects = {}
-                for entry in self._pollables:
-                    objects[entry.get_fd()] = entry
-                    poll.register(entry.get_fd(), entry.get_events())
-                self._logger.debug('Pollables registered %s', objects)
-
-                for fd, event in poll.poll():
+                for fd, event in events:
                     self._logger.debug('Poll wake: %s, event: %s', fd, event)
+                    entry = self._pollables.get(fd)
+                    if entry is None or entry in self._removed:
+                        continue
+
                     if event & select.POLLERR:
-                        to_remove.append(objects[fd].on_error())
+                        to_remove.append(self._call(entry, entry.on_error))
 
                     elif event & select.POLLIN:
-                        to_remove.append(objects[fd].on_read(self, args))
+                        self._on_activity(entry)
+                        to_remove.append(
+                            self._call(entry, entry.on_read, self, args)
+                        )
 
                     elif event & select.POLLHUP:
-                        to_remove.append(objects[fd].on_hup())
+                        to_remove.append(self._call(entry, entry.on_hup))
 
                     elif event & select.POLLOUT:
-                        to_remove.append(objects[fd].on_write())
+                        self._on_activity(entry)
+                        to_remove.append(self._call(entry, entry.on_write))
 
-            except Exception as e:
-                traceback.print_exc()
-                self._logger.error(
-                    'Poller caghut error %s',
-                    e,
-                )
-                to_remove.append(objects[fd])
+                    self.touch(entry)
+                    self.touch(getattr(entry, '_peer', None))
+
+                wakeups, self._wakeups = self._wakeups, set()
+                removed = set(to_remove)
+                for entry in wakeups:
+                    if (
+                        entry not in self._fds or
+                        entry in removed or
+                        entry in self._removed
+                    ):
+                        continue
+                    self._logger.debug('Poll wakeup: %s', entry)
+                    to_remove.append(
+                        self._call(entry, entry.on_read, self, args)
+                    )
+                    self.touch(entry)
+                    self.touch(getattr(entry, '_peer', None))
+
+                for timer in self._timers.expire():
+                    to_remove.append(self._call(None, timer.callback))
 
             finally:
-                if to_remove:
+                self._dispatching = False
+                to_remove = [entry for entry in to_remove if entry is not None]
+                if to_remove or self._removed:
                     self._logger.debug('Removing from poll %s', to_remove)
                     for entry in to_remove:
-                        if entry in self._pollables:
-                            self._pollables.remove(entry)
+                        self._remove(entry)
+                    removed, self._removed = self._removed, set()
+                    for entry in removed:
+                        self._remove(entry)
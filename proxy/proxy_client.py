@@ -4,13 +4,19 @@
 # Implementation of @ref proxy.proxy_client
 #
 
+import chunked
 import constants
 import errno
 import fcntl
+import freshness
+import functools
+import http_parser
 import os
 import pollable
 import select
+import send_buffer
 import socket
+import time
 import util
 
 ## States for parsing HTTP response
@@ -26,19 +32,112 @@ import util
 #
 # Created from ProxySocket class.
 # Sends requests to the destination server and parse his response.
+# Fetch of a cacheable request can lead other requests of the same url, so
+# they do not fetch it again. A cached response is relayed to these
+# followers as it arrives, unless it varies on request headers, otherwise
+# they fetch it on their own. Fetch leads until the cache entry is complete,
+# follower that comes once content was received first replays it from the
+# cache fill file. Fetch goes on for its followers if its own peer is gone.
+# Request that revalidates a stale cache entry is conditional, a 304 response
+# refreshes the entry, which is then served to peer and followers. Fetch can
+# be detached from its peer, to revalidate an entry that peer is served
+# meanwhile. Stale entry is also served to peer if fetch fails before the
+# response head was sent, and entry may be used on error.
 #
 class ProxyClientSocket(pollable.Pollable):
+    ## Deadlines armed by the poller.
+    timeouts = (
+        pollable.CONNECT_TIMEOUT,
+        pollable.FIRST_BYTE_TIMEOUT,
+        pollable.IDLE_TIMEOUT,
+        pollable.TOTAL_TIMEOUT,
+    )
+
     ## Constructor.
+    # An idle connection to the destination is reused when there is one,
+    # otherwise connection is made once the destination address is resolved.
     # @param address - desitnation address (str)
     # @param port - bind port (int)
     # @param peer - ProxySocket class (ProxySocket)
+    # @param poll object (poll).
     # @param application_context (dict)
     # @param logger (logging.Logger)
+    # @param pooled (bool) whether an idle pooled connection may be used.
     #
-    def __init__(self, address, port, peer, application_context, logger):
+    def __init__(
+        self,
+        address,
+        port,
+        peer,
+        poll,
+        application_context,
+        logger,
+        pooled=True,
+    ):
         self._state = REQUEST_STATE
         self._peer = peer
+        self._request_context = peer._request_context
+        self._cache = peer._cache
         self._logger = logger
+        self._to_send = send_buffer.SendBuffer()
+        self._received = ''
+        self._status_line = ''
+        self._headers = http_parser.Headers()
+        self._application_context = application_context
+        self._key = (address, port)
+        # Status code of response.
+        self._status_code = ''
+        # Response content bytes that were not received yet, None if
+        # response is chunked or ends when server closes connection.
+        self._content_left = None
+        # Decoder of chunked response content.
+        self._decoder = None
+        # Whether response that ends at close is sent chunked to peer.
+        self._rechunk = False
+        # Whether this response fills a cache entry.
+        self._caching = False
+        # Response head as stored in cache.
+        self._cache_head = ''
+        # Whether server keeps connection after response.
+        self._keep_alive = False
+        # Set once the whole response was received.
+        self._complete = False
+        # Set by peer once the whole request was passed to this socket.
+        self._request_complete = False
+        # Parser of response head being received.
+        self._parser = None
+        # Url this fetch leads, None if not leading.
+        self._fetch_uri = None
+        # ProxySocket objects waiting for this response.
+        self._followers = []
+        # Followers replaying content received before they came, follower ->
+        # [descriptor of cache fill file, bytes replayed].
+        self._replaying = {}
+        # Bytes of response content received so far.
+        self._content_received = 0
+        # Whether response head was relayed to followers.
+        self._head_relayed = False
+        # Set by peer when its connection is gone.
+        self._peer_closed = False
+        # Set once peer is served from cache, or by a retried fetch, instead
+        # of by this response.
+        self._peer_served = False
+        # Set when fetch goes on for the cache only.
+        self._detached = False
+        # Whether response head was sent to peer.
+        self._head_sent = False
+        # Set once any response byte was received.
+        self._response_started = False
+
+        self._socket = None
+        if pooled:
+            self._socket = application_context['pool'].checkout(self._key)
+        # Whether connection was taken from the pool.
+        self._reused = self._socket is not None
+        if self._reused:
+            poll.register(self)
+            return
+
         self._socket = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
@@ -48,18 +147,46 @@ class ProxyClientSocket(pollable.Pollable):
             fcntl.F_SETFL, fcntl.fcntl(self._socket.fileno(), fcntl.F_GETFL) |
             os.O_NONBLOCK,
         )
+        self._logger.debug(
+            'ProxyClientSocket object %s created' %
+            self._socket.fileno()
+        )
+        application_context['resolver'].resolve(
+            address,
+            functools.partial(self.connect, poll, address, port),
+        )
+
+    ## Connects to the destination server and registers to poll.
+    # Called by the resolver.
+    # @param poll object (poll).
+    # @param host (str) destination host name.
+    # @param port (int) destination port.
+    # @param address (str) resolved address, None if resolving failed.
+    #
+    def connect(self, poll, host, port, address):
+        if self._state == CLOSING_STATE:
+            # Peer is already gone.
+            self.close_socket()
+            return
+
+        if address is None:
+            self._logger.error(
+                'ProxyClientSocket %s cannot resolve %s',
+                self._socket.fileno(),
+                host,
+            )
+            self.fail(502, 'Bad Gateway')
+            poll.touch(self._peer)
+            self.close_socket()
+            return
+
         try:
             self._socket.connect((address, port))
         except socket.error as e:
             if e.errno != errno.EINPROGRESS:
                 self._state = CLOSING_STATE
-
-        self._to_send = ''
-        self._received = ''
-        self._status_line = ''
-        self._test = ''
-        self._headers = {}
-        self._application_context = application_context
+        poll.register(self)
+        poll.touch(self._peer)
 
     @property
     def socket(self):
@@ -93,175 +220,655 @@ class ProxyClientSocket(pollable.Pollable):
     # @returns (ProxyClientSocket) object to be removed from poll.
     #
     def on_read(self, poll, args):
-        while (self._state <= CLOSING_STATE and
+        while (self._state < CLOSING_STATE and
                 ProxyClientSocket.client_states[self._state]['function'](
                     self,
                     args,
                     poll,
                 )):
-            if self._state == CLOSING_STATE:
-                return self
-            self._state = ProxyClientSocket.client_states[self._state]['next']
-
+            if self._state != CLOSING_STATE:
+                self._state = ProxyClientSocket.client_states[
+                    self._state
+                ]['next']
+
+        if self._state == CLOSING_STATE:
+            self.closing_state(args, poll)
+            return self
         return None
 
-    ## Receives the status line from the destination server.
+    ## Receives the response head from the destination server.
+    # Whole head is parsed here, status line is handled. Interim (1xx)
+    # responses are relayed to peer, head of the final response is received
+    # after them.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def request_state(self, args, poll):
-        try:
-            self.add_buf()
-            line = self.check_if_line()
-        except RuntimeError:
-            self._state = CLOSING_STATE
-            return True
+        while True:
+            if self._parser is None:
+                self._parser = http_parser.HeadParser(
+                    max_size=args.max_head_size,
+                    max_headers=args.max_headers,
+                )
+            try:
+                if not self._received:
+                    self.add_buf()
+            except RuntimeError:
+                self._state = CLOSING_STATE
+                return True
+
+            data, self._received = self._received, ''
+            try:
+                if not self._parser.feed(data):
+                    return False
+            except http_parser.ParseError as e:
+                self._logger.error(
+                    'ProxyClientSocket %s invalid response head: %s',
+                    self._socket.fileno(),
+                    e,
+                )
+                self.fail(502, 'Bad Gateway')
+                self._state = CLOSING_STATE
+                return True
+            self._received = self._parser.rest
+            self._headers = self._parser.headers
+            line = self._parser.start_line
+            self._parser = None
 
-        if line:
             try:
                 signature, status_num, status = util.check_response(line)
             except RuntimeError:
-                self._peer._to_send = util.return_status(
-                    500,
-                    'Unsupported http request',
-                    '',
-                )
+                self.fail(500, 'Unsupported http request')
                 self._state = CLOSING_STATE
                 return True
-            to_send = (
-                '%s %s %s\r\n' % (
-                    signature,
-                    status_num,
-                    status,
-                )
-            ).encode('utf-8')
-            self._peer._to_send = to_send
-            self._test = to_send
-            self._status_line = to_send
-            return True
-        self.check_if_maxsize()
-        return False
+            self._status_line = '%s %s %s\r\n' % (
+                signature,
+                status_num,
+                status,
+            )
+            self._status_code = status_num
+            poll.clear_timeout(self, pollable.FIRST_BYTE_TIMEOUT)
+            if not self._status_code.startswith('1'):
+                return True
+            if self._status_code == '101':
+                # Protocol switch is not supported, Upgrade is not passed.
+                self.fail(502, 'Bad Gateway')
+                self._state = CLOSING_STATE
+                return True
+            self.relay_interim()
+
+    ## Relays interim (1xx) response to peer, as it was received.
+    # Interim response has no content and does not end the exchange, such as
+    # 100 Continue to a request with Expect.
+    #
+    def relay_interim(self):
+        if self.sends_to_peer():
+            head = self._status_line
+            for key, value in self._headers.items():
+                head += '%s: %s\r\n' % (key, value)
+            self._peer._to_send += head + constants.CRLF
+        self._status_line = ''
+        self._status_code = ''
+        self._headers = http_parser.Headers()
 
-    ## Receives response headers from the destination server.
+    ## Handles response headers, they were parsed with the status line.
+    # Status line is sent to peer here, unless response revalidated a stale
+    # cache entry.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def headers_state(self, args, poll):
-        line = ' '
-        if constants.CRLF not in self._received:
-            self.add_buf()
-        while line and self._received[:2] != constants.CRLF:
-            line = self.check_if_line()
-            if line:
-                self._headers = util.update_headers(
-                    line,
-                    self._headers,
-                )
-        check_header = self._peer._cache.check_headers(
-            self._headers
+        try:
+            if chunked.is_chunked(self._headers) and not self.bodiless():
+                self._decoder = chunked.ChunkedDecoder()
+            else:
+                self._content_left = self.get_content_length()
+        except ValueError:
+            self._logger.error(
+                'ProxyClientSocket %s invalid Content-Length',
+                self._socket.fileno(),
+            )
+            self.fail(502, 'Bad Gateway')
+            self._state = CLOSING_STATE
+            return True
+        self._keep_alive = util.is_keep_alive(
+            self._status_line,
+            self._headers,
+        )
+        # Response that ends when server closes connection is chunked
+        # for a persistent client.
+        self._rechunk = (
+            self._decoder is None and
+            self._content_left is None and
+            self._peer._keep_alive
+        )
+
+        stale = self._request_context['stale_entry']
+        if stale is not None:
+            if self._status_code == '304':
+                self.revalidated(poll)
+                return True
+            if self._status_code.startswith('5'):
+                # Response is drained, entry is kept.
+                self.serve_stale()
+                stale = None
+
+        check_header = self._cache.check_headers(
+            self._headers,
+            self._status_code,
+            self._request_context['method'],
+            self._request_context['headers'],
         )
         if check_header is not False:
-            self._peer._cache.create_files(
-                self._peer._request_context,
+            self._caching = self._cache.create_files(
+                self._request_context,
                 check_header,
+                freshness.vary_names(self._headers),
+                self._content_left,
             )
-            self._peer._cache.add_cache(
-                self._peer._request_context,
-                self._status_line,
+        if stale is not None and not self._caching:
+            # Stale entry was replaced by a response that is not cached.
+            self._cache.delete_cache(self._request_context['cache_key'])
+        head = self._status_line
+        self._cache_head = self._status_line
+        hop_by_hop = util.hop_by_hop_headers(self._headers)
+        for key, value in self._headers.items():
+            if key.lower() in hop_by_hop:
+                continue
+            to_send = '%s: %s\r\n' % (key, value)
+            head += to_send
+            # Cached content is stored decoded, with its exact length.
+            if key.lower() not in ('content-length', 'transfer-encoding'):
+                self._cache_head += to_send
+        if self._rechunk:
+            head += 'Transfer-Encoding: chunked\r\n'
+        if not self._peer._keep_alive:
+            head += 'Connection: close\r\n'
+        if self.sends_to_peer():
+            self._peer._to_send += head + constants.CRLF
+            self._head_sent = True
+
+        if self._caching and 'Vary' not in self._headers:
+            self.relay_head(poll)
+        else:
+            self.unlead()
+            self.release_followers()
+        if self.abandoned() or (self._detached and not self._caching):
+            self._state = CLOSING_STATE
+        return True
+
+    ## Handles 304 response to revalidation of a stale cache entry.
+    # Entry is refreshed and served to peer, followers look it up on their
+    # own.
+    # @param poll object (poll).
+    #
+    def revalidated(self, poll):
+        self._content_left = 0
+        self.unlead()
+        entry = self._cache.refresh(self._request_context, self._headers)
+        if self.sends_to_peer():
+            self._peer_served = True
+            self._peer.serve_from_cache(entry)
+        self.release_followers()
+        if self._peer_closed:
+            self._state = CLOSING_STATE
+
+    ## Checks whether response goes to peer.
+    # @returns (bool)
+    #
+    def sends_to_peer(self):
+        return not self._peer_closed and not self._peer_served
+
+    ## Checks whether nobody waits for the response any more.
+    # @returns (bool)
+    #
+    def abandoned(self):
+        return (
+            self._peer_closed and
+            not self._followers and
+            not self._detached
+        )
+
+    ## Lets fetch go on without its peer, for the cache only.
+    # Fetch keeps a copy of the request context, as peer goes on to serve
+    # its request from cache and to next requests.
+    #
+    def detach(self):
+        self._request_context = dict(
+            self._request_context,
+            cached_response=None,
+            cache_reader=None,
+        )
+        self._detached = True
+        self._peer_closed = True
+
+    ## Tells peer that response cannot be received.
+    # Request may be retried, or stale cache entry served instead, otherwise
+    # peer gets error response and is closed. Error response is 502 if none
+    # is given and nothing was sent to peer yet.
+    # @param code (int) status code of error response.
+    # @param reason (str) reason phrase of error response.
+    #
+    def fail(self, code=None, reason=None):
+        if code is None and self.retry():
+            return
+        if not self.sends_to_peer() or self.serve_stale():
+            return
+        if code is None and not self._head_sent and not self._peer._to_send:
+            code, reason = 502, 'Bad Gateway'
+        if code is not None:
+            self._peer._to_send = send_buffer.SendBuffer(
+                util.return_status(code, reason, ''),
             )
-        if self._received[:2] == '\r\n':  # or line == '':
-            self._received = self._received[2:]
-            for key in self._headers:
-                to_send = (
-                    '%s: %s\r\n' % (
-                        key,
-                        self._headers[key],
-                    )
-                ).encode('utf-8')
-                self._peer._to_send += to_send
-                self._test += to_send
-                self._peer._cache.add_cache(
-                    self._peer._request_context,
-                    to_send,
-                )
-            self._peer._to_send += constants.CRLF
-            self._peer._cache.add_cache(
-                self._peer._request_context,
-                constants.CRLF,
+        self._peer._closing = True
+
+    ## Sends request again on a new connection, if it may be.
+    # Pooled connection may be closed by the server just as it is reused.
+    # GET request whose whole request was passed on and that got no response
+    # byte is then retried once, on a fresh connection. New fetch takes over
+    # the followers.
+    # @returns (bool) whether request is retried.
+    #
+    def retry(self):
+        if not (
+            self._reused and
+            not self._response_started and
+            self._request_complete and
+            self._request_context['method'] == 'GET' and
+            self.sends_to_peer() and
+            not self._peer._closing
+        ):
+            return False
+        self._logger.info(
+            'ProxyClientSocket %s reused connection failed, retrying %s',
+            self._socket.fileno(),
+            self._request_context['uri'],
+        )
+        self._reused = False
+        uri = self._fetch_uri
+        self.unlead()
+        followers, self._followers = self._followers, []
+        self._peer_served = True
+        self._peer.fetch(self._peer._poll, pooled=False)
+        fetch = self._peer._peer
+        fetch._request_complete = True
+        self._peer._poll.touch(fetch)
+        if uri is not None:
+            fetch.lead(uri)
+        for follower in followers:
+            follower._leader = fetch
+            fetch.add_follower(follower)
+        return True
+
+    ## Serves stale cache entry to peer, if destination server failed.
+    # Only done before response head was sent, within stale-if-error time of
+    # entry.
+    # @returns (bool) whether peer is served from cache.
+    #
+    def serve_stale(self):
+        stale = self._request_context['stale_entry']
+        if (
+            stale is None or
+            self._head_sent or
+            not self.sends_to_peer() or
+            stale.stale_until('stale-if-error') < time.time()
+        ):
+            return False
+        self._logger.info(
+            'ProxyClientSocket %s serving stale %s',
+            self._socket.fileno(),
+            self._request_context['uri'],
+        )
+        self._peer_served = True
+        self._peer.serve_from_cache(stale)
+        return True
+
+    ## Called by peer when its connection is gone.
+    # Fetch is closed, unless it has followers.
+    #
+    def peer_closed(self):
+        self._peer_closed = True
+        if self.abandoned():
+            self._state = CLOSING_STATE
+
+    ## Makes later requests of url follow this fetch.
+    # @param uri (str) url.
+    #
+    def lead(self, uri):
+        self._fetch_uri = uri
+        self._application_context['fetches'][uri] = self
+
+    ## Stops taking new followers.
+    #
+    def unlead(self):
+        fetches = self._application_context['fetches']
+        if fetches.get(self._fetch_uri) is self:
+            del fetches[self._fetch_uri]
+        self._fetch_uri = None
+
+    ## Adds a request waiting for this response.
+    # Follower that comes after the head gets it right away, and replays
+    # content received so far from the cache fill file.
+    # @param follower (ProxySocket)
+    #
+    def add_follower(self, follower):
+        if self._head_relayed and self._content_received:
+            fd = self._cache.open_filling(self._request_context)
+            if fd is None:
+                # Fill was dropped, content received so far is gone.
+                follower.unfollow()
+                return
+            self._replaying[follower] = [fd, 0]
+        self._followers.append(follower)
+        if self._head_relayed:
+            self.send_head(follower)
+            follower._poll.touch(follower)
+
+    ## Removes a request that no longer waits for this response.
+    # @param follower (ProxySocket)
+    #
+    def remove_follower(self, follower):
+        if follower in self._followers:
+            self._followers.remove(follower)
+        self.stop_replay(follower)
+        if self.abandoned():
+            self._state = CLOSING_STATE
+
+    ## Lets go of all followers.
+    # Followers that did not get the head yet fetch on their own, the others
+    # are closed as the response was cut. Followers still replaying a
+    # complete response are kept.
+    #
+    def release_followers(self):
+        if self._complete:
+            return
+        followers, self._followers = self._followers, []
+        for follower in followers:
+            self.stop_replay(follower)
+            if self._head_relayed:
+                follower._leader = None
+                follower._closing = True
+                follower._poll.touch(follower)
+            else:
+                follower.unfollow()
+
+    ## Checks whether follower replays content received before it came.
+    # @param follower (ProxySocket)
+    # @returns (bool)
+    #
+    def replaying(self, follower):
+        return follower in self._replaying
+
+    ## Sends follower next part of content received before it came.
+    # Content is read from the cache fill file, as far as follower has room.
+    # Follower that caught up gets content as it arrives, or is done if the
+    # response is complete.
+    # @param follower (ProxySocket)
+    #
+    def replay(self, follower):
+        fd, offset = self._replaying[follower]
+        size = min(
+            constants.TO_SEND_MAXSIZE - len(follower._to_send),
+            self._content_received - offset,
+        )
+        if size <= 0:
+            return
+        self._cache.flush_filling(self._request_context)
+        try:
+            data = util.pread(fd, size, offset)
+        except OSError as e:
+            self._logger.error('Cannot replay content: %s', e)
+            data = ''
+        if not data:
+            # Content is cut, follower is closed.
+            self._followers.remove(follower)
+            self.stop_replay(follower)
+            follower._leader = None
+            follower._closing = True
+            follower._poll.touch(follower)
+            return
+        self._replaying[follower][1] += len(data)
+        self.send_content(follower, data, False)
+        if self._replaying[follower][1] == self._content_received:
+            self.stop_replay(follower)
+            if self._complete:
+                self._followers.remove(follower)
+                self.send_content(follower, '', True)
+
+    ## Stops replay of follower, if it replays.
+    # @param follower (ProxySocket)
+    #
+    def stop_replay(self, follower):
+        replay = self._replaying.pop(follower, None)
+        if replay is not None:
+            os.close(replay[0])
+
+    ## Checks whether follower gets content chunked.
+    # Response without length is chunked for a persistent follower.
+    # @param follower (ProxySocket)
+    # @returns (bool)
+    #
+    def follower_chunked(self, follower):
+        return follower._keep_alive and (
+            self._decoder is not None or self._content_left is None
+        )
+
+    ## Sends cached response head to followers.
+    # @param poll object (poll).
+    #
+    def relay_head(self, poll):
+        for follower in self._followers:
+            self.send_head(follower)
+            poll.touch(follower)
+        self._head_relayed = True
+
+    ## Sends cached response head to a follower.
+    # @param follower (ProxySocket)
+    #
+    def send_head(self, follower):
+        head = self._cache_head
+        if self._decoder is None and self._content_left is not None:
+            head += 'Content-Length: %s\r\n' % (
+                self._content_left + self._content_received
             )
+        elif self.follower_chunked(follower):
+            head += 'Transfer-Encoding: chunked\r\n'
+        if not follower._keep_alive:
+            head += 'Connection: close\r\n'
+        follower._to_send += head + constants.CRLF
+
+    ## Sends decoded content to followers.
+    # Followers that replay get it from the cache fill file later.
+    # @param content (str) content part.
+    # @param finished (bool) whether it is the last part.
+    # @param poll object (poll).
+    #
+    def relay_content(self, content, finished, poll):
+        for follower in self._followers:
+            if follower in self._replaying:
+                continue
+            self.send_content(follower, content, finished)
+            poll.touch(follower)
+        if finished:
+            self._followers = list(self._replaying)
+
+    ## Sends decoded content to a follower.
+    # @param follower (ProxySocket)
+    # @param content (str) content part.
+    # @param finished (bool) whether it is the last part.
+    #
+    def send_content(self, follower, content, finished):
+        if self.follower_chunked(follower):
+            for part in chunked.encode_chunk(content):
+                follower._to_send += part
+            if finished:
+                follower._to_send += chunked.LAST_CHUNK
+        else:
+            follower._to_send += content
+        if finished:
+            follower._leader = None
+            follower._response_complete = True
+
+    ## Checks whether some receiver of the response has too much to send.
+    # @returns (bool)
+    #
+    def backlogged(self):
+        if (
+            self.sends_to_peer() and
+            len(self._peer._to_send) > constants.TO_SEND_MAXSIZE
+        ):
             return True
-        self.check_if_maxsize()
+        for follower in self._followers:
+            if (
+                follower not in self._replaying and
+                len(follower._to_send) > constants.TO_SEND_MAXSIZE
+            ):
+                return True
         return False
 
+    ## Checks whether response has no content, whatever its headers say.
+    # @returns (bool)
+    #
+    def bodiless(self):
+        return (
+            self._status_code.startswith('1') or
+            self._status_code in ('204', '304')
+        )
+
+    ## Returns length of response content.
+    # @returns (int) content length, None if response ends when server
+    # closes connection.
+    #
+    def get_content_length(self):
+        if self.bodiless():
+            return 0
+        length = self._headers.get('Content-Length')
+        if length is None:
+            return None
+        length = int(length)
+        if length < 0:
+            raise ValueError('Negative Content-Length')
+        return length
+
     ## Receives responses content part from the destination server.
+    # Content is relayed as it arrives, chunked content is decoded only for
+    # the cache and to find where it ends.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def content_state(self, args, poll):
-        finished = False
-        self._headers['Content-Length'] = int(
-            self._headers.get('Content-Length', 0)
-        )
-        is_content = self._headers['Content-Length'] == 0
-        # if len(self._peer._to_send) > constants.TO_SEND_MAXSIZE:
-        #    return False
-        t = ''
-        try:
-            t = self._socket.recv(constants.BLOCK_SIZE)
-        except socket.error as e:
-            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+        eof = False
+        if (
+            not self._received and
+            (self._decoder is not None or self._content_left != 0)
+        ):
+            try:
+                self._received = self._socket.recv(constants.BLOCK_SIZE)
+            except socket.error as e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return False
                 self._logger.error(
                     'ProxyClientSocket %s socket error: %s',
                     self._socket.fileno(),
                     e,
                 )
                 self._state = CLOSING_STATE
-                finished = True
-
-        if not t and is_content:
-            finished = True
-
-        self._received += t
-        self._peer._to_send += self._received
-        self._test += self._received
-        self._peer._cache.add_cache(
-            self._peer._request_context,
-            self._received,
-        )
-        if self._headers['Content-Length'] != 0:
-            self._headers['Content-Length'] -= len(self._received)
-        self._received = ''
-
-        if self._headers['Content-Length'] == 0 and not is_content:
-            finished = True
-
-        if finished:
-            if (
-                self._peer._request_context['uri'] in
-                self._peer._cache._opened_files
-            ):
-                self._peer._cache._opened_files[
-                    self._peer._request_context['uri']
-                ].close()
-                del self._peer._cache._opened_files[
-                    self._peer._request_context['uri']
-                ]
+                return True
 
-            return True
+            if not self._received:
+                if self._decoder is not None or self._content_left is not None:
+                    self._logger.error(
+                        'ProxyClientSocket %s response was cut',
+                        self._socket.fileno(),
+                    )
+                    self._state = CLOSING_STATE
+                    return True
+                eof = True
+                self._keep_alive = False
 
-        return False
+        if self._decoder is not None:
+            try:
+                content, consumed = self._decoder.decode(self._received)
+            except ValueError as e:
+                self._logger.error(
+                    'ProxyClientSocket %s invalid chunked content: %s',
+                    self._socket.fileno(),
+                    e,
+                )
+                self._state = CLOSING_STATE
+                return True
+            data = self._received[:consumed]
+            finished = self._decoder.done
+        elif self._content_left is not None:
+            data = content = self._received[:self._content_left]
+            self._content_left -= len(data)
+            finished = self._content_left == 0
+        else:
+            data = content = self._received
+            finished = eof
+        self._received = self._received[len(data):]
+
+        if not self.sends_to_peer():
+            # Content is only received for cache and followers.
+            pass
+        elif self._rechunk:
+            for part in chunked.encode_chunk(content):
+                self._peer._to_send += part
+            if finished:
+                self._peer._to_send += chunked.LAST_CHUNK
+        else:
+            self._peer._to_send += data
+        if self._caching:
+            self._cache.add_cache(self._request_context, content)
+        self._content_received += len(content)
+        if self._followers:
+            self.relay_content(content, finished, poll)
+
+        if not finished:
+            return False
+
+        self._complete = True
+        if self._caching:
+            self._cache.finish_cache(
+                self._request_context,
+                self._cache_head,
+            )
+            self._caching = False
+        self.unlead()
+        return True
 
     ## Final state. Finished receiving. Ready to close socket.
+    # Peer is told whether response is complete. Connection goes back to
+    # pool if the whole exchange completed cleanly.
     # @param args (dict) program arguments.
     # @param poll object (poll).
     # @returns (boll) if ready to move to next state.
     #
     def closing_state(self, args, poll):
-        self._peer._closing = True
-        self.close_socket()
+        if self._caching:
+            self._cache.abort_cache(self._request_context)
+            self._caching = False
+        if self._complete and self._request_complete:
+            if self.sends_to_peer():
+                self._peer._response_complete = True
+        else:
+            self.fail()
+        if (
+            self._complete and
+            self._keep_alive and
+            self._request_complete and
+            not self._to_send and
+            not self._received
+        ):
+            self._application_context['pool'].release(
+                self._key,
+                self._socket,
+            )
+        else:
+            self.close_socket()
         return True
 
     ## dict of client state machine.
@@ -291,7 +898,10 @@ class ProxyClientSocket(pollable.Pollable):
     # @returns (ProxyClientSocket) object to be removed from poll.
     #
     def on_write(self):
-        self._to_send = self.send_all()
+        try:
+            self.send_all()
+        except socket.error:
+            return self.on_error()
         return None
 
     ## Function to be called when poller have a POLLERR event.
@@ -299,9 +909,8 @@ class ProxyClientSocket(pollable.Pollable):
     # @returns (ProxyClientSocket) object to be removed from poll.
     #
     def on_error(self):
+        self.fail()
         self.close_socket()
-        if self._peer:
-            self._peer._closing = True
         return self
 
     ## Function to be called when poller have a POLLHUP event.
@@ -309,11 +918,25 @@ class ProxyClientSocket(pollable.Pollable):
     # @returns (ProxyClientSocket) object to be removed from poll.
     #
     def on_hup(self):
+        self.fail()
         self.close_socket()
-        if self._peer:
-            self._peer._closing = True
         return self
 
+    ## Function to be called when a deadline expires.
+    # If no response was received yet, peer gets a gateway timeout error.
+    # @param kind (int) deadline kind.
+    # @returns (ProxyClientSocket) object to be removed from poll.
+    #
+    def on_timeout(self, kind):
+        self._logger.error(
+            'ProxyClientSocket %s deadline %s expired',
+            self._socket.fileno(),
+            kind,
+        )
+        if self._state == REQUEST_STATE:
+            self.fail(504, 'Gateway Timeout')
+        return self.on_error()
+
     ## Returns sockets file discriptor.
     # @returns (str) sockets file discriptor.
     #
@@ -330,35 +953,33 @@ class ProxyClientSocket(pollable.Pollable):
             self._state <= CLOSING_STATE
         ):
             events |= select.POLLIN
-            if self._peer:
-                if len(self._peer._to_send) > constants.TO_SEND_MAXSIZE:
-                    events = select.POLLERR
+            if self.backlogged():
+                events = select.POLLERR
 
         if self._to_send:
             events |= select.POLLOUT
         return events
 
     ## Closing socket.
+    # Followers of an incomplete response are let go.
     #
     def close_socket(self):
         self._logger.debug(
             'ProxyClientSocket socket %s is closing' %
             self._socket.fileno()
         )
+        self.unlead()
+        self.release_followers()
         self._socket.close()
 
     ## Sends everything possible from to_send buffer.
-    # @returns (str) string from buffer that couldn't be sent.
     #
     def send_all(self):
         try:
-            buf = self._to_send
-            while buf:
-                bytes_sent = self._socket.send(buf)
-                self._application_context[
-                    'statistics'
-                ]['throughput'][0] += bytes_sent
-                buf = buf[bytes_sent:]
+            bytes_sent = self._to_send.send(self._socket)
+            self._application_context[
+                'statistics'
+            ]['throughput'][0] += bytes_sent
 
         except socket.error as e:
             if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
@@ -369,8 +990,6 @@ class ProxyClientSocket(pollable.Pollable):
                 )
                 raise
 
-        return buf
-
     # Receives string from socket and adds it to received buffer.
     # @param max_length (int) max header length.
     # @param blocksize (int) length of bytes to receive.
@@ -385,6 +1004,7 @@ class ProxyClientSocket(pollable.Pollable):
             if not t:
                 raise RuntimeError('Disconnect')
             self._received += t
+            self._response_started = True
 
         except socket.error as e:
             if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
@@ -394,30 +1014,3 @@ class ProxyClientSocket(pollable.Pollable):
                     e,
                 )
                 raise RuntimeError('Disconnect')
-
-    ## Checks if theres a line in the received buffer, and returns it.
-    # @returns (str) line that was found in received buffer.
-    #
-    def check_if_line(self):
-        buf = self._received
-        n = buf.find(constants.CRLF_BIN)
-        if n == -1:
-            return None
-        line = buf[:n].decode('utf-8')
-        self._received = buf[n + len(constants.CRLF_BIN):]
-        return line
-
-    ## Checks if received buffer length exceeded max request/response length.
-    # If true, closing socket and sending error message.
-    # @returns (bool) whether buffer exceeded max length.
-    #
-    def check_if_maxsize(self):
-        if len(self._received) > constants.MAX_REQ_SIZE:
-            self._peer._to_send = util.return_status(500, 'Internal Error', '')
-            self._state = CLOSING_STATE
-            self._logger.error(
-                'ProxyClientSocket %s received-buffer reached max-size',
-                self._socket.fileno(),
-            )
-            return True
-        return False
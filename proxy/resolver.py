@@ -0,0 +1,459 @@
+## @package proxy.resolver
+# Module for Resolver object.
+## @file resolver.py
+# Implementation of @ref proxy.resolver
+#
+
+import collections
+import constants
+import errno
+import fcntl
+import functools
+import os
+import pollable
+import random
+import select
+import socket
+import struct
+import time
+
+## DNS record types
+(
+    TYPE_A,
+    TYPE_CNAME,
+    TYPE_SOA,
+) = (1, 5, 6)
+## DNS class internet.
+CLASS_IN = 1
+## DNS response code for non existing domain.
+RCODE_NXDOMAIN = 3
+
+
+## Checks whether host is an IPv4 address.
+# @param host (str)
+# @returns (bool)
+#
+def is_address(host):
+    try:
+        socket.inet_aton(host)
+    except socket.error:
+        return False
+    return host.count('.') == 3
+
+
+## Builds DNS query for A record.
+# @param query_id (int)
+# @param host (str)
+# @returns (str) query packet.
+#
+def build_query(query_id, host):
+    query = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    for label in host.rstrip('.').encode('idna').split('.'):
+        if not label or len(label) > 63:
+            raise ValueError('Invalid host name %s' % host)
+        query += struct.pack('!B', len(label)) + label
+    return query + struct.pack('!BHH', 0, TYPE_A, CLASS_IN)
+
+
+## Reads a (possibly compressed) name from DNS packet.
+# @param data (str) packet.
+# @param offset (int) name offset.
+# @returns (tuple) name, offset after name.
+#
+def read_name(data, offset):
+    labels = []
+    end = None
+    for i in range(constants.DNS_MAX_POINTERS):
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+        elif length == 0:
+            if end is None:
+                end = offset + 1
+            return '.'.join(labels).lower(), end
+        else:
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+    raise ValueError('DNS name pointer loop')
+
+
+## Parses DNS response.
+# Response must answer the query, its question is the one that was sent.
+# @param data (str) packet.
+# @param host (str) host that was queried.
+# @returns (tuple) query id, address (None if not found), ttl (int).
+#
+def parse_response(data, host):
+    (
+        query_id,
+        flags,
+        qdcount,
+        ancount,
+        nscount,
+        arcount,
+    ) = struct.unpack('!HHHHHH', data[:12])
+    name = host.rstrip('.').lower()
+    if not flags & 0x8000 or qdcount != 1:
+        raise ValueError('Not a response to a single question')
+    question, offset = read_name(data, 12)
+    if (
+        question != name or
+        struct.unpack('!HH', data[offset:offset + 4]) != (TYPE_A, CLASS_IN)
+    ):
+        raise ValueError('Response to another question %s' % question)
+    offset += 4
+
+    addresses = {}
+    aliases = {}
+    ttl = constants.DNS_NEGATIVE_TTL
+    for i in range(ancount + nscount):
+        record_name, offset = read_name(data, offset)
+        rtype, rclass, rttl, length = struct.unpack(
+            '!HHIH',
+            data[offset:offset + 10],
+        )
+        offset += 10
+        rdata = data[offset:offset + length]
+        if rclass == CLASS_IN:
+            if rtype == TYPE_A and length == 4:
+                addresses.setdefault(
+                    record_name,
+                    (socket.inet_ntoa(rdata), rttl),
+                )
+            elif rtype == TYPE_CNAME:
+                aliases[record_name] = (read_name(data, offset)[0], rttl)
+            elif rtype == TYPE_SOA:
+                # negative answer is cached for min(SOA ttl, SOA minimum).
+                ttl = min(rttl, struct.unpack('!I', rdata[-4:])[0])
+        offset += length
+
+    if flags & 0x000f == RCODE_NXDOMAIN:
+        return query_id, None, ttl
+
+    min_ttl = None
+    for i in range(constants.DNS_MAX_POINTERS):
+        if name in addresses:
+            address, rttl = addresses[name]
+            return query_id, address, min(rttl, min_ttl or rttl)
+        if name not in aliases:
+            break
+        name, rttl = aliases[name]
+        min_ttl = min(rttl, min_ttl or rttl)
+    return query_id, None, ttl
+
+
+## Asynchronous DNS resolver.
+#
+# Created by __main__, one per worker.
+# Sends UDP queries to the name server from within the poll loop, so a slow
+# lookup does not block other connections. Answers are cached according to
+# their TTL, failures are cached as well (negative cache).
+# Names in the hosts file are resolved without a query.
+# Search domains of resolv.conf are appended to short names, the candidate
+# names are queried one after the other until one is found.
+#
+class Resolver(pollable.Pollable):
+    ## Constructor.
+    # @param poll (Poller) poll object, used for query timeouts.
+    # @param server (str) name server, host[:port], None for the system one.
+    # @param logger (logging.Logger)
+    #
+    def __init__(self, poll, server, logger):
+        self._poll = poll
+        self._logger = logger
+        resolv_conf = self.load_resolv_conf()
+        self._search = resolv_conf['search']
+        self._ndots = resolv_conf['ndots']
+        if server is None:
+            server = resolv_conf['nameserver']
+        if server is None:
+            self._logger.warning(
+                'No name server in %s, using %s',
+                constants.RESOLV_CONF_FILE,
+                constants.DEFAULT_DNS_SERVER,
+            )
+            server = constants.DEFAULT_DNS_SERVER
+        self._server = self.parse_server(server)
+        self._hosts = self.load_hosts()
+        # host -> (expiration time, address or None)
+        self._cache = collections.OrderedDict()
+        # host -> query context
+        self._queries = {}
+        # query id -> host
+        self._ids = {}
+        self._socket = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_DGRAM,
+        )
+        fcntl.fcntl(
+            self._socket.fileno(),
+            fcntl.F_SETFL, fcntl.fcntl(self._socket.fileno(), fcntl.F_GETFL) |
+            os.O_NONBLOCK,
+        )
+
+    ## Loads system resolver configuration from resolv.conf.
+    # Last of search and domain lines wins, without either the domain of
+    # the local host name is searched.
+    # @returns (dict) nameserver (str, first one, None if there is none),
+    # search (list) domains, ndots (int).
+    #
+    def load_resolv_conf(self):
+        resolv_conf = {
+            'nameserver': None,
+            'search': None,
+            'ndots': constants.DNS_NDOTS,
+        }
+        try:
+            with open(constants.RESOLV_CONF_FILE) as f:
+                for line in f:
+                    comps = line.split('#', 1)[0].split(';', 1)[0].split()
+                    if len(comps) < 2:
+                        continue
+                    if comps[0] == 'nameserver':
+                        if (
+                            resolv_conf['nameserver'] is None and
+                            is_address(comps[1])
+                        ):
+                            resolv_conf['nameserver'] = comps[1]
+                    elif comps[0] == 'domain':
+                        resolv_conf['search'] = comps[1:2]
+                    elif comps[0] == 'search':
+                        resolv_conf['search'] = comps[1:]
+                    elif comps[0] == 'options':
+                        for option in comps[1:]:
+                            name, sep, value = option.partition(':')
+                            if name == 'ndots' and value.isdigit():
+                                resolv_conf['ndots'] = int(value)
+        except IOError:
+            self._logger.warning('Cannot read name servers')
+        if resolv_conf['search'] is None:
+            domain = socket.gethostname().partition('.')[2]
+            resolv_conf['search'] = [domain] if domain else []
+        resolv_conf['search'] = [
+            domain.rstrip('.').lower()
+            for domain in resolv_conf['search']
+            if domain.rstrip('.')
+        ]
+        return resolv_conf
+
+    ## Parses name server address.
+    # @param server (str) host[:port].
+    # @returns (tuple) address, port.
+    #
+    def parse_server(self, server):
+        address, port = ('%s:' % server).split(':', 1)
+        port = port.replace(':', '')
+        return address, int(port) if port else constants.DNS_PORT
+
+    ## Loads static names from hosts file.
+    # @returns (dict) host -> address.
+    #
+    def load_hosts(self):
+        hosts = {}
+        try:
+            with open(constants.HOSTS_FILE) as f:
+                for line in f:
+                    comps = line.split('#', 1)[0].split()
+                    if len(comps) > 1 and is_address(comps[0]):
+                        for name in comps[1:]:
+                            hosts.setdefault(name.lower(), comps[0])
+        except IOError:
+            self._logger.warning('Cannot read hosts file')
+        return hosts
+
+    ## Returns names to query for host, in order.
+    # Name with a trailing dot is queried as is. Name with fewer dots than
+    # ndots is tried with each search domain first, other names last.
+    # @param host (str) host name.
+    # @returns (list) names.
+    #
+    def candidates(self, host):
+        if host.endswith('.'):
+            return [host]
+        names = ['%s.%s' % (host, domain) for domain in self._search]
+        if host.count('.') >= self._ndots:
+            return [host] + names
+        return names + [host]
+
+    ## Resolves host name to IPv4 address.
+    # Callback is called with the address, or with None if host cannot be
+    # resolved. It may be called before this function returns.
+    # @param host (str) host name.
+    # @param callback (callable) called with resolved address.
+    #
+    def resolve(self, host, callback):
+        host = host.lower()
+        if is_address(host):
+            callback(host)
+            return
+        if host in self._hosts:
+            callback(self._hosts[host])
+            return
+
+        cached = self._cache.get(host)
+        if cached is not None:
+            if cached[0] > time.time():
+                callback(cached[1])
+                return
+            del self._cache[host]
+
+        if host in self._queries:
+            self._queries[host]['callbacks'].append(callback)
+            return
+
+        self._queries[host] = {
+            'callbacks': [callback],
+            'names': self.candidates(host),
+            'index': 0,
+            'tries': 0,
+            'id': None,
+            'timer': None,
+        }
+        self.send_query(host)
+
+    ## Sends (or resends) query for host.
+    # @param host (str) host name.
+    #
+    def send_query(self, host):
+        query = self._queries[host]
+        if query['tries'] >= constants.DNS_TRIES:
+            self._logger.error('DNS query for %s timed out', host)
+            self.finish(host, None, constants.DNS_NEGATIVE_TTL)
+            return
+        query['tries'] += 1
+        self._ids.pop(query['id'], None)
+        query['id'] = random.randint(0, 0xffff)
+        while query['id'] in self._ids:
+            query['id'] = random.randint(0, 0xffff)
+        self._ids[query['id']] = host
+        query['timer'] = self._poll.arm_timer(
+            constants.DNS_TIMEOUT,
+            functools.partial(self.send_query, host),
+        )
+
+        name = query['names'][query['index']]
+        try:
+            self._socket.sendto(build_query(query['id'], name), self._server)
+        except ValueError as e:
+            self._logger.error('DNS query for %s failed: %s', name, e)
+            if not self.next_name(host):
+                self.finish(host, None, constants.DNS_NEGATIVE_TTL)
+        except socket.error as e:
+            # query is retried when timer expires.
+            self._logger.error('DNS query for %s failed: %s', host, e)
+
+    ## Moves query on to the next candidate name of host.
+    # @param host (str) host name.
+    # @returns (bool) whether another name is queried.
+    #
+    def next_name(self, host):
+        query = self._queries[host]
+        if query['index'] + 1 >= len(query['names']):
+            return False
+        query['index'] += 1
+        query['tries'] = 0
+        if query['timer'] is not None:
+            self._poll.cancel_timer(query['timer'])
+            query['timer'] = None
+        self.send_query(host)
+        return True
+
+    ## Completes query, caches result and calls all waiting callbacks.
+    # @param host (str) host name.
+    # @param address (str) resolved address, None on failure.
+    # @param ttl (int) seconds to cache result.
+    #
+    def finish(self, host, address, ttl):
+        query = self._queries.pop(host)
+        self._ids.pop(query['id'], None)
+        if query['timer'] is not None:
+            self._poll.cancel_timer(query['timer'])
+
+        ttl = min(ttl, constants.DNS_MAX_TTL)
+        if ttl > 0:
+            self._cache[host] = (time.time() + ttl, address)
+            while len(self._cache) > constants.DNS_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        self._logger.debug('Resolved %s: %s (ttl %s)', host, address, ttl)
+        for callback in query['callbacks']:
+            try:
+                callback(address)
+            except Exception:
+                self._logger.exception('DNS callback for %s failed', host)
+
+    ## Function to be called when poller have a POLLIN event.
+    # Reads all available responses.
+    # @param poll object (poll).
+    # @param args (dict) program arguments.
+    # @returns (Resolver) object to be removed from poll.
+    #
+    def on_read(self, poll, args):
+        while True:
+            try:
+                data, address = self._socket.recvfrom(
+                    constants.DNS_MAX_PACKET_SIZE,
+                )
+            except socket.error as e:
+                if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    self._logger.error('Resolver socket error: %s', e)
+                return None
+
+            if address != self._server:
+                continue
+            try:
+                query_id = struct.unpack('!H', data[:2])[0]
+                host = self._ids.get(query_id)
+                if host is None:
+                    continue
+                query = self._queries[host]
+                query_id, resolved, ttl = parse_response(
+                    data,
+                    query['names'][query['index']],
+                )
+            except (ValueError, IndexError, struct.error) as e:
+                self._logger.error('Invalid DNS response: %s', e)
+                continue
+            if resolved is None and self.next_name(host):
+                continue
+            self.finish(host, resolved, ttl)
+
+    ## Function to be called when poller have a POLLOUT event.
+    # @returns (Resolver) object to be removed from poll.
+    #
+    def on_write(self):
+        return None
+
+    ## Function to be called when poller have a POLLERR event.
+    # Errors are reported by recvfrom, queries are retried on timeout.
+    # @returns (Resolver) object to be removed from poll.
+    #
+    def on_error(self):
+        try:
+            self._socket.recvfrom(constants.DNS_MAX_PACKET_SIZE)
+        except socket.error as e:
+            self._logger.error('Resolver socket error: %s', e)
+        return None
+
+    ## Returns poll events.
+    # @returns (int) poll events.
+    #
+    def get_events(self):
+        return select.POLLIN | select.POLLERR
+
+    ## Returns sockets file discriptor.
+    # @returns (str) sockets file discriptor.
+    #
+    def get_fd(self):
+        return self._socket.fileno()
+
+    ## Closing socket.
+    #
+    def close_socket(self):
+        self._logger.debug(
+            'Resolver socket %s is closing' %
+            self._socket.fileno()
+        )
+        self._socket.close()
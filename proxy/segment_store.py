@@ -0,0 +1,372 @@
+## @package proxy.segment_store
+# Module for Segment, SegmentStore objects.
+## @file segment_store.py
+# Implementation of @ref proxy.segment_store
+#
+
+import cache_reader
+import constants
+import errno
+import os
+import struct
+import time
+import util
+
+## Record header: magic, key length, head length, content length,
+# expiration date.
+RECORD_HEADER = struct.Struct('!4sIIIq')
+## Magic of record header.
+RECORD_MAGIC = 'PXS1'
+## Magic of deletion record header, record has the key only.
+DELETION_MAGIC = 'PXS0'
+
+
+## Segment file, shared by readers of all entries stored in it.
+#
+# Created by SegmentStore, which holds a reference until the segment is
+# retired, so the file is closed once its last reader is done.
+#
+class Segment(cache_reader.SharedFile):
+    ## Constructor.
+    # @param path (str) segment file.
+    # @param number (int) segment number.
+    #
+    def __init__(self, path, number):
+        super(Segment, self).__init__(
+            path,
+            os.O_RDWR | os.O_APPEND | os.O_CREAT,
+        )
+        self.path = path
+        self.number = number
+        # record start -> (key, record end), of records still indexed
+        self.records = {}
+        # Bytes of records still indexed.
+        self.live = 0
+        self.acquire()
+
+
+## Log-structured store of cache entries.
+#
+# Created by Cache, when entries are stored in segments.
+# Entries are appended as records to the active segment file, which is
+# replaced by a new one once large enough. A record holds the key, the head
+# and the content, and is located by (segment number, record start, record
+# end), kept in the cache index. Content is the end of its record.
+# Index snapshot is saved with a mark, the position the store reached.
+# Records appended after the mark are read back at startup, deleted entry
+# gets a deletion record, so it is not read back. Segments are compacted
+# only once they are before the mark.
+# Segments are only appended to, and are owned by a single worker, named by
+# its slot. Removed records leave dead space, segment that is mostly dead is
+# compacted: records still in use are copied to the active segment, and the
+# segment is retired. Segment numbers are taken from the clock, so a number
+# is not reused by a later segment.
+#
+class SegmentStore(object):
+    ## Constructor.
+    # @param path (str) directory of segment files.
+    # @param slot (int) worker slot, segments of other slots are left alone.
+    # @param segment_size (int) bytes after which a new segment is started.
+    #
+    def __init__(self, path, slot=0, segment_size=constants.SEGMENT_SIZE):
+        self._path = path
+        self._slot = slot
+        self._segment_size = segment_size
+        # number -> Segment
+        self._segments = {}
+        # Segment appended to, None until first append.
+        self._active = None
+        # Segment whose records are being copied by compaction.
+        self._compacting = None
+        # Position of last index snapshot, (segment number, offset), None
+        # if there is none.
+        self.mark = None
+
+    ## Path of index snapshot of this slot.
+    @property
+    def index_path(self):
+        return os.path.join(
+            self._path,
+            '%s.%s' % (constants.CACHE_INDEX_FILE, self._slot),
+        )
+
+    ## Returns path of segment file.
+    # @param number (int) segment number.
+    # @returns (str) path.
+    #
+    def segment_path(self, number):
+        return os.path.join(self._path, '%s.%s' % (self._slot, number))
+
+    ## Opens segment files of this slot.
+    # Records are not known until adopted from the index.
+    #
+    def open(self):
+        try:
+            os.mkdir(self._path)
+        except OSError:
+            pass
+        for name in os.listdir(self._path):
+            slot, sep, number = name.partition('.')
+            if slot == str(self._slot) and number.isdigit():
+                number = int(number)
+                self._segments[number] = Segment(
+                    self.segment_path(number),
+                    number,
+                )
+
+    ## Position of next record.
+    @property
+    def position(self):
+        if self._active is not None:
+            return (self._active.number, self._active.size)
+        return (max(self._segments or [-1]) + 1, 0)
+
+    ## Takes indexed record of entry into the store.
+    # @param key (str) cache key.
+    # @param location (tuple) record location.
+    # @param size (int) content length.
+    # @returns (bool) whether record is in a segment.
+    #
+    def adopt(self, key, location, size):
+        number, start, end = location
+        segment = self._segments.get(number)
+        if (
+            segment is None or
+            end > segment.size or
+            end - start < RECORD_HEADER.size + size
+        ):
+            return False
+        segment.records[start] = (key, end)
+        segment.live += end - start
+        return True
+
+    ## Reads records appended after the mark.
+    # Records appended before it are known to the index snapshot, those left
+    # out of it were deleted. Records after it are read up to the first
+    # incomplete record of a segment, which was cut by a crash. Deletion
+    # record removes entry appended before it.
+    # @returns (list) (key, expiration, head, size, location) of records, in
+    # the order they were appended, head is None for deletion record.
+    #
+    def recover(self):
+        found = []
+        mark = self.mark or (0, 0)
+        for number in sorted(self._segments):
+            if number < mark[0]:
+                continue
+            segment = self._segments[number]
+            offset = mark[1] if number == mark[0] else 0
+            while offset + RECORD_HEADER.size <= segment.size:
+                (
+                    magic,
+                    key_length,
+                    head_length,
+                    size,
+                    expiration,
+                ) = RECORD_HEADER.unpack(
+                    util.pread(segment.fd, RECORD_HEADER.size, offset),
+                )
+                end = (
+                    offset + RECORD_HEADER.size +
+                    key_length + head_length + size
+                )
+                if (
+                    magic not in (RECORD_MAGIC, DELETION_MAGIC) or
+                    end > segment.size
+                ):
+                    break
+                data = util.pread(
+                    segment.fd,
+                    key_length + head_length,
+                    offset + RECORD_HEADER.size,
+                )
+                key, head = data[:key_length], data[key_length:]
+                if magic == DELETION_MAGIC:
+                    head = None
+                else:
+                    segment.records[offset] = (key, end)
+                    segment.live += end - offset
+                found.append(
+                    (key, expiration, head, size, (number, offset, end)),
+                )
+                offset = end
+        return found
+
+    ## Retires segments with no indexed records.
+    # Called once index was adopted and recovered.
+    #
+    def drop_unused(self):
+        for segment in self._segments.values():
+            if not segment.records:
+                self.retire(segment)
+
+    ## Starts a new active segment.
+    # @returns (Segment) active segment.
+    #
+    def roll(self):
+        number = int(time.time() * 1000)
+        if self._segments:
+            number = max(number, max(self._segments) + 1)
+        self._active = Segment(self.segment_path(number), number)
+        self._segments[number] = self._active
+        return self._active
+
+    ## Appends record to the active segment.
+    # @param key (str) cache key.
+    # @param record (str) record.
+    # @returns (tuple) record location.
+    #
+    def append_record(self, key, record):
+        segment = self._active
+        if segment is None or segment.size >= self._segment_size:
+            segment = self.roll()
+        try:
+            written = os.write(segment.fd, record)
+        except OSError:
+            segment.size = os.fstat(segment.fd).st_size
+            raise
+        start = segment.size
+        segment.size += written
+        if written != len(record):
+            raise IOError(
+                errno.ENOSPC,
+                'Short write to segment %s' % segment.number,
+            )
+        segment.records[start] = (key, segment.size)
+        segment.live += written
+        return (segment.number, start, segment.size)
+
+    ## Appends entry to the active segment.
+    # @param key (str) cache key.
+    # @param head (str) response head.
+    # @param content (str) response content.
+    # @param expiration (int) expiration date.
+    # @returns (tuple) record location.
+    #
+    def append(self, key, head, content, expiration):
+        return self.append_record(
+            key,
+            RECORD_HEADER.pack(
+                RECORD_MAGIC,
+                len(key),
+                len(head),
+                len(content),
+                expiration,
+            ) + key + head + content,
+        )
+
+    ## Opens reader of entry content.
+    # @param key (str) cache key.
+    # @param head (str) response head.
+    # @param location (tuple) record location.
+    # @param size (int) content length.
+    # @returns (CacheReader) reader.
+    #
+    def open_reader(self, key, head, location, size):
+        number, start, end = location
+        segment = self._segments.get(number)
+        if segment is None:
+            raise OSError(errno.ENOENT, 'Segment %s is gone' % number)
+        return cache_reader.CacheReader(key, segment, head, end - size, size)
+
+    ## Removes record, its space is reclaimed by compaction.
+    # @param location (tuple) record location.
+    #
+    def remove(self, location):
+        number, start, end = location
+        segment = self._segments.get(number)
+        if segment is not None and segment.records.pop(start, None):
+            segment.live -= end - start
+
+    ## Removes record of deleted entry.
+    # Deletion record is appended, it is dead space right away.
+    # @param key (str) cache key.
+    # @param location (tuple) record location.
+    #
+    def delete(self, key, location):
+        self.remove(location)
+        number, start, end = self.append_record(
+            key,
+            RECORD_HEADER.pack(DELETION_MAGIC, len(key), 0, 0, 0) + key,
+        )
+        self.remove((number, start, end))
+
+    ## Removes segment file.
+    # Current readers keep reading the file they opened.
+    # @param segment (Segment).
+    #
+    def retire(self, segment):
+        self._segments.pop(segment.number, None)
+        if segment is self._active:
+            self._active = None
+        try:
+            os.remove(segment.path)
+        except OSError:
+            pass
+        segment.release()
+
+    ## Removes all segments.
+    #
+    def clear(self):
+        self._compacting = None
+        for segment in self._segments.values():
+            self.retire(segment)
+
+    ## Returns segment worth compacting.
+    # Only segments before the mark are compacted, records after it may be
+    # needed to recover entries the index snapshot does not have.
+    # @returns (Segment) segment with least space in use, None if none is
+    # below the compaction ratio.
+    #
+    def pick(self):
+        if self.mark is None:
+            return None
+        candidates = [
+            segment
+            for segment in self._segments.values()
+            if (
+                segment.number < self.mark[0] and
+                segment.live < segment.size * constants.SEGMENT_COMPACT_RATIO
+            )
+        ]
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda segment: float(segment.live) / max(segment.size, 1),
+        )
+
+    ## Copies records of mostly dead segments to the active segment.
+    # Segment is retired once all its records were copied.
+    # @param budget (int) max bytes to copy.
+    # @returns (list) (key, old location, new location) of moved records,
+    # new location is None if record could not be read. Copying stops at the
+    # first record that cannot be written.
+    #
+    def compact(self, budget):
+        moved = []
+        while budget > 0:
+            segment = self._compacting
+            if segment is None or segment.number not in self._segments:
+                segment = self._compacting = self.pick()
+                if segment is None:
+                    break
+            if not segment.records:
+                self._compacting = None
+                self.retire(segment)
+                continue
+            start, (key, end) = segment.records.popitem()
+            segment.live -= end - start
+            budget -= end - start
+            record = util.pread(segment.fd, end - start, start)
+            location = None
+            if len(record) == end - start:
+                try:
+                    location = self.append_record(key, record)
+                except (IOError, OSError):
+                    # Record stays, copy is tried again on next call.
+                    segment.records[start] = (key, end)
+                    segment.live += end - start
+                    break
+            moved.append((key, (segment.number, start, end), location))
+        return moved
@@ -0,0 +1,91 @@
+## @package proxy.send_buffer
+# Module for SendBuffer object.
+## @file send_buffer.py
+# Implementation of @ref proxy.send_buffer
+#
+
+import collections
+import constants
+import errno
+import socket
+
+
+## Outbound buffer of a socket.
+#
+# Queue of chunks that were added by producers. Chunks are never joined or
+# re-sliced, a partial write only advances the offset into the first chunk,
+# and the total length is kept so len() is O(1).
+# Where socket.sendmsg is available, pending chunks are written with one
+# scatter-gather call.
+#
+class SendBuffer(object):
+    ## Constructor.
+    # @param data (str) initial content.
+    #
+    def __init__(self, data=''):
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._length = 0
+        self.append(data)
+
+    def __len__(self):
+        return self._length
+
+    def __iadd__(self, data):
+        self.append(data)
+        return self
+
+    ## Adds data to the end of the buffer.
+    # @param data (str) data to add.
+    #
+    def append(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if data:
+            self._chunks.append(data)
+            self._length += len(data)
+
+    ## Drops all pending data.
+    #
+    def clear(self):
+        self._chunks.clear()
+        self._offset = 0
+        self._length = 0
+
+    ## Drops bytes that were sent from the head of the buffer.
+    # @param count (int) number of bytes.
+    #
+    def consume(self, count):
+        self._length -= count
+        count += self._offset
+        while self._chunks and count >= len(self._chunks[0]):
+            count -= len(self._chunks.popleft())
+        self._offset = count
+
+    ## Sends everything possible from the buffer.
+    # @param s (socket) socket to send to.
+    # @returns (int) number of bytes sent.
+    #
+    def send(self, s):
+        sent = 0
+        try:
+            while self._chunks:
+                first = memoryview(self._chunks[0])[self._offset:]
+                if hasattr(s, 'sendmsg') and len(self._chunks) > 1:
+                    buffers = [first]
+                    for i in range(
+                        1,
+                        min(len(self._chunks), constants.SEND_BUFFER_IOV),
+                    ):
+                        buffers.append(self._chunks[i])
+                    bytes_sent = s.sendmsg(buffers)
+                else:
+                    bytes_sent = s.send(first)
+                self.consume(bytes_sent)
+                sent += bytes_sent
+
+        except socket.error as e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+
+        return sent
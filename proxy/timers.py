@@ -0,0 +1,98 @@
+## @package proxy.timers
+# Module for Timer, TimerWheel objects.
+## @file timers.py
+# Implementation of @ref proxy.timers
+#
+
+import constants
+import math
+import time
+
+
+## Single timer armed on a TimerWheel.
+class Timer(object):
+    ## Constructor.
+    # @param tick (int) absolute wheel tick the timer expires at.
+    # @param callback (callable) called when timer expires.
+    #
+    def __init__(self, tick, callback):
+        self.tick = tick
+        self.callback = callback
+
+
+## Hashed timer wheel.
+#
+# Created by Poller.
+# Timers are hashed into slots by their expiration tick, so arm and cancel
+# are O(1). Timers further away than one wheel turn share a slot with closer
+# ones and are skipped until their tick is reached.
+#
+class TimerWheel(object):
+    ## Constructor.
+    # @param slots (int) number of slots in wheel.
+    # @param resolution (float) seconds per tick.
+    #
+    def __init__(
+        self,
+        slots=constants.TIMER_WHEEL_SLOTS,
+        resolution=constants.TIMER_WHEEL_RESOLUTION,
+    ):
+        self._slots = [set() for i in range(slots)]
+        self._resolution = resolution
+        self._current = int(time.time() / resolution)
+        self._count = 0
+
+    ## Arm a new timer.
+    # @param delay (float) seconds until expiration.
+    # @param callback (callable) called when timer expires.
+    # @returns (Timer) timer handle.
+    #
+    def arm(self, delay, callback):
+        tick = max(
+            int(math.ceil((time.time() + delay) / self._resolution)),
+            self._current + 1,
+        )
+        timer = Timer(tick, callback)
+        self._slots[tick % len(self._slots)].add(timer)
+        self._count += 1
+        return timer
+
+    ## Cancel armed timer.
+    # @param timer (Timer) timer handle.
+    #
+    def cancel(self, timer):
+        slot = self._slots[timer.tick % len(self._slots)]
+        if timer in slot:
+            slot.remove(timer)
+            self._count -= 1
+
+    ## Returns seconds until the next non empty slot.
+    # @returns (float) seconds, None if no timer is armed.
+    #
+    def next_timeout(self):
+        if not self._count:
+            return None
+        for tick in range(
+            self._current + 1,
+            self._current + len(self._slots) + 1,
+        ):
+            if self._slots[tick % len(self._slots)]:
+                return max(0, tick * self._resolution - time.time())
+
+    ## Advance wheel to current time and collect expired timers.
+    # @returns (list) expired timers.
+    #
+    def expire(self):
+        target = int(time.time() / self._resolution)
+        expired = []
+        for tick in range(
+            self._current + 1,
+            min(target, self._current + len(self._slots)) + 1,
+        ):
+            slot = self._slots[tick % len(self._slots)]
+            for timer in [timer for timer in slot if timer.tick <= target]:
+                slot.remove(timer)
+                expired.append(timer)
+        self._current = max(self._current, target)
+        self._count -= len(expired)
+        return expired
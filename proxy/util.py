@@ -6,8 +6,11 @@
 #
 
 import constants
+import email.utils
 import errno
+import os
 import socket
+import sys
 
 
 # python-3 woodo
@@ -19,31 +22,132 @@ except ImportError:
     import urllib.parse
     urlparse = urllib.parse
 
+## SO_REUSEPORT socket option, not exported by python-2 socket module.
+SO_REUSEPORT = getattr(
+    socket,
+    'SO_REUSEPORT',
+    15 if sys.platform.startswith('linux') else 0x0200,
+)
 
-## Parse header line.
-# @returns (tuple) header, content
+## TCP_CORK socket option, None where not supported.
+TCP_CORK = getattr(
+    socket,
+    'TCP_CORK',
+    3 if sys.platform.startswith('linux') else None,
+)
+
+
+## Corks or uncorks socket.
+# Corked socket sends only full packets, so a head and the content that
+# follows share packets. Uncorking sends what is pending.
+# @param s (socket)
+# @param cork (bool)
 #
-def parse_header(line):
-    SEP = ':'
-    n = line.find(SEP)
-    if n == -1:
-        raise RuntimeError('Invalid header received')
-    return line[:n].rstrip(), line[n + len(SEP):].lstrip()
+def set_cork(s, cork):
+    if TCP_CORK is not None:
+        s.setsockopt(socket.IPPROTO_TCP, TCP_CORK, int(cork))
+
+
+# python-3 woodo
+if hasattr(os, 'pread'):
+    pread = os.pread
+else:
+    ## Reads from descriptor at offset.
+    # Offset of descriptor is changed, which is safe as long as the
+    # descriptor is used from a single thread.
+    # @param fd (int) descriptor.
+    # @param size (int) max bytes to read.
+    # @param offset (int) position to read from.
+    # @returns (str) data, empty at end of file.
+    #
+    def pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+## Checks whether a process is running.
+# @param pid (int) process id.
+# @returns (bool)
+#
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+## Parses HTTP date.
+# @param value (str) date.
+# @returns (float) timestamp, None if date is invalid.
+#
+def parse_http_date(value):
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
 
 
-## Add header to existing headers dict.
-# @param line (str) header to add to headers dict.
-# @param headers (dict) Header dict.
-# @return (dict) headers
+## Checks whether entity tag matches If-None-Match header.
+# Tags are compared weakly.
+# @param header (str) If-None-Match header.
+# @param etag (str) entity tag, None if there is none.
+# @returns (bool)
 #
-def update_headers(line, headers):
-    if len(headers) < constants.MAX_NUMBER_OF_HEADERS:
-        k, v = parse_header(line)
-        headers[k] = v
-    else:
-        raise RuntimeError('Too many headers')
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    if etag is None:
+        return False
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
 
-    return headers
+
+## Returns tokens of Connection header.
+# Old HTTP/1.0 proxy clients send Proxy-Connection instead, its tokens are
+# honoured the same way.
+# @param headers (Headers)
+# @returns (list) lower case tokens.
+#
+def connection_tokens(headers):
+    return [
+        token.strip().lower()
+        for name in ('Connection', 'Proxy-Connection')
+        for token in headers.get(name, '').split(',')
+    ]
+
+
+## Checks if a connection is kept open after a response.
+# @param status_line (str) response status line.
+# @param headers (Headers) response headers.
+# @returns (bool)
+#
+def is_keep_alive(status_line, headers):
+    tokens = connection_tokens(headers)
+    if status_line.startswith(constants.HTTP_SIGNATURE):
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+
+## Returns names of headers that must not be forwarded.
+# These are the standard hop-by-hop headers, and headers listed in
+# Connection (or Proxy-Connection) header.
+# @param headers (Headers)
+# @returns (set) lower case header names.
+#
+def hop_by_hop_headers(headers):
+    return set(constants.HOP_BY_HOP_HEADERS).union(connection_tokens(headers))
 
 
 ## Checks if response status line is valid, and parse it.
@@ -71,10 +175,10 @@ def check_response(res):
 #
 def check_request(req):
     req_comps = req.split(' ', 2)
-    if req_comps[2] != constants.HTTP_SIGNATURE:
-        raise RuntimeError('Not HTTP protocol')
     if len(req_comps) != 3:
         raise RuntimeError('Incomplete HTTP protocol')
+    if req_comps[2] != constants.HTTP_SIGNATURE:
+        raise RuntimeError('Not HTTP protocol')
 
     method, uri, signature = req_comps
     if method not in ('GET', 'CONNECT', 'POST'):
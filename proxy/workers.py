@@ -0,0 +1,219 @@
+## @package proxy.workers
+# Module for Supervisor, SharedStatistics objects.
+## @file workers.py
+# Implementation of @ref proxy.workers
+#
+
+import constants
+import errno
+import mmap
+import os
+import signal
+import struct
+import time
+import traceback
+
+## Layout of worker throughput counter: bytes sent, throughput start time.
+THROUGHPUT_FORMAT = '=qd'
+## Layout of worker connections counter: open connections.
+CONNECTIONS_FORMAT = '=q'
+## Layout of worker sweeper counters: entries and bytes removed, lag.
+SWEEP_FORMAT = '=qqq'
+## Names of worker sweeper counters.
+SWEEP_NAMES = ('entries', 'bytes', 'lag')
+## Size of a single worker statistics slot.
+SLOT_SIZE = sum(
+    struct.calcsize(fmt)
+    for fmt in (THROUGHPUT_FORMAT, CONNECTIONS_FORMAT, SWEEP_FORMAT)
+)
+
+
+## Counters of a single worker.
+#
+# Behaves like the lists and dicts of application_context['statistics'],
+# but the values live in memory shared by all workers.
+#
+class SharedCounters(object):
+    ## Constructor.
+    # @param buf (mmap) shared memory.
+    # @param offset (int) offset of counters.
+    # @param fmt (str) struct format of counters.
+    # @param names (tuple) names of counters, if accessed by name.
+    #
+    def __init__(self, buf, offset, fmt, names=()):
+        self._buf = buf
+        self._offset = offset
+        self._format = fmt
+        self._names = names
+
+    ## Size of counters.
+    @property
+    def size(self):
+        return struct.calcsize(self._format)
+
+    def _index(self, key):
+        if key in self._names:
+            return self._names.index(key)
+        return key
+
+    def __getitem__(self, key):
+        return struct.unpack_from(
+            self._format,
+            self._buf,
+            self._offset,
+        )[self._index(key)]
+
+    def __setitem__(self, key, value):
+        values = list(
+            struct.unpack_from(self._format, self._buf, self._offset)
+        )
+        values[self._index(key)] = value
+        struct.pack_into(self._format, self._buf, self._offset, *values)
+
+
+## Statistics shared between the supervisor and all workers.
+#
+# Created by __main__ before workers are forked, so the anonymous memory
+# mapping is inherited by all of them.
+#
+class SharedStatistics(object):
+    ## Constructor.
+    # @param count (int) number of workers.
+    #
+    def __init__(self, count):
+        self._count = count
+        self._buf = mmap.mmap(-1, SLOT_SIZE * count)
+        for index in range(count):
+            self.reset(index)
+
+    ## Clears counters of worker.
+    # Called when worker is started, counters left by the worker it replaces
+    # are stale, its connections are gone.
+    # @param index (int) worker index.
+    #
+    def reset(self, index):
+        offset = SLOT_SIZE * index
+        self._buf[offset:offset + SLOT_SIZE] = '\0' * SLOT_SIZE
+        self.statistics(index)['throughput'][1] = time.time()
+
+    ## Returns counters of worker.
+    # @param index (int) worker index.
+    # @returns (dict) counters, same keys as
+    # application_context['statistics'].
+    #
+    def statistics(self, index):
+        offset = SLOT_SIZE * index
+        throughput = SharedCounters(self._buf, offset, THROUGHPUT_FORMAT)
+        offset += throughput.size
+        connections = SharedCounters(self._buf, offset, CONNECTIONS_FORMAT)
+        offset += connections.size
+        return {
+            'throughput': throughput,
+            'connections': connections,
+            'sweep': SharedCounters(
+                self._buf,
+                offset,
+                SWEEP_FORMAT,
+                SWEEP_NAMES,
+            ),
+        }
+
+    ## Returns counters of all workers.
+    # @returns (list) counters.
+    #
+    def all_statistics(self):
+        return [self.statistics(index) for index in range(self._count)]
+
+
+## SIGTERM handler of a process running the proxy.
+# Exits through SystemExit, so sockets are closed and cache index is saved
+# on the way out.
+#
+def terminate(signum, frame):
+    raise SystemExit(0)
+
+
+## Supervisor of worker processes.
+#
+# Created from __main__ when running with more than one worker.
+# Forks the workers, restarts workers that died and terminates all of them
+# on shutdown.
+#
+class Supervisor(object):
+    ## Constructor.
+    # @param count (int) number of workers.
+    # @param target (callable) worker main, called with worker index.
+    # @param logger (logging.Logger)
+    #
+    def __init__(self, count, target, logger):
+        self._count = count
+        self._target = target
+        self._logger = logger
+        # pid -> (index, time started)
+        self._children = {}
+        self._stopping = False
+
+    ## Forks a worker.
+    # @param index (int) worker index.
+    #
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, terminate)
+                self._target(index)
+            except SystemExit as e:
+                status = e.code or 0
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self._logger.info('Worker %s started, pid %s', index, pid)
+        self._children[pid] = (index, time.time())
+
+    ## Terminates all workers.
+    #
+    def stop(self, signum=None, frame=None):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    ## Runs the workers until stopped.
+    #
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(self._count):
+            self.spawn(index)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                self.stop()
+                continue
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            if pid not in self._children:
+                continue
+            index, started = self._children.pop(pid)
+            if self._stopping:
+                continue
+            self._logger.error(
+                'Worker %s (pid %s) died with status %s, restarting',
+                index,
+                pid,
+                status,
+            )
+            if time.time() - started < constants.WORKER_RESTART_DELAY:
+                time.sleep(constants.WORKER_RESTART_DELAY)
+            self.spawn(index)
@@ -0,0 +1,150 @@
+## @package proxy.zero_copy
+# Module for moving data between descriptors inside the kernel.
+## @file zero_copy.py
+# Implementation of @ref proxy.zero_copy
+#
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import sys
+
+## splice() flag, move pages instead of copying.
+SPLICE_F_MOVE = 1
+## splice() flag, do not block on pipe.
+SPLICE_F_NONBLOCK = 2
+
+
+## Load C library.
+# @returns (ctypes.CDLL) C library, None if not available.
+#
+def load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+
+
+_libc = load_libc()
+
+
+# python-3 woodo
+if hasattr(os, 'splice'):
+    ## Moves bytes between descriptors, one of them must be a pipe.
+    # @param fd_in (int) descriptor to read from.
+    # @param fd_out (int) descriptor to write to.
+    # @param count (int) max bytes to move.
+    # @returns (int) bytes moved, 0 on end of file.
+    #
+    def splice(fd_in, fd_out, count):
+        return os.splice(
+            fd_in,
+            fd_out,
+            count,
+            flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK,
+        )
+
+elif (
+    sys.platform.startswith('linux') and
+    _libc is not None and
+    hasattr(_libc, 'splice')
+):
+    _libc.splice.argtypes = [
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_uint,
+    ]
+    _libc.splice.restype = ctypes.c_ssize_t
+
+    def splice(fd_in, fd_out, count):
+        ret = _libc.splice(
+            fd_in,
+            None,
+            fd_out,
+            None,
+            count,
+            SPLICE_F_MOVE | SPLICE_F_NONBLOCK,
+        )
+        if ret == -1:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return ret
+
+else:
+    splice = None
+
+
+# python-3 woodo
+if hasattr(os, 'sendfile'):
+    ## Sends bytes of a file to a socket.
+    # File offset is not changed.
+    # @param fd_out (int) socket descriptor.
+    # @param fd_in (int) file descriptor.
+    # @param offset (int) position in file to send from.
+    # @param count (int) max bytes to send.
+    # @returns (int) bytes sent, 0 on end of file.
+    #
+    def sendfile(fd_out, fd_in, offset, count):
+        return os.sendfile(fd_out, fd_in, offset, count)
+
+elif (
+    sys.platform.startswith('linux') and
+    _libc is not None and
+    hasattr(_libc, 'sendfile64')
+):
+    _libc.sendfile64.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t,
+    ]
+    _libc.sendfile64.restype = ctypes.c_ssize_t
+
+    def sendfile(fd_out, fd_in, offset, count):
+        offset = ctypes.c_int64(offset)
+        ret = _libc.sendfile64(fd_out, fd_in, ctypes.byref(offset), count)
+        if ret == -1:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return ret
+
+else:
+    sendfile = None
+
+
+## Creates a non blocking pipe to splice through.
+# @returns (tuple) read fd, write fd. None if splice is not available.
+#
+def create_pipe():
+    if splice is None:
+        return None
+    pipe = os.pipe()
+    for fd in pipe:
+        fcntl.fcntl(
+            fd,
+            fcntl.F_SETFL,
+            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK,
+        )
+    return pipe
+
+
+## Closes a pipe.
+# @param pipe (tuple) read fd, write fd.
+#
+def close_pipe(pipe):
+    if pipe:
+        for fd in pipe:
+            os.close(fd)
+
+
+## Checks whether error means that operation would block.
+# @param e (EnvironmentError)
+# @returns (bool)
+#
+def would_block(e):
+    return e.errno in (errno.EWOULDBLOCK, errno.EAGAIN)
@@ -0,0 +1,273 @@
+## @file test_resolver.py
+# Tests of @ref proxy.resolver against a local stub name server.
+#
+
+import logging
+import os
+import select
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from proxy import constants
+from proxy import resolver
+
+
+## Stub name server.
+# Answers each query with the packets returned by handler, which is called
+# with query id and queried name.
+#
+class StubServer(object):
+    def __init__(self):
+        self.queries = []
+        self.handler = lambda query_id, name: []
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._thread = threading.Thread(target=self.serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def address(self):
+        return '127.0.0.1:%d' % self._socket.getsockname()[1]
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self._socket.recvfrom(4096)
+            except socket.error:
+                return
+            query_id = struct.unpack('!H', data[:2])[0]
+            name = resolver.read_name(data, 12)[0]
+            self.queries.append((query_id, name))
+            for packet in self.handler(query_id, name):
+                self._socket.sendto(packet, address)
+
+    def close(self):
+        self._socket.close()
+
+
+## Builds response packet.
+# @param query_id (int) response id.
+# @param name (str) name in question section.
+# @param address (str) answer, None for NXDOMAIN.
+# @param ttl (int) ttl of answer, or SOA minimum of NXDOMAIN.
+# @returns (str) packet.
+#
+def response(query_id, name, address=None, ttl=60):
+    question = resolver.build_query(query_id, name)[12:]
+    if address is not None:
+        return (
+            struct.pack('!HHHHHH', query_id, 0x8180, 1, 1, 0, 0) +
+            question +
+            '\xc0\x0c' +
+            struct.pack('!HHIH', resolver.TYPE_A, resolver.CLASS_IN, ttl, 4) +
+            socket.inet_aton(address)
+        )
+    soa = '\x00' * 2 + struct.pack('!IIIII', 1, 3600, 600, 86400, ttl)
+    return (
+        struct.pack('!HHHHHH', query_id, 0x8183, 1, 0, 1, 0) +
+        question +
+        '\xc0\x0c' +
+        struct.pack(
+            '!HHIH',
+            resolver.TYPE_SOA,
+            resolver.CLASS_IN,
+            3600,
+            len(soa),
+        ) +
+        soa
+    )
+
+
+## Poll stub, timers expire only when fired by test.
+#
+class Poll(object):
+    def __init__(self):
+        self.timers = []
+
+    def arm_timer(self, delay, callback):
+        timer = [callback]
+        self.timers.append(timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        self.timers = [t for t in self.timers if t is not timer]
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            timer[0]()
+
+
+## Clock stub for cache expiration.
+#
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+logging.getLogger('test_resolver').addHandler(logging.NullHandler())
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._saved = (
+            constants.RESOLV_CONF_FILE,
+            constants.HOSTS_FILE,
+            resolver.time,
+        )
+        constants.RESOLV_CONF_FILE = os.path.join(self._dir, 'resolv.conf')
+        constants.HOSTS_FILE = os.path.join(self._dir, 'hosts')
+        with open(constants.RESOLV_CONF_FILE, 'w') as f:
+            f.write('search corp.example\noptions ndots:1\n')
+        with open(constants.HOSTS_FILE, 'w') as f:
+            f.write('')
+        self.clock = resolver.time = Clock()
+        self.server = StubServer()
+        self.poll = Poll()
+        self.resolver = resolver.Resolver(
+            self.poll,
+            self.server.address(),
+            logging.getLogger('test_resolver'),
+        )
+
+    def tearDown(self):
+        self.resolver.close_socket()
+        self.server.close()
+        (
+            constants.RESOLV_CONF_FILE,
+            constants.HOSTS_FILE,
+            resolver.time,
+        ) = self._saved
+        shutil.rmtree(self._dir)
+
+    ## Resolves host.
+    # @param host (str) host name.
+    # @param wait (bool) whether to read responses until callback is called.
+    # @returns (list) addresses callback was called with.
+    #
+    def resolve(self, host, wait=True):
+        result = []
+        self.resolver.resolve(host, result.append)
+        if wait:
+            self.wait(result)
+        return result
+
+    ## Reads responses until callback is called.
+    # @param result (list) addresses callback was called with.
+    #
+    def wait(self, result):
+        while not result:
+            ready = select.select([self.resolver.get_fd()], [], [], 2)[0]
+            self.assertTrue(ready, 'no response from stub server')
+            self.resolver.on_read(None, None)
+
+    def test_positive_ttl(self):
+        self.server.handler = lambda query_id, name: [
+            response(query_id, name, '10.0.0.1', ttl=60),
+        ]
+        self.assertEqual(self.resolve('www.example'), ['10.0.0.1'])
+        self.assertEqual(self.resolve('www.example', False), ['10.0.0.1'])
+        self.assertEqual(len(self.server.queries), 1)
+
+        self.clock.now += 61
+        self.assertEqual(self.resolve('www.example'), ['10.0.0.1'])
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_negative_ttl(self):
+        self.server.handler = lambda query_id, name: [
+            response(query_id, name, None, ttl=10),
+        ]
+        self.assertEqual(self.resolve('missing.example.'), [None])
+        self.assertEqual(self.resolve('missing.example.', False), [None])
+        self.assertEqual(len(self.server.queries), 1)
+
+        self.clock.now += 11
+        self.assertEqual(self.resolve('missing.example.'), [None])
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_search_ndots(self):
+        def handler(query_id, name):
+            if name in ('web.corp.example', 'a.b'):
+                return [response(query_id, name, '10.0.0.2')]
+            return [response(query_id, name)]
+        self.server.handler = handler
+
+        self.assertEqual(self.resolve('web'), ['10.0.0.2'])
+        self.assertEqual(
+            [name for query_id, name in self.server.queries],
+            ['web.corp.example'],
+        )
+
+        del self.server.queries[:]
+        self.assertEqual(self.resolve('a.b'), ['10.0.0.2'])
+        self.assertEqual(
+            [name for query_id, name in self.server.queries],
+            ['a.b'],
+        )
+
+        del self.server.queries[:]
+        self.assertEqual(self.resolve('db'), [None])
+        self.assertEqual(
+            [name for query_id, name in self.server.queries],
+            ['db.corp.example', 'db'],
+        )
+
+    def test_timeout_retry(self):
+        def handler(query_id, name):
+            if len(self.server.queries) < 2:
+                return []
+            return [response(query_id, name, '10.0.0.3')]
+        self.server.handler = handler
+
+        result = self.resolve('slow.example', False)
+        self.assertEqual(result, [])
+        self.poll.fire()
+        self.wait(result)
+        self.assertEqual(result, ['10.0.0.3'])
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertNotEqual(
+            self.server.queries[0][0],
+            self.server.queries[1][0],
+        )
+        self.assertEqual(self.poll.timers, [])
+
+    def test_timeout_gives_up(self):
+        result = self.resolve('dead.example', False)
+        for i in range(constants.DNS_TRIES):
+            self.assertEqual(result, [])
+            self.poll.fire()
+        self.assertEqual(result, [None])
+        deadline = time.time() + 2
+        while (
+            len(self.server.queries) < constants.DNS_TRIES and
+            time.time() < deadline
+        ):
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.queries), constants.DNS_TRIES)
+
+    def test_mismatched_id(self):
+        self.server.handler = lambda query_id, name: [
+            response(query_id ^ 1, name, '10.6.6.6'),
+            response(query_id, name, '10.0.0.4'),
+        ]
+        self.assertEqual(self.resolve('id.example'), ['10.0.0.4'])
+
+    def test_mismatched_question(self):
+        self.server.handler = lambda query_id, name: [
+            response(query_id, 'evil.example', '10.6.6.6'),
+            response(query_id, name, '10.0.0.5'),
+        ]
+        self.assertEqual(self.resolve('name.example'), ['10.0.0.5'])
+
+
+if __name__ == '__main__':
+    unittest.main()